@@ -7,7 +7,12 @@ import sys
 import os
 import argparse
 
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename
+from plot_app.log_parameters import delete_log_parameters
+from plot_app.log_search import delete_log_search_entry
+from plot_app.log_statistics import delete_log_statistics
 
 
 parser = argparse.ArgumentParser(description='Remove a DB entry (but not the log file)')
@@ -22,6 +27,9 @@ with con:
     cur = con.cursor()
     for log_id in args.log_id:
         print('Removing '+log_id)
+        delete_log_statistics(cur, log_id)
+        delete_log_search_entry(cur, log_id)
+        delete_log_parameters(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         num_deleted = cur.rowcount
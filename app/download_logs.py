@@ -83,13 +83,50 @@ def error_labels_to_ids(error_labels):
     return error_ids
 
 
+def get_db_info_params(args):
+    """
+    returns the query arguments for the dbinfo API, so that the server only
+    sends the matching entries (the filters are applied here as well, for
+    servers that do not support them)
+    """
+    params = {}
+    if args.mav_type is not None:
+        params['mav_type'] = args.mav_type
+    if args.rating is not None:
+        params['rating'] = args.rating
+    if args.error_labels is not None:
+        params['error_labels'] = error_labels_to_ids(args.error_labels)
+    if args.flight_modes is not None:
+        params['flight_modes'] = flight_modes_to_ids(args.flight_modes)
+    if args.uuid is not None:
+        params['uuid'] = args.uuid
+    if args.log_id is not None:
+        params['log_id'] = args.log_id
+    if args.vehicle_name is not None:
+        params['vehicle_name'] = args.vehicle_name
+    if args.airframe_name is not None:
+        params['airframe_name'] = args.airframe_name
+    if args.airframe_type is not None:
+        params['airframe_type'] = args.airframe_type
+    if args.latest_per_vehicle:
+        params['latest_per_vehicle'] = 1
+    if args.source is not None:
+        params['source'] = args.source
+    if args.git_hash is not None:
+        params['git_hash'] = args.git_hash
+    if args.max_num > 0:
+        params['length'] = args.max_num
+    return params
+
+
 def main():
     """ main script entry point """
     args = get_arguments()
 
     try:
-        # the db_info_api sends a json file with a list of all public database entries
-        db_entries_list = requests.get(url=args.db_info_api, timeout=5*60).json()
+        # the db_info_api sends a json file with a list of all matching public database entries
+        db_entries_list = requests.get(url=args.db_info_api, params=get_db_info_params(args),
+                                       timeout=5*60).json()
     except:
         print("Server request failed.")
         raise
@@ -217,15 +254,37 @@ def main():
                     if args.overwrite or entry_id not in logids:
 
                         file_path = os.path.join(args.download_folder, entry_id + ".ulg")
+                        # download into a partial file, and resume it on retry
+                        partial_file_path = file_path + '.part'
+                        headers = {}
+                        if os.path.exists(partial_file_path):
+                            headers['Range'] = 'bytes={}-'.format(
+                                os.path.getsize(partial_file_path))
 
                         print('downloading {:}/{:} ({:})'.format(i + 1, n_en, entry_id))
                         request = requests.get(url=args.download_api +
                                                "?log=" + entry_id, stream=True,
-                                               timeout=10*60)
-                        with open(file_path, 'wb') as log_file:
-                            for chunk in request.iter_content(chunk_size=1024):
+                                               headers=headers, timeout=10*60)
+                        if request.status_code == 416:
+                            # the partial file is complete if it has the size
+                            # of the log, otherwise it's broken: start over
+                            content_range = request.headers.get('Content-Range', '')
+                            if content_range == 'bytes */{}'.format(
+                                    os.path.getsize(partial_file_path)):
+                                os.rename(partial_file_path, file_path)
+                                n_downloaded += 1
+                                break
+                            print('partial file does not match the log, downloading it again')
+                            os.remove(partial_file_path)
+                            continue
+                        request.raise_for_status()
+                        # the server sends the whole file if it does not support ranges
+                        file_mode = 'ab' if request.status_code == 206 else 'wb'
+                        with open(partial_file_path, file_mode) as log_file:
+                            for chunk in request.iter_content(chunk_size=1024*1024):
                                 if chunk:  # filter out keep-alive new chunks
                                     log_file.write(chunk)
+                        os.rename(partial_file_path, file_path)
                         n_downloaded += 1
                     else:
                         n_skipped += 1
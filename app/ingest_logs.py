@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+""" Script to ingest (many) ULog files from folders into the DB, in parallel.
+The ingested files are recorded in the IngestManifest table, so that an
+interrupted run can be resumed by running it again with the same arguments. """
+
+import argparse
+import datetime
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from pyulog import ULog
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
+from tornado_handlers.bulk_upload import insert_bulk_log_db_entry, generate_log_id
+from tornado_handlers.common import insert_generated_db_data, get_duplicate_log_id
+from tornado_handlers.ingest import write_vehicle_db_entry
+from config import get_log_filepath #pylint: disable=C0411
+from db_connection import get_db_connection, close_db_connection #pylint: disable=C0411
+from db_entry import DBDataGenerated, DBVehicleData #pylint: disable=C0411
+from helper import load_ulog_file, get_total_flight_time, get_log_filename #pylint: disable=C0411
+
+# the files are copied under this name & renamed after the batch is committed
+TEMPORARY_SUFFIX = '.ingest'
+
+# only one run at a time (see _recover_temporary_files)
+LOCK_FILE_NAME = 'ingest_logs.lock'
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+LOG_FILE_EXTENSIONS = ['.ulg', '.ulog']
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = argparse.ArgumentParser(description='Ingest all ULog files in the given folders '
+                                                 '(recursively) into the database. Files that '
+                                                 'were ingested already (same path, size & '
+                                                 'modification time, or same content if '
+                                                 'upload_deduplication is enabled) are '
+                                                 'skipped, so an interrupted run can be resumed.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths', metavar='PATH', nargs='+',
+                        help='Folders or ULog files to ingest.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (parsing the logs).')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of logs per DB transaction.')
+    parser.add_argument('--delete-after', action='store_true', default=False,
+                        help='Delete the source files after successfully ingesting them.')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='Retry the files that failed in a previous run.')
+    parser.add_argument('--source', type=str, default='bulk',
+                        help='Source tag of the DB entries.')
+    parser.add_argument('--description', type=str, default='',
+                        help='Description of the DB entries.')
+    parser.add_argument('--private', action='store_true', default=False,
+                        help='Do not list the logs publicly.')
+    parser.add_argument('--progress-interval', type=float, default=10,
+                        help='Print the progress every this many seconds.')
+    return parser.parse_args()
+
+
+def get_bulk_formdict(source='bulk', description='', is_public=1):
+    """ get the upload options of the DB entries (see bulk_upload.py) """
+    return {
+        'description': description,
+        'email': '',
+        'upload_type': 'personal',
+        'source': source,
+        'title': '',
+        'obfuscated': 0,
+        'allow_for_analysis': 1,
+        'feedback': '',
+        'wind_speed': -1,
+        'rating': '',
+        'video_url': '',
+        'is_public': is_public,
+        'vehicle_name': '',
+        'error_labels': '',
+        }
+
+
+def find_log_files(paths):
+    """ get all ULog files in the given folders & files
+    :return: list of absolute paths, sorted """
+    file_paths = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            file_paths.append(path)
+            continue
+        for root, _, file_names in os.walk(path):
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1] in LOG_FILE_EXTENSIONS:
+                    file_paths.append(os.path.join(root, file_name))
+    return sorted(file_paths)
+
+
+def _recover_temporary_files(cur):
+    """ handle the copies of an interrupted run: the ones that were committed
+    are renamed, the others are removed """
+    log_dir = get_log_filepath()
+    for file_name in os.listdir(log_dir):
+        if not file_name.endswith(TEMPORARY_SUFFIX):
+            continue
+        temporary_file_name = os.path.join(log_dir, file_name)
+        log_id = os.path.splitext(file_name[:-len(TEMPORARY_SUFFIX)])[0]
+        cur.execute('SELECT Id FROM Logs WHERE Id = ?', [log_id])
+        if cur.fetchone() is not None:
+            os.rename(temporary_file_name, get_log_filename(log_id))
+        else:
+            os.unlink(temporary_file_name)
+
+
+def _init_worker():
+    """ worker process initializer: Ctrl-C is handled by the main process """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _ingest_file(task):
+    """
+    worker: copy a file into the log folder (under a temporary name) while
+    hashing it, and parse it
+    :param task: tuple of (path, size, modification time)
+    :return: result dict
+    """
+    file_path, size, mtime = task
+    result = {'path': file_path, 'size': size, 'mtime': mtime, 'log_id': None,
+              'sha256': None, 'error': ''}
+    log_id, new_file_name = generate_log_id()
+    temporary_file_name = new_file_name + TEMPORARY_SUFFIX
+    try:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as input_file, open(temporary_file_name, 'wb') as output_file:
+            header = input_file.read(len(ULog.HEADER_BYTES))
+            if header != ULog.HEADER_BYTES:
+                raise ValueError('Not a ULog file')
+            while len(header) > 0:
+                sha256.update(header)
+                output_file.write(header)
+                header = input_file.read(COPY_BUFFER_SIZE)
+        result['sha256'] = sha256.hexdigest()
+
+        ulog = load_ulog_file(temporary_file_name)
+        # the worker only needs each log once
+        load_ulog_file.cache_clear()
+        result['db_data_gen'] = DBDataGenerated.from_ulog(ulog)
+        result['flight_time'] = get_total_flight_time(ulog)
+        result['log_id'] = log_id
+    except Exception as e: #pylint: disable=broad-except
+        result['error'] = str(e) or type(e).__name__
+        if os.path.exists(temporary_file_name):
+            os.unlink(temporary_file_name)
+    return result
+
+
+class _Progress:
+    """ progress & throughput reporting """
+
+    def __init__(self, num_total, interval):
+        self.num_total = num_total
+        self.interval = interval
+        self.counts = {'ingested': 0, 'duplicate': 0, 'failed': 0}
+        self.num_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_print = self.start_time
+
+    def add(self, result_type, num_bytes):
+        """ count a processed file """
+        self.counts[result_type] += 1
+        self.num_bytes += num_bytes
+        if time.monotonic() - self.last_print >= self.interval:
+            self.print()
+
+    def print(self):
+        """ print the current progress """
+        self.last_print = time.monotonic()
+        elapsed = max(self.last_print - self.start_time, 1e-3)
+        num_done = sum(self.counts.values())
+        files_per_sec = num_done / elapsed
+        eta = ''
+        if 0 < num_done < self.num_total:
+            eta = ', ETA {}'.format(datetime.timedelta(
+                seconds=int((self.num_total - num_done) / files_per_sec)))
+        print('[{}/{}] {} ingested, {} duplicates, {} failed | {:.1f} files/s, {:.1f} MB/s{}'
+              .format(num_done, self.num_total, self.counts['ingested'],
+                      self.counts['duplicate'], self.counts['failed'], files_per_sec,
+                      self.num_bytes / elapsed / 1e6, eta))
+
+
+def _add_manifest_entry(cur, result, log_id, error=''):
+    """ record a processed file """
+    cur.execute('INSERT OR REPLACE INTO IngestManifest '
+                '(Path, Size, MTime, Sha256, LogId, Error, Date) values (?, ?, ?, ?, ?, ?, ?)',
+                [result['path'], result['size'], result['mtime'], result['sha256'],
+                 log_id, error, datetime.datetime.now()])
+
+
+def _commit_batch(con, batch, formdict, progress):
+    """
+    insert the processed files of a batch in one transaction
+    :return: list of the source files that can be deleted
+    """
+    cur = con.cursor()
+    ingested_files = []
+    committed_log_ids = []
+    with con: # commits, or rolls back on error
+        for result in batch:
+            if result['log_id'] is None:
+                print('Failed to ingest {}: {}'.format(result['path'], result['error']))
+                _add_manifest_entry(cur, result, None, result['error'])
+                progress.add('failed', result['size'])
+                continue
+            temporary_file_name = get_log_filename(result['log_id']) + TEMPORARY_SUFFIX
+
+            # same content uploaded already (from another path, or in this batch)
+            duplicate_log_id = get_duplicate_log_id(cur, result['sha256'], formdict['is_public'],
+                                                    formdict['source'])
+            if duplicate_log_id is not None:
+                os.unlink(temporary_file_name)
+                _add_manifest_entry(cur, result, duplicate_log_id)
+                ingested_files.append(result['path'])
+                progress.add('duplicate', result['size'])
+                continue
+
+            log_id = result['log_id']
+            insert_bulk_log_db_entry(cur, log_id, os.path.basename(result['path']), formdict,
+                                     queue_ingestion=False, sha256=result['sha256'])
+            db_data_gen = result['db_data_gen']
+            insert_generated_db_data(cur, log_id, db_data_gen)
+            if db_data_gen.vehicle_uuid is not None:
+                vehicle_data = DBVehicleData()
+                vehicle_data.uuid = db_data_gen.vehicle_uuid
+                vehicle_data.log_id = log_id
+                if result['flight_time'] is not None:
+                    vehicle_data.flight_time = result['flight_time']
+                write_vehicle_db_entry(cur, vehicle_data, formdict['vehicle_name'])
+            _add_manifest_entry(cur, result, log_id)
+            ingested_files.append(result['path'])
+            committed_log_ids.append(log_id)
+            progress.add('ingested', result['size'])
+    for log_id in committed_log_ids:
+        os.rename(get_log_filename(log_id) + TEMPORARY_SUFFIX, get_log_filename(log_id))
+    cur.close()
+    return ingested_files
+
+
+def _get_tasks(cur, file_paths, retry_failed):
+    """ get the files that still need to be ingested
+    :return: list of (path, size, modification time) tuples """
+    tasks = []
+    for file_path in file_paths:
+        try:
+            stat_result = os.stat(file_path)
+        except OSError as e:
+            print('Skipping {}: {}'.format(file_path, e))
+            continue
+        cur.execute('SELECT Size, MTime, LogId FROM IngestManifest WHERE Path = ?', [file_path])
+        db_tuple = cur.fetchone()
+        if db_tuple is not None and db_tuple[0] == stat_result.st_size and \
+                db_tuple[1] == stat_result.st_mtime and \
+                (db_tuple[2] is not None or not retry_failed):
+            continue
+        tasks.append((file_path, stat_result.st_size, stat_result.st_mtime))
+    return tasks
+
+
+def ingest_log_files(paths, formdict, num_jobs, batch_size=100, delete_after=False,
+                     retry_failed=False, progress_interval=10):
+    """
+    ingest all ULog files in the given folders & files (skipping the ones that
+    were ingested already)
+    :param formdict: upload options of the DB entries (see get_bulk_formdict)
+    :return: True if all files were ingested successfully
+    """
+    with open(os.path.join(get_log_filepath(), LOCK_FILE_NAME), 'w', encoding='utf-8') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print('Error: another ingestion is running')
+            return False
+        return _ingest_log_files(paths, formdict, num_jobs, batch_size, delete_after,
+                                 retry_failed, progress_interval)
+
+
+def _ingest_log_files(paths, formdict, num_jobs, batch_size, delete_after,
+                      retry_failed, progress_interval):
+    """ see ingest_log_files (while holding the lock) """
+    con = get_db_connection()
+    cur = con.cursor()
+    _recover_temporary_files(cur)
+    file_paths = find_log_files(paths)
+    tasks = _get_tasks(cur, file_paths, retry_failed)
+    cur.close()
+    print('Found {} log files, {} of them are not ingested yet'.format(
+        len(file_paths), len(tasks)))
+
+    progress = _Progress(len(tasks), progress_interval)
+    batch = []
+    interrupted = False
+    # fork: the workers inherit the imported modules & config
+    with multiprocessing.get_context('fork').Pool(num_jobs, _init_worker) as pool:
+        try:
+            for result in pool.imap_unordered(_ingest_file, tasks):
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    ingested_files = _commit_batch(con, batch, formdict, progress)
+                    batch = []
+                    if delete_after:
+                        for file_path in ingested_files:
+                            os.unlink(file_path)
+        except KeyboardInterrupt:
+            print('Interrupted, committing the processed files')
+            interrupted = True
+            pool.terminate()
+    ingested_files = _commit_batch(con, batch, formdict, progress)
+    if delete_after:
+        for file_path in ingested_files:
+            os.unlink(file_path)
+    # files copied by the terminated workers
+    cur = con.cursor()
+    _recover_temporary_files(cur)
+    cur.close()
+    progress.print()
+    close_db_connection()
+    return not interrupted and progress.counts['failed'] == 0
+
+
+def main():
+    """ main method """
+    args = get_arguments()
+    formdict = get_bulk_formdict(args.source, args.description, 0 if args.private else 1)
+    success = ingest_log_files(args.paths, formdict, args.jobs, args.batch_size,
+                               args.delete_after, args.retry_failed, args.progress_interval)
+    sys.exit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+""" Script to measure the request latencies of a running server under
+concurrent, mixed traffic (browse table, dbinfo, downloads & the 3D page) """
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = argparse.ArgumentParser(description='Load test a running Flight Review server '
+                                                 'and print the latency percentiles per '
+                                                 'request type.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--url', type=str, default='http://localhost:5006',
+                        help='Base url of the server.')
+    parser.add_argument('--password', type=str, default='Password',
+                        help='Login password (needed for the browse page).')
+    parser.add_argument('-c', '--concurrency', type=int, default=20,
+                        help='Number of concurrent clients.')
+    parser.add_argument('-n', '--num-requests', type=int, default=500,
+                        help='Total number of requests.')
+    parser.add_argument('--mix', type=str, default='browse:6,dbinfo:1,download:2,3d:1',
+                        help='Relative weights of the request types.')
+    parser.add_argument('--log-id', type=str, default=None, nargs='+', dest='log_ids',
+                        help='Logs to use for downloads & the 3D page. Default: all public logs.')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='Request timeout in seconds.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed, to send the same requests in each run.')
+    return parser.parse_args()
+
+
+def percentile(sorted_values, fraction):
+    """ get a percentile (nearest rank) from a sorted list """
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadTest:
+    """ sends the requests & collects the latencies """
+
+    def __init__(self, args):
+        self.args = args
+        self.client = AsyncHTTPClient(max_clients=args.concurrency)
+        self.cookie = ''
+        self.num_logs = 0
+        self.log_ids = []
+        self.latencies = {}
+        self.errors = {}
+
+    async def setup(self):
+        """ login & get the ids of the logs to download """
+        response = await self.client.fetch(self.args.url+'/login', method='POST',
+                                           body=urlencode({'password': self.args.password}),
+                                           follow_redirects=False, raise_error=False)
+        cookies = response.headers.get_list('Set-Cookie')
+        self.cookie = '; '.join(cookie.split(';')[0] for cookie in cookies)
+
+        response = await self.client.fetch(self.args.url+'/dbinfo',
+                                           request_timeout=self.args.timeout)
+        self.num_logs = len(json.loads(response.body))
+        print('Server has {:} public logs'.format(self.num_logs))
+        self.log_ids = self.args.log_ids
+        if self.log_ids is None:
+            self.log_ids = [entry['log_id'] for entry in json.loads(response.body)]
+
+    def get_url(self, request_type):
+        """ get the url for a request type """
+        if request_type == 'browse':
+            params = {'draw': 1, 'start': random.randrange(0, max(1, self.num_logs), 1),
+                      'length': 50, 'order[0][column]': 1, 'order[0][dir]': 'desc',
+                      'search[value]': random.choice(['', '', 'quad', 'px4'])}
+            return self.args.url+'/browse_data_retrieval?'+urlencode(params)
+        if request_type == 'dbinfo':
+            return self.args.url+'/dbinfo'
+        log_id = random.choice(self.log_ids) if len(self.log_ids) > 0 else 'none'
+        if request_type == 'download':
+            return self.args.url+'/download?'+urlencode({'log': log_id})
+        if request_type == '3d':
+            return self.args.url+'/3d?'+urlencode({'log': log_id})
+        raise ValueError('Unknown request type '+request_type)
+
+    async def worker(self, request_types):
+        """ send requests until all are done """
+        while len(request_types) > 0:
+            request_type = request_types.pop()
+            url = self.get_url(request_type)
+            start = time.monotonic()
+            try:
+                await self.client.fetch(url, headers={'Cookie': self.cookie},
+                                        follow_redirects=False,
+                                        request_timeout=self.args.timeout)
+            except HTTPClientError as error:
+                # 4xx are expected (e.g. a log without position data for the 3D page)
+                if error.code >= 500 or error.code == 599:
+                    self.errors[request_type] = self.errors.get(request_type, 0) + 1
+            self.latencies.setdefault(request_type, []).append(time.monotonic() - start)
+
+    async def run(self):
+        """ run the load test
+        :return: duration in seconds
+        """
+        weights = {}
+        for entry in self.args.mix.split(','):
+            request_type, weight = entry.split(':')
+            weights[request_type] = float(weight)
+        request_types = random.choices(list(weights.keys()), list(weights.values()),
+                                       k=self.args.num_requests)
+        start = time.monotonic()
+        await asyncio.gather(*[self.worker(request_types)
+                               for _ in range(self.args.concurrency)])
+        return time.monotonic() - start
+
+    def print_results(self, duration):
+        """ print the latency table """
+        print('{:} requests in {:.1f} s ({:.1f} req/s), {:} concurrent clients'.format(
+            self.args.num_requests, duration, self.args.num_requests / duration,
+            self.args.concurrency))
+        print('{:<10} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+            'type', 'count', 'errors', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]'))
+        all_latencies = []
+        for request_type in sorted(self.latencies):
+            latencies = sorted(self.latencies[request_type])
+            all_latencies.extend(latencies)
+            self._print_row(request_type, latencies, self.errors.get(request_type, 0))
+        self._print_row('all', sorted(all_latencies), sum(self.errors.values()))
+
+    @staticmethod
+    def _print_row(name, latencies, num_errors):
+        """ print a table row """
+        print('{:<10} {:>6} {:>6} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f}'.format(
+            name, len(latencies), num_errors, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000,
+            latencies[-1] * 1000))
+
+
+async def main():
+    """ main method """
+    args = get_arguments()
+    random.seed(args.seed)
+    load_test = LoadTest(args)
+    await load_test.setup()
+    duration = await load_test.run()
+    load_test.print_results(duration)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
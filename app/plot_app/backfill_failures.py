@@ -0,0 +1,67 @@
+""" Logs for which the background generation of the LogsGenerated entry (or
+flight summary or stored parameters) failed, e.g. because the log file is
+broken or missing (BackfillFailures table). The table is shared by all server
+processes, so that the listings exclude the same logs. """
+
+import time
+
+from ingest_jobs import INGEST_FAILED_IDS_SQL
+
+# failed logs are not queued again during this time (the listings would
+# otherwise keep trying to parse broken or missing log files)
+RETRY_FAILED_AFTER_SEC = 60 * 60
+
+BACKFILL_FAILURES_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS BackfillFailures("
+                               "Id TEXT, " # log id
+                               "Time INT, " # unix timestamp of the last failure
+                               "Error TEXT, "
+                               "CONSTRAINT Id_PK PRIMARY KEY (Id))")
+
+BACKFILL_FAILURES_INDEX_SQL = ("CREATE INDEX IF NOT EXISTS BackfillFailures_Time "
+                               "ON BackfillFailures (Time)")
+
+# ids of the logs that failed within RETRY_FAILED_AFTER_SEC
+RECENT_BACKFILL_FAILURES_SQL = ("SELECT Id FROM BackfillFailures "
+                                "WHERE Time > CAST(strftime('%s', 'now') AS INT) - " +
+                                str(RETRY_FAILED_AFTER_SEC))
+
+# ids of the logs that are not listed (browse, dbinfo): the ingestion failed,
+# or the log has no LogsGenerated entry & generating it failed recently. There
+# are only few, so they can be selected once per query.
+UNLISTED_LOG_IDS_SQL = (INGEST_FAILED_IDS_SQL + " UNION SELECT Id FROM (" +
+                        RECENT_BACKFILL_FAILURES_SQL + ") AS Failures "
+                        "WHERE NOT EXISTS (SELECT 1 FROM LogsGenerated "
+                        "                  WHERE LogsGenerated.Id = Failures.Id)")
+
+
+def set_backfill_failure(cur, log_id, error):
+    """
+    store (or update) the failure of a log (the caller commits)
+    :param cur: DB cursor
+    :param error: error message
+    """
+    cur.execute('INSERT INTO BackfillFailures (Id, Time, Error) values (?, ?, ?) '
+                'ON CONFLICT (Id) DO UPDATE SET Time = excluded.Time, Error = excluded.Error',
+                [log_id, int(time.time()), error])
+
+
+def delete_backfill_failure(cur, log_id):
+    """
+    remove the failure of a log after it succeeded (the caller commits)
+    :param cur: DB cursor
+    """
+    cur.execute('DELETE FROM BackfillFailures WHERE Id = ?', [log_id])
+
+
+def get_backfill_failures(cur, max_failures):
+    """
+    get the number of failed logs & the most recent failures
+    :param cur: DB cursor
+    :return: tuple of (number of failed logs, list of (log id, error) tuples,
+             newest first)
+    """
+    cur.execute('SELECT count(*) FROM BackfillFailures')
+    num_failures = cur.fetchone()[0]
+    cur.execute('SELECT Id, Error FROM BackfillFailures ORDER BY Time DESC LIMIT ?',
+                [max_failures])
+    return num_failures, cur.fetchall()
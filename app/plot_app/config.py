@@ -29,9 +29,20 @@ __HTTP_PROTOCOL = _conf.get('general', 'http_protocol')
 __AIRFRAMES_URL = _conf.get('general', 'airframes_url')
 __PARAMETERS_URL = _conf.get('general', 'parameters_url')
 __EVENTS_URL = _conf.get('general', 'events_url')
+__METADATA_MIRROR_PATH = _conf.get('general', 'metadata_mirror_path')
 __MAPBOX_API_ACCESS_TOKEN = _conf.get('general', 'mapbox_api_access_token')
 __CESIUM_API_KEY = _conf.get('general', 'cesium_api_key')
 __LOG_CACHE_SIZE = int(_conf.get('general', 'log_cache_size'))
+__DB_WORKER_THREADS = int(_conf.get('general', 'db_worker_threads'))
+__RENDER_WORKER_THREADS = int(_conf.get('general', 'render_worker_threads'))
+__BACKFILL_WORKER_THREADS = int(_conf.get('general', 'backfill_worker_threads'))
+__INGEST_WORKER_PROCESSES = int(_conf.get('general', 'ingest_worker_processes'))
+__KML_WORKER_THREADS = int(_conf.get('general', 'kml_worker_threads'))
+__KML_GENERATE_AT_INGEST = _conf.get('general', 'kml_generate_at_ingest') == '1'
+__UPLOAD_DEDUPLICATION = _conf.get('general', 'upload_deduplication') == '1'
+__RESUMABLE_UPLOAD_MAX_SIZE_MB = int(_conf.get('general', 'resumable_upload_max_size_mb'))
+__RESUMABLE_UPLOAD_EXPIRY_HOURS = float(_conf.get('general', 'resumable_upload_expiry_hours'))
+__STATISTICS_CACHE_TTL_SEC = float(_conf.get('general', 'statistics_cache_ttl_sec'))
 __DB_FILENAME_CUSTOM = _conf.get('general', 'db_filename')
 
 __STORAGE_PATH = _conf.get('general', 'storage_path')
@@ -135,6 +146,10 @@ def get_parameters_url():
     """ get parameters download URL """
     return __PARAMETERS_URL
 
+def get_metadata_mirror_path():
+    """ get the directory to copy the metadata files from (empty: download them) """
+    return __METADATA_MIRROR_PATH
+
 def get_mapbox_api_access_token():
     """ get MapBox API Access Token """
     return __MAPBOX_API_ACCESS_TOKEN
@@ -147,6 +162,46 @@ def get_log_cache_size():
     """ get maximum number of cached logs in RAM """
     return __LOG_CACHE_SIZE
 
+def get_db_worker_threads():
+    """ get number of threads for DB access & file I/O of the request handlers """
+    return __DB_WORKER_THREADS
+
+def get_render_worker_threads():
+    """ get number of threads for CPU-bound page rendering of the request handlers """
+    return __RENDER_WORKER_THREADS
+
+def get_backfill_worker_threads():
+    """ get number of threads for generating missing LogsGenerated entries """
+    return __BACKFILL_WORKER_THREADS
+
+def get_ingest_worker_processes():
+    """ get number of processes for ingesting uploaded logs """
+    return __INGEST_WORKER_PROCESSES
+
+def get_kml_worker_threads():
+    """ get number of threads for generating KML files """
+    return __KML_WORKER_THREADS
+
+def get_kml_generate_at_ingest():
+    """ get whether KML files are generated when a log is ingested """
+    return __KML_GENERATE_AT_INGEST
+
+def get_upload_deduplication():
+    """ get whether uploads of existing log files return the existing log """
+    return __UPLOAD_DEDUPLICATION
+
+def get_resumable_upload_max_size_mb():
+    """ get the maximum file size of resumable uploads in MB """
+    return __RESUMABLE_UPLOAD_MAX_SIZE_MB
+
+def get_resumable_upload_expiry_hours():
+    """ get the time after which unfinished resumable uploads are deleted """
+    return __RESUMABLE_UPLOAD_EXPIRY_HOURS
+
+def get_statistics_cache_ttl_sec():
+    """ get the time in seconds for which the statistics page is cached """
+    return __STATISTICS_CACHE_TTL_SEC
+
 def debug_print_timing():
     """ print timing information? """
     return __PRINT_TIMING == 1
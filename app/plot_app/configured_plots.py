@@ -10,6 +10,7 @@ from bokeh.io import curdoc
 from bokeh.models import Div
 
 from config import *
+from flight_summary import get_log_flight_summary
 from helper import *
 from leaflet import ulog_to_polyline
 from plotting import *
@@ -91,7 +92,7 @@ def generate_plots(
     flight_mode_changes = get_flight_mode_changes(ulog)
 
     # VTOL state changes & vehicle type
-    vtol_states = None
+    vtol_states = get_vtol_states(ulog)
     is_vtol = False
     is_vtol_tailsitter = False
     try:
@@ -103,40 +104,8 @@ def generate_plots(
                 "is_vtol_tailsitter" in cur_dataset.data
                 and np.amax(cur_dataset.data["is_vtol_tailsitter"]) == 1
             )
-            # find mode after transitions (states: 1=transition, 2=FW, 3=MC)
-            if "vehicle_type" in cur_dataset.data:
-                vehicle_type_field = "vehicle_type"
-                vtol_state_mapping = {2: 2, 1: 3}
-                vehicle_type = cur_dataset.data["vehicle_type"]
-                in_transition_mode = cur_dataset.data["in_transition_mode"]
-                vtol_states = []
-                for i in range(len(vehicle_type)):
-                    # a VTOL can change state also w/o in_transition_mode set
-                    # (e.g. in Manual mode)
-                    if (
-                        i == 0
-                        or in_transition_mode[i - 1] != in_transition_mode[i]
-                        or vehicle_type[i - 1] != vehicle_type[i]
-                    ):
-                        vtol_states.append(
-                            (cur_dataset.data["timestamp"][i], in_transition_mode[i])
-                        )
-
-            else:  # COMPATIBILITY: old logs (https://github.com/PX4/Firmware/pull/11918)
-                vtol_states = cur_dataset.list_value_changes("in_transition_mode")
-                vehicle_type_field = "is_rotary_wing"
-                vtol_state_mapping = {0: 2, 1: 3}
-            for i in range(len(vtol_states)):
-                if vtol_states[i][1] == 0:
-                    t = vtol_states[i][0]
-                    idx = np.argmax(cur_dataset.data["timestamp"] >= t) + 1
-                    vtol_states[i] = (
-                        t,
-                        vtol_state_mapping[cur_dataset.data[vehicle_type_field][idx]],
-                    )
-            vtol_states.append((ulog.last_timestamp, -1))
     except (KeyError, IndexError) as error:
-        vtol_states = None
+        pass
 
     # Heading
     curdoc().template_variables["title_html"] = get_heading_html(
@@ -149,8 +118,11 @@ def generate_plots(
     )
 
     # info text on top (logging duration, max speed, ...)
+    flight_summary = get_log_flight_summary(
+        curdoc().template_variables.get("log_id", ""), ulog, vtol_states
+    )
     curdoc().template_variables["info_table_html"] = get_info_table_html(
-        ulog, px4_ulog, db_data, vehicle_data, vtol_states
+        ulog, px4_ulog, db_data, vehicle_data, flight_summary
     )
 
     curdoc().template_variables["error_labels_html"] = get_error_labels_html()
@@ -0,0 +1,112 @@
+""" Shared SQLite DB connection handling """
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import threading
+
+from config import get_db_filename, get_db_worker_threads, get_render_worker_threads
+
+# Connections are kept open and reused (one per thread, as sqlite3 connections
+# must not be shared between threads). Besides avoiding the connection setup
+# per request this keeps the compiled SQL statements cached (see
+# _STATEMENT_CACHE_SIZE), so always use constant SQL strings with parameters.
+_thread_data = threading.local()
+
+# thread pools of the (async) request handlers, so that they do not block the
+# IOLoop: 'db' for blocking DB queries & file I/O, 'render' for CPU-bound page
+# rendering (which would otherwise occupy the DB threads for seconds, and
+# only one thread runs Python code at a time anyway). Values are tuples of
+# (executor, pid).
+_executors = {}
+_executor_lock = threading.Lock()
+
+_STATEMENT_CACHE_SIZE = 256
+_BUSY_TIMEOUT_SEC = 30
+
+_PRAGMAS = [
+    # WAL: readers do not block writers and vice versa (persistent in the DB file)
+    'PRAGMA journal_mode = WAL',
+    # with WAL this is still safe against corruption, only the last commits
+    # might get lost on power loss (but not on an application crash)
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -65536', # in KiB (64 MiB per connection)
+    'PRAGMA mmap_size = 268435456', # 256 MiB
+    'PRAGMA temp_store = MEMORY',
+    ]
+
+
+def _create_db_connection():
+    """ open a new connection & apply the settings """
+    con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES,
+                          timeout=_BUSY_TIMEOUT_SEC,
+                          cached_statements=_STATEMENT_CACHE_SIZE)
+    for pragma in _PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+def get_db_connection():
+    """
+    get the DB connection for the current thread (opened on first use).
+
+    The connection is shared with other users of the same thread, so do not
+    close it, and do not leave uncommitted changes behind: either commit, or
+    use the connection as context manager (commits, or rolls back on an
+    exception).
+    :return: sqlite3.Connection
+    """
+    con = getattr(_thread_data, 'connection', None)
+    # a forked process must not reuse the connection of its parent
+    if con is None or _thread_data.pid != os.getpid():
+        con = _create_db_connection()
+        _thread_data.connection = con
+        _thread_data.pid = os.getpid()
+    return con
+
+
+def close_db_connection():
+    """ close the DB connection of the current thread (if there is one) """
+    con = getattr(_thread_data, 'connection', None)
+    if con is not None:
+        if _thread_data.pid == os.getpid():
+            con.close()
+        _thread_data.connection = None
+
+
+def _get_executor(name, max_workers):
+    """ get a thread pool (created on first use) """
+    with _executor_lock:
+        executor, pid = _executors.get(name, (None, None))
+        # threads do not survive a fork
+        if executor is None or pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix=name+'_worker')
+            _executors[name] = (executor, os.getpid())
+        return executor
+
+
+async def run_db_task(func, *args):
+    """
+    run a blocking function (DB queries, file I/O, log parsing) in the DB
+    thread pool and wait for its result without blocking the IOLoop.
+    The function runs in another thread, so it must use get_db_connection()
+    itself (instead of passing a connection or cursor) and must not access the
+    request handler.
+    :return: return value of func(*args)
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_executor('db', get_db_worker_threads()), func, *args)
+
+
+async def run_render_task(func, *args):
+    """
+    run a CPU-bound function (log parsing & page rendering) in the render
+    thread pool and wait for its result, same as run_db_task. Use this for
+    functions that take seconds, so that the DB thread pool stays available
+    for the short queries of the other requests.
+    :return: return value of func(*args)
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_executor('render', get_render_worker_threads()), func, *args)
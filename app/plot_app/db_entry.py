@@ -5,7 +5,9 @@ from html import escape
 from pyulog import *
 from pyulog.px4 import *
 
-from helper import get_log_filename, load_ulog_file
+from flight_summary import get_flight_summary
+from helper import get_log_filename, load_ulog_file, get_vtol_states
+from log_parameters import LogParameters
 
 #pylint: disable=missing-docstring, too-few-public-methods
 
@@ -72,6 +74,10 @@ class DBDataGenerated:
         self.flight_modes = set()
         self.vehicle_uuid = ''
         self.flight_mode_durations = [] # list of tuples of (mode, duration sec)
+        # LogParameters object (only set when initialized from a log)
+        self.parameters = None
+        # dict of metrics (see flight_summary.py), None if not computed
+        self.flight_summary = None
         super().__init__()
 
     def flight_mode_durations_str(self):
@@ -83,10 +89,14 @@ class DBDataGenerated:
     @classmethod
     def from_log_file(cls, log_id):
         """ initialize from a log file """
-        obj = cls()
-
         ulog_file_name = get_log_filename(log_id)
-        ulog = load_ulog_file(ulog_file_name)
+        return cls.from_ulog(load_ulog_file(ulog_file_name))
+
+    @classmethod
+    def from_ulog(cls, ulog):
+        """ initialize from a loaded log
+        :param ulog: ULog object """
+        obj = cls()
         px4_ulog = PX4ULog(ulog)
 
         # extract information
@@ -103,6 +113,8 @@ class DBDataGenerated:
         obj.num_logged_warnings = 0
         if 'sys_uuid' in ulog.msg_info_dict:
             obj.vehicle_uuid = escape(ulog.msg_info_dict['sys_uuid'])
+        obj.parameters = LogParameters.from_ulog(ulog)
+        obj.flight_summary = get_flight_summary(ulog, get_vtol_states(ulog))
 
         for m in ulog.logged_messages:
             if m.log_level <= ord('3'):
@@ -157,6 +169,7 @@ class DBDataGenerated:
         jsondict['flight_modes'] = list(self.flight_modes)
         jsondict['vehicle_uuid'] = self.vehicle_uuid
         jsondict['flight_mode_durations'] = self.flight_mode_durations
+        jsondict['flight_summary'] = self.flight_summary
         return jsondict
 
 class DBVehicleData:
@@ -1,6 +1,7 @@
 """ Event parsing """
 import json
 import lzma
+import os
 from typing import Optional, Any, List, Tuple
 
 from helper import download_file_maybe
@@ -10,6 +11,8 @@ from pyulog.px4_events import PX4Events
 
 # pylint: disable=global-statement
 __event_parser: PX4Events = None  # Keep the parser to cache the default event definitions
+# mtime of the events file used by the parser
+__events_file_mtime = None #pylint: disable=invalid-name
 
 
 def get_logged_events(ulog: ULog) -> List[Tuple[int, str, str]]:
@@ -21,15 +24,18 @@ def get_logged_events(ulog: ULog) -> List[Tuple[int, str, str]]:
     def get_default_json_definitions(already_has_default_parser: bool) -> Optional[Any]:
         """ Retrieve the default json event definitions """
 
+        global __events_file_mtime
         events_json_xz = get_events_filename()
+        if download_file_maybe(events_json_xz, get_events_url()) == 0:
+            return None
         # Check for cached file update
-        downloaded = download_file_maybe(events_json_xz, get_events_url())
-        if downloaded == 2 or (downloaded == 1 and not already_has_default_parser):
-            # Decompress
-            with lzma.open(events_json_xz, 'rt') as json_file:
-                return json.load(json_file)
-
-        return None
+        mtime = os.path.getmtime(events_json_xz)
+        if already_has_default_parser and mtime == __events_file_mtime:
+            return None
+        __events_file_mtime = mtime
+        # Decompress
+        with lzma.open(events_json_xz, 'rt') as json_file:
+            return json.load(json_file)
 
     global __event_parser
     if __event_parser is None:
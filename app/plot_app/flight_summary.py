@@ -0,0 +1,218 @@
+""" Flight summary metrics of a log (max speed, distance, ...), computed once
+when a log is ingested and stored in the LogsGenerated table, so that the info
+table of the plot page and the browse page do not need to compute them """
+
+import sqlite3
+
+import numpy as np
+
+from db_connection import get_db_connection
+from helper import get_vtol_state_per_sample
+
+# increase when the computation changes: logs with an older version are
+# recomputed (see get_log_flight_summary & the backfill)
+FLIGHT_SUMMARY_VERSION = 1
+
+# (key, LogsGenerated column) of the metrics. The values are None if the log
+# does not contain the data.
+FLIGHT_SUMMARY_COLUMNS = [
+    ('distance_m', 'Distance'),
+    ('max_altitude_diff_m', 'MaxAltitudeDiff'),
+    ('average_speed_m_s', 'AverageSpeed'), # not set for VTOLs
+    ('average_speed_mc_m_s', 'AverageSpeedMC'), # VTOLs only
+    ('average_speed_fw_m_s', 'AverageSpeedFW'), # VTOLs only
+    ('max_speed_m_s', 'MaxSpeed'),
+    ('max_speed_horizontal_m_s', 'MaxSpeedHorizontal'),
+    ('max_speed_up_m_s', 'MaxSpeedUp'),
+    ('max_speed_down_m_s', 'MaxSpeedDown'),
+    ('max_tilt_deg', 'MaxTilt'),
+    ('max_rotation_speed_deg_s', 'MaxRotationSpeed'),
+    ('average_current_a', 'AverageCurrent'), # not set for VTOLs
+    ('average_current_mc_a', 'AverageCurrentMC'), # VTOLs only
+    ('average_current_fw_a', 'AverageCurrentFW'), # VTOLs only
+    ('max_current_a', 'MaxCurrent'),
+    ]
+
+
+def _get_vtol_means_per_mode(vtol_states, timestamps, data):
+    """
+    get the mean values separated by MC and FW mode for some
+    data vector
+    :return: tuple of (mean mc, mean fw)
+    """
+    states = get_vtol_state_per_sample(vtol_states, timestamps)
+    mean_mc = None
+    if np.any(states == 3): mean_mc = np.mean(data[states == 3])
+    mean_fw = None
+    if np.any(states == 2): mean_fw = np.mean(data[states == 2])
+    return (mean_mc, mean_fw)
+
+
+def _add_position_metrics(summary, ulog, vtol_states):
+    """ distance, altitude & speed from the local position """
+    local_pos = ulog.get_dataset('vehicle_local_position')
+    pos_x = local_pos.data['x'].astype(np.float64)
+    pos_y = local_pos.data['y'].astype(np.float64)
+    pos_z = local_pos.data['z'].astype(np.float64)
+    pos_xyz_valid = np.multiply(local_pos.data['xy_valid'], local_pos.data['z_valid']) > 0
+    local_vel_valid = np.multiply(local_pos.data['v_xy_valid'], local_pos.data['v_z_valid']) > 0
+    vel_x = local_pos.data['vx'][local_vel_valid].astype(np.float64)
+    vel_y = local_pos.data['vy'][local_vel_valid].astype(np.float64)
+    vel_z = local_pos.data['vz'][local_vel_valid].astype(np.float64)
+
+    # total distance (only between consecutive valid samples)
+    consecutive_valid = np.logical_and(pos_xyz_valid[1:], pos_xyz_valid[:-1])
+    distances = np.sqrt(np.square(np.diff(pos_x)) + np.square(np.diff(pos_y)) +
+                        np.square(np.diff(pos_z)))
+    summary['distance_m'] = np.sum(distances[consecutive_valid])
+
+    if len(pos_z) > 0:
+        summary['max_altitude_diff_m'] = np.amax(pos_z) - np.amin(pos_z)
+
+    if len(vel_x) > 0:
+        speed_vector = np.sqrt(np.square(vel_x) + np.square(vel_y) + np.square(vel_z))
+        if vtol_states is None:
+            summary['average_speed_m_s'] = np.mean(speed_vector)
+        else:
+            local_pos_timestamp = local_pos.data['timestamp'][local_vel_valid]
+            summary['average_speed_mc_m_s'], summary['average_speed_fw_m_s'] = \
+                _get_vtol_means_per_mode(vtol_states, local_pos_timestamp, speed_vector)
+        summary['max_speed_m_s'] = np.amax(speed_vector)
+        summary['max_speed_horizontal_m_s'] = np.amax(
+            np.sqrt(np.square(vel_x) + np.square(vel_y)))
+        summary['max_speed_up_m_s'] = np.amax(-vel_z)
+        summary['max_speed_down_m_s'] = np.amax(vel_z)
+
+
+def _add_attitude_metrics(summary, ulog):
+    """ tilt & rotation speed from the attitude """
+    vehicle_attitude = ulog.get_dataset('vehicle_attitude')
+    if len(vehicle_attitude.data['timestamp']) == 0:
+        return
+    # tilt = angle between [0,0,1] and [0,0,1] rotated by the attitude (the
+    # z component of the rotated vector is cos(roll)*cos(pitch))
+    q_x = vehicle_attitude.data['q[1]'].astype(np.float64)
+    q_y = vehicle_attitude.data['q[2]'].astype(np.float64)
+    cos_tilt = np.clip(1 - 2 * (np.square(q_x) + np.square(q_y)), -1, 1)
+    summary['max_tilt_deg'] = np.amax(np.arccos(cos_tilt)) * 180 / np.pi
+
+    rollspeed = vehicle_attitude.data['rollspeed']
+    pitchspeed = vehicle_attitude.data['pitchspeed']
+    yawspeed = vehicle_attitude.data['yawspeed']
+    summary['max_rotation_speed_deg_s'] = np.amax(np.sqrt(
+        np.square(rollspeed) + np.square(pitchspeed) + np.square(yawspeed))) * 180 / np.pi
+
+
+def _add_battery_metrics(summary, ulog, vtol_states):
+    """ current from the battery status """
+    battery_status = ulog.get_dataset('battery_status')
+    battery_current = battery_status.data['current_a']
+    if len(battery_current) == 0:
+        return
+    summary['max_current_a'] = np.amax(battery_current)
+    if vtol_states is None:
+        summary['average_current_a'] = np.mean(battery_current)
+    else:
+        summary['average_current_mc_a'], summary['average_current_fw_a'] = \
+            _get_vtol_means_per_mode(vtol_states, battery_status.data['timestamp'],
+                                     battery_current)
+
+
+def get_flight_summary(ulog, vtol_states):
+    """
+    compute the flight summary metrics of a log
+    :param ulog: ULog object
+    :param vtol_states: VTOL state changes (see helper.get_vtol_states) or None
+    :return: dict with the keys of FLIGHT_SUMMARY_COLUMNS (SI units, degrees)
+    """
+    summary = {key: None for key, _ in FLIGHT_SUMMARY_COLUMNS}
+    for add_metrics, args in [(_add_position_metrics, (vtol_states,)),
+                              (_add_attitude_metrics, ()),
+                              (_add_battery_metrics, (vtol_states,))]:
+        try:
+            add_metrics(summary, ulog, *args)
+        except (KeyError, IndexError, ValueError):
+            pass # ignore (e.g. if topic not found)
+    # numpy types cannot be stored in the DB
+    for key, value in summary.items():
+        if value is not None:
+            summary[key] = float(value)
+    return summary
+
+
+def get_flight_summary_from_tuple(db_tuple):
+    """
+    get the flight summary from LogsGenerated columns
+    :param db_tuple: SummaryVersion followed by the FLIGHT_SUMMARY_COLUMNS
+    :return: dict (see get_flight_summary), or None if not computed (or
+             computed by an older version)
+    """
+    if db_tuple[0] != FLIGHT_SUMMARY_VERSION:
+        return None
+    return {key: value for (key, _), value in zip(FLIGHT_SUMMARY_COLUMNS, db_tuple[1:])}
+
+
+def write_flight_summary(cur, log_id, summary):
+    """
+    store the flight summary in the LogsGenerated entry of a log (the caller
+    commits)
+    :param cur: DB cursor
+    :param summary: dict (see get_flight_summary)
+    """
+    cur.execute('UPDATE LogsGenerated SET SummaryVersion = ?, ' +
+                ', '.join(column+' = ?' for _, column in FLIGHT_SUMMARY_COLUMNS) +
+                ' WHERE Id = ?',
+                [FLIGHT_SUMMARY_VERSION] + [summary[key] for key, _ in FLIGHT_SUMMARY_COLUMNS] +
+                [log_id])
+
+
+def read_flight_summary(cur, log_id):
+    """
+    get the stored flight summary of a log
+    :param cur: DB cursor
+    :return: dict (see get_flight_summary), or None if not stored
+    """
+    cur.execute('SELECT SummaryVersion, ' +
+                ', '.join(column for _, column in FLIGHT_SUMMARY_COLUMNS) +
+                ' FROM LogsGenerated WHERE Id = ?', [log_id])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    return get_flight_summary_from_tuple(db_tuple)
+
+
+def get_log_flight_summary(log_id, ulog, vtol_states):
+    """
+    get the flight summary of a log from the DB. If it is not stored (logs
+    that were added before), it's computed and stored. Blocking (DB access).
+    :param log_id: log id, or '' for a log that is not in the DB
+    :return: dict (see get_flight_summary)
+    """
+    if log_id != '':
+        try:
+            con = get_db_connection()
+            cur = con.cursor()
+            try:
+                summary = read_flight_summary(cur, log_id)
+                if summary is None:
+                    summary = get_flight_summary(ulog, vtol_states)
+                    with con: # commits, or rolls back on error
+                        write_flight_summary(cur, log_id, summary)
+                return summary
+            finally:
+                cur.close()
+        except sqlite3.Error as error:
+            print("DB access failed:", error)
+    return get_flight_summary(ulog, vtol_states)
+
+
+def format_distance(distance_m):
+    """ distance as string (m or km) """
+    if distance_m > 1000:
+        return "{:.2f} km".format(distance_m/1000)
+    return "{:.1f} m".format(distance_m)
+
+
+def format_speed(speed_m_s):
+    """ speed as string (km/h) """
+    return "{:.1f} km/h".format(speed_m_s*3.6)
@@ -6,7 +6,9 @@ import re
 import os
 import traceback
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+import threading
 from urllib.request import urlretrieve
 import xml.etree.ElementTree # airframe parsing
 import shutil
@@ -20,7 +22,8 @@ from config_tables import *
 from config import get_log_filepath, get_airframes_filename, get_airframes_url, \
                    get_parameters_filename, get_parameters_url, \
                    get_log_cache_size, debug_print_timing, \
-                   get_releases_filename
+                   get_releases_filename, get_events_filename, get_events_url, \
+                   get_metadata_mirror_path
 
 from Crypto.Cipher import ChaCha20
 from Crypto.PublicKey import RSA
@@ -77,72 +80,189 @@ def get_log_filename(log_id):
     return os.path.join(get_log_filepath(), log_id + '.ulg')
 
 
-__last_failed_downloads = {} # dict with key=file name and a timestamp of last failed download
+# metadata files are downloaded again if they are older than this
+METADATA_MAX_AGE_SEC = 24 * 3600
+# don't try to download too often
+METADATA_RETRY_SEC = 10 * 60
+
+__RELEASES_URL = 'https://api.github.com/repos/PX4/Firmware/releases'
+
+__metadata_lock = threading.Lock()
+__metadata_executor = {'executor': None, 'pid': None}
+__metadata_status = {} # dict with key=file name and a dict of the refresh status
+__metadata_callbacks = [] # functions called with the file name after a refresh
+
+def __get_metadata_executor():
+    """ get the thread for the metadata downloads (created on first use, and
+        again after a fork). Call with __metadata_lock held """
+    if __metadata_executor['executor'] is None or __metadata_executor['pid'] != os.getpid():
+        __metadata_executor['executor'] = ThreadPoolExecutor(max_workers=1,
+                                                             thread_name_prefix='metadata')
+        __metadata_executor['pid'] = os.getpid()
+    return __metadata_executor['executor']
+
+def __refresh_file(filename, url):
+    """ download an url to filename, or copy it from the mirror directory
+        (runs in the metadata thread) """
+    mirror_path = get_metadata_mirror_path()
+    # download to a temporary random file, then move to avoid race conditions
+    temp_file_name = filename+'.'+str(uuid.uuid4())
+    error = None
+    try:
+        if mirror_path != '':
+            mirror_file_name = os.path.join(mirror_path, os.path.basename(filename))
+            print("Copying "+mirror_file_name)
+            shutil.copyfile(mirror_file_name, temp_file_name)
+        else:
+            print("Downloading "+url)
+            urlretrieve(url, temp_file_name)
+        shutil.move(temp_file_name, filename)
+    except Exception as e:
+        print("Download error: "+str(e))
+        error = str(e)
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+    with __metadata_lock:
+        status = __metadata_status[filename]
+        status['refreshing'] = False
+        status['last_error'] = error
+        if error is None:
+            status['last_refresh'] = time.time()
+        callbacks = list(__metadata_callbacks)
+    if error is None:
+        for callback in callbacks:
+            try:
+                callback(filename)
+            except Exception as e:
+                print("Metadata refresh callback failed: "+str(e))
+
+def add_metadata_refresh_callback(callback):
+    """ register a function that is called with the file name after a metadata
+        file was refreshed (in the metadata thread) """
+    with __metadata_lock:
+        __metadata_callbacks.append(callback)
+
+def __schedule_refresh(filename, url, force=False):
+    """ start a background download of a file, unless it's already running or
+        failed recently """
+    with __metadata_lock:
+        status = __metadata_status.setdefault(filename, {
+            'url': url, 'refreshing': False, 'last_attempt': 0,
+            'last_refresh': None, 'last_error': None})
+        if status['refreshing']:
+            return
+        if not force and status['last_error'] is not None and \
+                time.time() < status['last_attempt'] + METADATA_RETRY_SEC:
+            return
+        status['refreshing'] = True
+        status['last_attempt'] = time.time()
+        __get_metadata_executor().submit(__refresh_file, filename, url)
 
 def download_file_maybe(filename, url):
-    """ download an url to filename if it does not exist or it's older than a day.
-        returns 0: on problem, 1: file usable, 2: file usable and was downloaded
+    """ make sure a file downloaded from an url is available: if it does not
+        exist or it's older than a day, it's downloaded in the background (or
+        copied from the metadata mirror directory). Never blocks: until the
+        download is finished the old file is used.
+        returns 0: file not available (yet), 1: file usable
     """
-    need_download = False
-    if os.path.exists(filename):
+    try:
         elapsed_sec = time.time() - os.path.getmtime(filename)
-        if elapsed_sec / 3600 > 24:
-            need_download = True
-            os.unlink(filename)
-    else:
-        need_download = True
-    if need_download:
-        if filename in __last_failed_downloads:
-            if time.time() < __last_failed_downloads[filename] + 30:
-                # don't try to download too often
-                return 0
-        print("Downloading "+url)
-        try:
-            # download to a temporary random file, then move to avoid race
-            # conditions
-            temp_file_name = filename+'.'+str(uuid.uuid4())
-            urlretrieve(url, temp_file_name)
-            shutil.move(temp_file_name, filename)
-        except Exception as e:
-            print("Download error: "+str(e))
-            __last_failed_downloads[filename] = time.time()
-            return 0
-        return 2
+    except OSError:
+        __schedule_refresh(filename, url)
+        return 0
+    if elapsed_sec > METADATA_MAX_AGE_SEC:
+        __schedule_refresh(filename, url)
     return 1
 
+def __get_metadata_files():
+    """ get a list of (file name, url) of all downloaded metadata files """
+    return [(get_airframes_filename(), get_airframes_url()),
+            (get_parameters_filename(), get_parameters_url()),
+            (get_events_filename(), get_events_url()),
+            (get_releases_filename(), __RELEASES_URL)]
+
+def refresh_metadata_files(force=False):
+    """ download all metadata files in the background that are missing or
+        outdated (or all of them if force is set) """
+    for filename, url in __get_metadata_files():
+        if force:
+            __schedule_refresh(filename, url, force=True)
+        else:
+            download_file_maybe(filename, url)
 
-@lru_cache(maxsize=128)
-def __get_airframe_data(airframe_id):
-    """ cached version of get_airframe_data()
-    """
-    airframe_xml = get_airframes_filename()
-    if download_file_maybe(airframe_xml, get_airframes_url()) > 0:
-        try:
-            e = xml.etree.ElementTree.parse(airframe_xml).getroot()
-            for airframe_group in e.findall('airframe_group'):
-                for airframe in airframe_group.findall('airframe'):
-                    if str(airframe_id) == airframe.get('id'):
-                        ret = {'name': airframe.get('name')}
-                        try:
-                            ret['type'] = airframe.find('type').text
-                        except:
-                            pass
-                        return ret
-        except:
-            pass
-    return None
+def get_metadata_files_status():
+    """ get the refresh status of the metadata files
+        :return: list of dicts
+    """
+    ret = []
+    for filename, url in __get_metadata_files():
+        with __metadata_lock:
+            status = dict(__metadata_status.get(filename, {}))
+        age_sec = None
+        if os.path.exists(filename):
+            age_sec = int(time.time() - os.path.getmtime(filename))
+        ret.append({
+            'file': os.path.basename(filename),
+            'url': url,
+            'source': get_metadata_mirror_path() or 'url',
+            'age_sec': age_sec,
+            'refreshing': status.get('refreshing', False),
+            'last_refresh': status.get('last_refresh'),
+            'last_error': status.get('last_error'),
+            })
+    return ret
+
+
+__file_indexes = {} # dict with key=file name and a tuple of (mtime, parsed content)
+
+def __get_file_index(filename, url, parse_method):
+    """ get the parsed content of a downloaded file (via parse_method(filename)).
+        The file is only parsed again when it changed on disk.
+        returns None if the file is not available
+    """
+    if download_file_maybe(filename, url) == 0:
+        return None
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return None
+    file_index = __file_indexes.get(filename)
+    if file_index is None or file_index[0] != mtime:
+        file_index = (mtime, parse_method(filename))
+        __file_indexes[filename] = file_index
+    return file_index[1]
+
+def __parse_airframes(airframe_xml):
+    """ parse the airframes xml file into a dict with key=autostart id (str) and
+        a dict of airframe data ('name' & optionally 'type')
+    """
+    airframes = {}
+    try:
+        e = xml.etree.ElementTree.parse(airframe_xml).getroot()
+        for airframe_group in e.findall('airframe_group'):
+            for airframe in airframe_group.findall('airframe'):
+                airframe_id = airframe.get('id')
+                if airframe_id in airframes:
+                    continue # use the first one
+                ret = {'name': airframe.get('name')}
+                airframe_type = airframe.find('type')
+                if airframe_type is not None:
+                    ret['type'] = airframe_type.text
+                airframes[airframe_id] = ret
+    except:
+        pass
+    return airframes
 
-__last_airframe_cache_clear_timestamp = 0
 def get_airframe_data(airframe_id):
     """ return a dict of aiframe data ('name' & 'type') from an autostart id.
     Downloads aiframes if necessary. Returns None on error
+    (the dict is shared, do not modify it)
     """
-    global __last_airframe_cache_clear_timestamp
-    current_time = time.time()
-    if current_time > __last_airframe_cache_clear_timestamp + 3600:
-        __last_airframe_cache_clear_timestamp = current_time
-        __get_airframe_data.cache_clear()
-    return __get_airframe_data(airframe_id)
+    airframes = __get_file_index(get_airframes_filename(), get_airframes_url(),
+                                 __parse_airframes)
+    if airframes is None:
+        return None
+    return airframes.get(str(airframe_id))
 
 def get_sw_releases():
     """ return a JSON object of public releases.
@@ -150,59 +270,44 @@ def get_sw_releases():
     """
 
     releases_json = get_releases_filename()
-    if download_file_maybe(releases_json, 'https://api.github.com/repos/PX4/Firmware/releases') > 0:
+    if download_file_maybe(releases_json, __RELEASES_URL) > 0:
         with open(releases_json, encoding='utf-8') as data_file:
             return json.load(data_file)
     return None
 
+def __parse_parameters(parameters_xml):
+    """ parse the parameters xml file (see get_default_parameters()) """
+    param_dict = {}
+    try:
+        e = xml.etree.ElementTree.parse(parameters_xml).getroot()
+        for group in e.findall('group'):
+            group_name = group.get('name')
+            for param in group.findall('parameter'):
+                cur_param_dict = {
+                    'default': param.get('default'),
+                    'type': param.get('type'),
+                    'group_name': group_name,
+                    }
+                for key in ['min', 'max', 'short_desc', 'long_desc', 'decimal']:
+                    element = param.find(key)
+                    if element is not None:
+                        cur_param_dict[key] = element.text
+                param_dict[param.get('name')] = cur_param_dict
+    except:
+        pass
+    return param_dict
+
 def get_default_parameters():
     """ get the default parameters
 
         :return: dict with params (key is param name, value is a dict with
-                 'default', 'min', 'max', ...)
+                 'default', 'min', 'max', ...). The dict is shared, do not
+                 modify it.
     """
-    parameters_xml = get_parameters_filename()
-    param_dict = {}
-    if download_file_maybe(parameters_xml, get_parameters_url()) > 0:
-        try:
-            e = xml.etree.ElementTree.parse(parameters_xml).getroot()
-            for group in e.findall('group'):
-                group_name = group.get('name')
-                try:
-                    for param in group.findall('parameter'):
-                        param_name = param.get('name')
-                        param_type = param.get('type')
-                        param_default = param.get('default')
-                        cur_param_dict = {
-                            'default': param_default,
-                            'type': param_type,
-                            'group_name': group_name,
-                            }
-                        try:
-                            cur_param_dict['min'] = param.find('min').text
-                        except:
-                            pass
-                        try:
-                            cur_param_dict['max'] = param.find('max').text
-                        except:
-                            pass
-                        try:
-                            cur_param_dict['short_desc'] = param.find('short_desc').text
-                        except:
-                            pass
-                        try:
-                            cur_param_dict['long_desc'] = param.find('long_desc').text
-                        except:
-                            pass
-                        try:
-                            cur_param_dict['decimal'] = param.find('decimal').text
-                        except:
-                            pass
-                        param_dict[param_name] = cur_param_dict
-                except:
-                    pass
-        except:
-            pass
+    param_dict = __get_file_index(get_parameters_filename(), get_parameters_url(),
+                                  __parse_parameters)
+    if param_dict is None:
+        return {}
     return param_dict
 
 def WGS84_to_mercator(lon, lat):
@@ -317,7 +422,7 @@ def load_ulog_file(file_name):
                   'ekf2_timestamps', 'manual_control_switches', 'event',
                   'vehicle_imu_status', 'actuator_motors', 'actuator_servos',
                   'vehicle_thrust_setpoint', 'vehicle_torque_setpoint',
-                  'failsafe_flags', 'esc_status']
+                  'failsafe_flags', 'esc_status', 'camera_capture']
     try:
         ulog = ULog(file_name, msg_filter, disable_str_exceptions=True)
     except FileNotFoundError:
@@ -498,6 +603,61 @@ def get_flight_mode_changes(ulog):
         flight_mode_changes = []
     return flight_mode_changes
 
+def get_vtol_states(ulog):
+    """
+    get the VTOL state changes
+    :return: list of (timestamp, int state) tuples (states: 1=transition,
+    2=FW, 3=MC), the last is the last log timestamp and state = -1. None if
+    the vehicle is not a VTOL.
+    """
+    try:
+        cur_dataset = ulog.get_dataset('vehicle_status')
+        if np.amax(cur_dataset.data['is_vtol']) != 1:
+            return None
+        # find mode after transitions (states: 1=transition, 2=FW, 3=MC)
+        if 'vehicle_type' in cur_dataset.data:
+            vehicle_type_field = 'vehicle_type'
+            vtol_state_mapping = {2: 2, 1: 3}
+            vehicle_type = cur_dataset.data['vehicle_type']
+            in_transition_mode = cur_dataset.data['in_transition_mode']
+            vtol_states = []
+            for i in range(len(vehicle_type)): #pylint: disable=consider-using-enumerate
+                # a VTOL can change state also w/o in_transition_mode set
+                # (e.g. in Manual mode)
+                if i == 0 or in_transition_mode[i-1] != in_transition_mode[i] or \
+                        vehicle_type[i-1] != vehicle_type[i]:
+                    vtol_states.append((cur_dataset.data['timestamp'][i],
+                                        in_transition_mode[i]))
+
+        else: # COMPATIBILITY: old logs (https://github.com/PX4/Firmware/pull/11918)
+            vtol_states = cur_dataset.list_value_changes('in_transition_mode')
+            vehicle_type_field = 'is_rotary_wing'
+            vtol_state_mapping = {0: 2, 1: 3}
+        for i in range(len(vtol_states)): #pylint: disable=consider-using-enumerate
+            if vtol_states[i][1] == 0:
+                t = vtol_states[i][0]
+                idx = np.argmax(cur_dataset.data['timestamp'] >= t) + 1
+                vtol_states[i] = (t, vtol_state_mapping[cur_dataset.data[vehicle_type_field][idx]])
+        vtol_states.append((ulog.last_timestamp, -1))
+    except (KeyError, IndexError) as error:
+        vtol_states = None
+    return vtol_states
+
+def get_vtol_state_per_sample(vtol_states, timestamps, side='left'):
+    """
+    get the VTOL state of each sample of a topic: the state of the last change
+    before the sample
+    :param vtol_states: list of (timestamp, state) tuples (see get_vtol_states)
+    :param timestamps: numpy array of the sample timestamps
+    :param side: state of a sample at the time of a change: 'left' for the
+    state before the change, 'right' for the new state
+    :return: numpy array of states (same length as timestamps), -1 before the
+    first change
+    """
+    change_times = np.array([int(vtol_state[0]) for vtol_state in vtol_states], dtype=np.int64)
+    states = np.array([-1] + [int(vtol_state[1]) for vtol_state in vtol_states])
+    return states[np.searchsorted(change_times, timestamps.astype(np.int64), side=side)]
+
 def print_cache_info():
     """ print information about the ulog cache """
     print(load_ulog_file.cache_info())
@@ -517,8 +677,24 @@ def validate_error_ids(err_ids):
 
     return True
 
-def decrypt_ulge_payload(payload: bytes, private_key_path: str) -> bytes:
-    """Decrypt an uploaded .ulge file payload and return decrypted .ulg bytes."""
+# .ulge files are decrypted in chunks of this size
+ULGE_CHUNK_SIZE = 1024 * 1024
+
+@lru_cache(maxsize=4)
+def _load_ulge_private_key(private_key_path: str, mtime: float):
+    """ import the RSA key (cached, it's expensive). The modification time is
+    part of the cache key, so that a replaced key file is loaded again. """
+    with open(private_key_path, 'rb') as f:
+        return RSA.import_key(f.read())
+
+def decrypt_ulge_chunks(encrypted_file, private_key_path: str):
+    """
+    Decrypt an uploaded .ulge file in chunks: the ULogEnc header is read and
+    the ChaCha20 key is unwrapped with the RSA key, then the data is decrypted
+    chunk by chunk.
+    :param encrypted_file: file object of the .ulge file (opened in binary mode)
+    :return: generator of decrypted .ulg data chunks
+    """
 
     if not os.path.exists(private_key_path):
         raise FileNotFoundError(f"Private key not found at {private_key_path}")
@@ -526,27 +702,31 @@ def decrypt_ulge_payload(payload: bytes, private_key_path: str) -> bytes:
     magic = b"ULogEnc"
     header_size = 22
 
-    if payload[:7] != magic:
+    header = encrypted_file.read(header_size)
+    if len(header) != header_size or header[:7] != magic:
         raise ValueError("Invalid header magic")
-    if payload[7] != 1:
+    if header[7] != 1:
         raise ValueError("Unsupported header version")
-    if payload[16] != 4:
+    if header[16] != 4:
         raise ValueError("Unsupported key algorithm")
 
-    key_size = payload[19] << 8 | payload[18]
-    nonce_size = payload[21] << 8 | payload[20]
+    key_size = header[19] << 8 | header[18]
+    nonce_size = header[21] << 8 | header[20]
 
-    cipher_text = payload[header_size:header_size + key_size]
-    nonce = payload[header_size + key_size:header_size + key_size + nonce_size]
-    encrypted_data = payload[header_size + key_size + nonce_size:]
+    cipher_text = encrypted_file.read(key_size)
+    nonce = encrypted_file.read(nonce_size)
 
-    with open(private_key_path, 'rb') as f:
-        rsa_key = RSA.import_key(f.read())
-        cipher_rsa = PKCS1_OAEP.new(rsa_key, SHA256)
-        try:
-            sym_key = cipher_rsa.decrypt(cipher_text)
-        except ValueError as e:
-            raise ValueError("Decryption failed: possibly incorrect private key or corrupt file.") from e
+    rsa_key = _load_ulge_private_key(private_key_path, os.path.getmtime(private_key_path))
+    cipher_rsa = PKCS1_OAEP.new(rsa_key, SHA256)
+    try:
+        sym_key = cipher_rsa.decrypt(cipher_text)
+    except ValueError as e:
+        raise ValueError("Decryption failed: possibly incorrect private key or corrupt file.") from e
 
     cipher = ChaCha20.new(key=sym_key, nonce=nonce)
-    return cipher.decrypt(encrypted_data)
+    while True:
+        encrypted_data = encrypted_file.read(ULGE_CHUNK_SIZE)
+        if len(encrypted_data) == 0:
+            break
+        # the key stream continues over the calls
+        yield cipher.decrypt(encrypted_data)
@@ -0,0 +1,174 @@
+""" Persistent queue of the uploaded logs that still need to be ingested
+(IngestJobs table). The upload handlers store the file, insert the Logs entry
+and the job in the same transaction, and the job does the expensive part
+(parsing the log) in the background. """
+
+import datetime
+import json
+
+INGEST_QUEUED = 'queued'
+INGEST_RUNNING = 'running'
+INGEST_DONE = 'done'
+INGEST_FAILED = 'failed'
+
+INGEST_JOBS_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS IngestJobs("
+                         "Id TEXT, " # log id
+                         "State TEXT, " # one of the INGEST_* constants
+                         "Options TEXT, " # JSON dict, see add_ingest_job
+                         "Created TIMESTAMP, "
+                         "Updated TIMESTAMP, " # last state change
+                         "Error TEXT, " # error message if failed
+                         "Worker TEXT DEFAULT '', " # process pool that claimed the job
+                         "Crashes INT DEFAULT 0, " # how often the worker process died
+                         "CONSTRAINT Id_PK PRIMARY KEY (Id))")
+
+# ids of the logs whose ingestion failed (e.g. the file is corrupt). They are
+# not listed (browse, dbinfo) nor backfilled.
+INGEST_FAILED_IDS_SQL = "SELECT Id FROM IngestJobs WHERE State = '" + INGEST_FAILED + "'"
+
+# a job fails after its worker process died this many times while running it
+MAX_INGEST_CRASHES = 3
+
+INGEST_JOBS_INDEX_SQL = "CREATE INDEX IF NOT EXISTS IngestJobs_State ON IngestJobs (State)"
+
+# files ingested by ingest_logs.py, to resume an interrupted run & skip
+# duplicate files
+INGEST_MANIFEST_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS IngestManifest("
+                             "Path TEXT, " # absolute path of the source file
+                             "Size INT, "
+                             "MTime REAL, " # modification time (os.stat)
+                             "Sha256 TEXT, " # hex digest of the file content
+                             "LogId TEXT, " # NULL if the ingestion failed
+                             "Error TEXT, "
+                             "Date TIMESTAMP, " # when it was ingested
+                             "CONSTRAINT Path_PK PRIMARY KEY (Path))")
+
+INGEST_MANIFEST_INDEX_SQL = ("CREATE INDEX IF NOT EXISTS IngestManifest_Sha256 "
+                             "ON IngestManifest (Sha256)")
+
+
+def add_ingest_job(cur, log_id, options):
+    """
+    queue a log for ingestion. Call this after inserting the Logs entry, in
+    the same transaction (the caller commits).
+    :param cur: DB cursor
+    :param options: dict with the upload options that are not stored in the
+                    Logs table: 'vehicle_name' (new vehicle name or ''),
+                    'email' (for the notification email, '' for none),
+                    'notify' (whether to send the notification emails).
+                    Optionally (if the upload handler parsed the log header):
+                    'vehicle_updated' (True if the Vehicle entry is written)
+                    and 'ulog_info' (the log information for the emails)
+    """
+    now = datetime.datetime.now()
+    cur.execute('INSERT INTO IngestJobs (Id, State, Options, Created, Updated, Error) '
+                'values (?, ?, ?, ?, ?, ?)',
+                [log_id, INGEST_QUEUED, json.dumps(options), now, now, ''])
+
+
+def claim_ingest_job(cur, log_id, worker=''):
+    """
+    mark a queued job as running (the caller commits). Several processes might
+    try to run the same job, only one of them gets it.
+    :param cur: DB cursor
+    :param worker: name of the process pool that runs the job (see
+                   requeue_crashed_ingest_job)
+    :return: the options dict of the job, or None if it is not queued
+    """
+    cur.execute('UPDATE IngestJobs SET State = ?, Updated = ?, Worker = ? '
+                'WHERE Id = ? AND State = ?',
+                [INGEST_RUNNING, datetime.datetime.now(), worker, log_id, INGEST_QUEUED])
+    if cur.rowcount != 1:
+        return None
+    cur.execute('SELECT Options FROM IngestJobs WHERE Id = ?', [log_id])
+    return json.loads(cur.fetchone()[0])
+
+
+def set_ingest_job_state(cur, log_id, state, error=''):
+    """
+    update the state of a job (the caller commits)
+    :param cur: DB cursor
+    """
+    cur.execute('UPDATE IngestJobs SET State = ?, Updated = ?, Error = ? WHERE Id = ?',
+                [state, datetime.datetime.now(), error, log_id])
+
+
+def get_queued_ingest_jobs(cur):
+    """
+    get the queued jobs, oldest first
+    :param cur: DB cursor
+    :return: list of log ids
+    """
+    cur.execute('SELECT Id FROM IngestJobs WHERE State = ? ORDER BY Created', [INGEST_QUEUED])
+    return [db_tuple[0] for db_tuple in cur.fetchall()]
+
+
+def is_ingest_job_pending(cur, log_id):
+    """
+    check whether a log is queued or being ingested
+    :param cur: DB cursor
+    """
+    cur.execute('SELECT State FROM IngestJobs WHERE Id = ?', [log_id])
+    db_tuple = cur.fetchone()
+    return db_tuple is not None and db_tuple[0] in (INGEST_QUEUED, INGEST_RUNNING)
+
+
+def requeue_interrupted_ingest_jobs(cur):
+    """
+    queue the jobs again that were running when the server stopped. Only call
+    this on startup, when no job can be running (the caller commits).
+    :param cur: DB cursor
+    :return: number of requeued jobs
+    """
+    cur.execute('UPDATE IngestJobs SET State = ?, Updated = ? WHERE State = ?',
+                [INGEST_QUEUED, datetime.datetime.now(), INGEST_RUNNING])
+    return cur.rowcount
+
+
+def requeue_crashed_ingest_job(cur, log_id, worker):
+    """
+    queue a job again after a process of the pool that runs it died (e.g. out
+    of memory), or mark it as failed if this happened MAX_INGEST_CRASHES times
+    already (the caller commits).
+    :param cur: DB cursor
+    :param worker: name of the process pool (see claim_ingest_job)
+    :return: the new state of the job, or None if it is not running in that pool
+    """
+    cur.execute('SELECT Crashes FROM IngestJobs WHERE Id = ? AND State = ? AND Worker = ?',
+                [log_id, INGEST_RUNNING, worker])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    num_crashes = (db_tuple[0] or 0) + 1
+    if num_crashes >= MAX_INGEST_CRASHES:
+        state = INGEST_FAILED
+        error = 'The ingestion process died {} times'.format(num_crashes)
+    else:
+        state = INGEST_QUEUED
+        error = ''
+    cur.execute('UPDATE IngestJobs SET State = ?, Updated = ?, Error = ?, Crashes = ? '
+                'WHERE Id = ?', [state, datetime.datetime.now(), error, num_crashes, log_id])
+    return state
+
+
+def get_ingest_job_status(cur, log_id):
+    """
+    get the ingestion state of a log. Logs that were added before the queue
+    existed are reported as done.
+    :param cur: DB cursor
+    :return: dict, or None if there is no such log
+    """
+    cur.execute('SELECT IngestJobs.State, IngestJobs.Created, IngestJobs.Updated, '
+                '   IngestJobs.Error, Logs.Id FROM Logs '
+                '   LEFT JOIN IngestJobs on Logs.Id=IngestJobs.Id '
+                'WHERE Logs.Id = ?', [log_id])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    if db_tuple[0] is None:
+        return {'log_id': log_id, 'state': INGEST_DONE}
+    status = {'log_id': log_id, 'state': db_tuple[0],
+              'created': db_tuple[1].isoformat(), 'updated': db_tuple[2].isoformat()}
+    if db_tuple[0] == INGEST_FAILED:
+        status['error'] = db_tuple[3]
+    return status
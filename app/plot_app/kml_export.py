@@ -0,0 +1,196 @@
+""" Export of the GPS track of a log as KML file (colored by flight mode), from
+the cached ULog object, and a background thread pool that generates the KML
+files on request """
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+import simplekml
+
+from config import get_kml_filepath, get_kml_worker_threads
+from helper import get_log_filename, load_ulog_file, flight_modes_table
+
+KML_POSITION_TOPIC = 'vehicle_global_position'
+KML_CAMERA_TRIGGER_TOPIC = 'camera_capture'
+# minimum time between two points of the track
+KML_MINIMUM_INTERVAL_S = 0.1
+KML_LINE_WIDTH = 2
+
+# logs that failed (e.g. no position data) are not generated again during this
+# time, and the failure is reported to the requests
+RETRY_FAILED_AFTER_SEC = 60 * 60
+
+# The queue is per server process. Different processes might generate the same
+# file, the second one replaces the first.
+_lock = threading.Lock()
+_executor = None #pylint: disable=invalid-name
+_queued = set() # queued or running log ids
+_failed = {} # log id -> (timestamp, error message)
+
+
+def get_kml_filename(log_id):
+    """ get the file name of the (cached) KML file of a log """
+    return os.path.join(get_kml_filepath(), log_id.replace('/', '.')+'.kml')
+
+
+def kml_colors(flight_mode):
+    """ flight mode colors for KML file """
+    if flight_mode not in flight_modes_table: flight_mode = 0
+
+    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
+
+    # increase brightness to match colors with template
+    rgb = [min(int(color_str[2*x:2*x+2], 16) + 40, 255) for x in range(3)]
+    color_str = "".join(map(lambda x: format(x, '02x'), rgb))
+
+    return 'ff'+color_str[4:6]+color_str[2:4]+color_str[0:2] # KML uses aabbggrr
+
+
+def _get_dataset(ulog, topic_name):
+    """ get the first instance of a topic, or None """
+    for dataset in ulog.data_list:
+        if dataset.name == topic_name and dataset.multi_id == 0:
+            return dataset
+    return None
+
+
+def _get_position_arrays(dataset):
+    """ get the position of a dataset in degrees & meters
+    :return: tuple of (lon, lat, alt) arrays """
+    # 'longitude_deg' is used in newer PX4 versions
+    data = dataset.data
+    lon = data['lon'] if 'lon' in data else data['longitude_deg']
+    lat = data['lat'] if 'lat' in data else data['latitude_deg']
+    alt = data['alt'] if 'alt' in data else data['altitude_msl_m']
+    # scale if it's an integer type
+    if lon.dtype == np.int32:
+        return lon / 1e7, lat / 1e7, alt / 1e3
+    return lon, lat, alt
+
+
+def _get_track_indices(timestamps):
+    """ get the indices of the points of the track: a point is used if it's
+    more than the minimum interval after the previously used one """
+    minimum_interval = KML_MINIMUM_INTERVAL_S * 1e6
+    indices = []
+    last_t = 0
+    for i, cur_t in enumerate(timestamps.tolist()):
+        if cur_t - last_t > minimum_interval:
+            indices.append(i)
+            last_t = cur_t
+    return np.array(indices, dtype=np.int64)
+
+
+def _add_track(kml, ulog, dataset):
+    """ add the track as one line string per flight mode segment """
+    lon, lat, alt = _get_position_arrays(dataset)
+    timestamps = dataset.data['timestamp']
+    if 'fix_type' in dataset.data:
+        fix = dataset.data['fix_type'] > 2 # use only data with a fix
+        lon, lat, alt, timestamps = lon[fix], lat[fix], alt[fix], timestamps[fix]
+    indices = _get_track_indices(timestamps)
+    if len(indices) == 0:
+        return
+    coords = np.column_stack((lon[indices], lat[indices], alt[indices]))
+
+    # flight mode of each point (the mode changes at the first point after
+    # the change, which also ends the previous line string)
+    flight_mode_changes = []
+    status = _get_dataset(ulog, 'vehicle_status')
+    if status is not None and 'nav_state' in status.data:
+        flight_mode_changes = status.list_value_changes('nav_state')
+        flight_mode_changes.append((ulog.last_timestamp, -1))
+    if len(flight_mode_changes) > 0:
+        change_times = np.array([change[0] for change in flight_mode_changes])
+        mode_indices = np.maximum(np.searchsorted(
+            change_times, timestamps[indices], side='right') - 1, 0)
+    else:
+        flight_mode_changes = [(0, 0)]
+        mode_indices = np.zeros(len(indices), dtype=np.int64)
+
+    segment_starts = np.flatnonzero(np.diff(mode_indices)) + 1
+    starts = np.concatenate(([0], segment_starts))
+    ends = np.concatenate((segment_starts + 1, [len(indices)]))
+    for start, end in zip(starts, ends):
+        flight_mode = flight_mode_changes[mode_indices[start]][1]
+        linestring = kml.newlinestring(name=KML_POSITION_TOPIC+':'+str(flight_mode),
+                                       altitudemode='absolute')
+        linestring.style.linestyle.color = kml_colors(flight_mode)
+        linestring.style.linestyle.width = KML_LINE_WIDTH
+        linestring.coords.addcoordinates(coords[start:end].tolist())
+
+
+def _add_camera_triggers(kml, ulog):
+    """ add the camera trigger points """
+    dataset = _get_dataset(ulog, KML_CAMERA_TRIGGER_TOPIC)
+    if dataset is None:
+        return
+    lon, lat, alt = _get_position_arrays(dataset)
+    for cur_lon, cur_lat, cur_alt, sequence in zip(
+            lon.tolist(), lat.tolist(), alt.tolist(), dataset.data['seq'].tolist()):
+        point = kml.newpoint(name='Camera Trigger '+str(sequence))
+        point.coords = [(cur_lon, cur_lat, cur_alt)]
+
+
+def write_kml_file(ulog, log_id):
+    """
+    write the KML file of a log
+    :param ulog: ULog object (as loaded by load_ulog_file)
+    :raise KeyError: if the log has no position data
+    """
+    dataset = _get_dataset(ulog, KML_POSITION_TOPIC)
+    if dataset is None:
+        raise KeyError(KML_POSITION_TOPIC+' not found in data')
+    kml = simplekml.Kml()
+    _add_track(kml, ulog, dataset)
+    _add_camera_triggers(kml, ulog)
+    # write to a random temporary file, then move it (to avoid races)
+    kml_file_name = get_kml_filename(log_id)
+    temp_file_name = kml_file_name+'.'+str(uuid.uuid4())
+    kml.save(temp_file_name)
+    os.replace(temp_file_name, kml_file_name)
+
+
+def _generate_kml_file(log_id):
+    """ worker: generate the KML file of a log """
+    try:
+        write_kml_file(load_ulog_file(get_log_filename(log_id)), log_id)
+        error = None
+    except Exception as e: #pylint: disable=broad-except
+        error = str(e) or type(e).__name__
+        print('Failed to generate the KML file of log {}: {}'.format(log_id, error))
+    with _lock:
+        _queued.discard(log_id)
+        if error is not None:
+            _failed[log_id] = (time.time(), error)
+
+
+def request_kml_file(log_id):
+    """
+    get the KML file of a log, or queue its generation if it does not exist.
+    Can be called from any thread, and repeatedly for the same log.
+    :return: tuple of (KML file name or None, error message or None). Both
+             are None while the file is being generated.
+    """
+    global _executor #pylint: disable=global-statement
+    kml_file_name = get_kml_filename(log_id)
+    with _lock:
+        if os.path.exists(kml_file_name):
+            return kml_file_name, None
+        if log_id in _queued:
+            return None, None
+        if log_id in _failed:
+            failed_time, error = _failed[log_id]
+            if time.time() - failed_time < RETRY_FAILED_AFTER_SEC:
+                return None, error
+            del _failed[log_id]
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_kml_worker_threads(),
+                                           thread_name_prefix='kml')
+        _queued.add(log_id)
+        _executor.submit(_generate_kml_file, log_id)
+    return None, None
@@ -0,0 +1,257 @@
+""" Initial & default parameters of the logs (LogParameters table), extracted
+when a log is ingested, so that the parameter exports do not need to read the
+log file, and queries of a parameter over many logs """
+
+import math
+
+from db_connection import get_db_connection
+from helper import get_log_filename, load_ulog_file
+
+# one row per log & parameter. The columns have no type, so that the values
+# keep theirs (INTEGER or REAL, an int32 parameter stays an int). Value is NULL
+# for a parameter that only has a default. A NaN float is stored as the text
+# NAN_VALUE (sqlite would store NULL). Clustered by log, as the rows of a log
+# are always read together.
+LOG_PARAMETERS_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS LogParameters("
+                            "LogId TEXT, "
+                            "Name TEXT, "
+                            "Value, "
+                            "SystemDefault, " # NULL if the log has none
+                            "AirframeDefault, " # NULL if the log has none
+                            "CONSTRAINT LogId_Name_PK PRIMARY KEY (LogId, Name)) "
+                            "WITHOUT ROWID")
+
+# lookup of a parameter over all logs (covering: the index of a WITHOUT ROWID
+# table contains the primary key)
+LOG_PARAMETERS_NAME_INDEX_SQL = ("CREATE INDEX IF NOT EXISTS LogParameters_Name "
+                                 "ON LogParameters (Name, Value)")
+
+# maximum number of logs returned by query_log_parameter
+MAX_QUERY_LOGS = 10000
+
+# stored (and returned by the queries, as JSON has no NaN) for NaN values
+NAN_VALUE = 'NaN'
+
+
+def _to_db_value(value):
+    """ map a parameter value to the stored value (NaN to NAN_VALUE) """
+    if isinstance(value, float) and math.isnan(value):
+        return NAN_VALUE
+    return value
+
+
+def _from_db_value(value):
+    """ map a stored value back to the parameter value """
+    if value == NAN_VALUE:
+        return float('nan')
+    return value
+
+
+class LogParameters:
+    """
+    Initial & default parameters of a log. Has the same attributes & methods
+    for them as ULog, so that it can be used instead (e.g. for
+    plotted_tables.get_changed_parameters).
+    has_default_parameters is True if the log contains defaults (unlike ULog,
+    not only if the flag is set).
+    """
+
+    def __init__(self, initial_parameters, system_defaults, airframe_defaults):
+        self.initial_parameters = initial_parameters
+        self._default_parameters = {0: system_defaults, 1: airframe_defaults}
+        self.has_default_parameters = len(system_defaults) + len(airframe_defaults) > 0
+
+    @classmethod
+    def from_ulog(cls, ulog):
+        """ initialize from a loaded log
+        :param ulog: ULog object """
+        if not ulog.has_default_parameters:
+            return cls(dict(ulog.initial_parameters), {}, {})
+        return cls(dict(ulog.initial_parameters), dict(ulog.get_default_parameters(0)),
+                   dict(ulog.get_default_parameters(1)))
+
+    def get_default_parameters(self, default_type):
+        """ dictionary of the default parameters (key=param name)
+        :param default_type: 0: system, 1: current_setup (airframe) """
+        return self._default_parameters[default_type]
+
+
+def write_log_parameters(cur, log_id, parameters):
+    """
+    store the parameters of a log, replacing existing ones, and mark them as
+    stored in the LogsGenerated entry (the caller commits)
+    :param cur: DB cursor
+    :param parameters: LogParameters object
+    """
+    system_defaults = parameters.get_default_parameters(0)
+    airframe_defaults = parameters.get_default_parameters(1)
+    names = set(parameters.initial_parameters) | set(system_defaults) | set(airframe_defaults)
+    cur.execute('DELETE FROM LogParameters WHERE LogId = ?', [log_id])
+    cur.executemany(
+        'INSERT INTO LogParameters (LogId, Name, Value, SystemDefault, AirframeDefault) '
+        'values (?, ?, ?, ?, ?)',
+        [(log_id, name, _to_db_value(parameters.initial_parameters.get(name)),
+          _to_db_value(system_defaults.get(name)), _to_db_value(airframe_defaults.get(name)))
+         for name in sorted(names)])
+    # also marks logs without parameters, so that they are not read again
+    cur.execute('UPDATE LogsGenerated SET ParametersStored = 1 WHERE Id = ?', [log_id])
+
+
+def read_log_parameters(cur, log_id):
+    """
+    get the stored parameters of a log
+    :param cur: DB cursor
+    :return: LogParameters object, or None if they are not stored (logs that
+             were added before the table existed)
+    """
+    cur.execute('SELECT Name, Value, SystemDefault, AirframeDefault FROM LogParameters '
+                'WHERE LogId = ?', [log_id])
+    rows = cur.fetchall()
+    if len(rows) == 0:
+        cur.execute('SELECT ParametersStored FROM LogsGenerated WHERE Id = ?', [log_id])
+        db_tuple = cur.fetchone()
+        if db_tuple is None or db_tuple[0] != 1:
+            return None
+        # the log has no parameters
+    initial_parameters = {}
+    system_defaults = {}
+    airframe_defaults = {}
+    for name, value, system_default, airframe_default in rows:
+        if value is not None:
+            initial_parameters[name] = _from_db_value(value)
+        if system_default is not None:
+            system_defaults[name] = _from_db_value(system_default)
+        if airframe_default is not None:
+            airframe_defaults[name] = _from_db_value(airframe_default)
+    return LogParameters(initial_parameters, system_defaults, airframe_defaults)
+
+
+def delete_log_parameters(cur, log_id):
+    """
+    delete the parameters of a log (the caller commits)
+    :param cur: DB cursor
+    """
+    cur.execute('DELETE FROM LogParameters WHERE LogId = ?', [log_id])
+
+
+def get_log_parameter_query(name, log_ids=None, uuids=None, start_time=None,
+                            end_time=None, count_values=False):
+    """
+    build the query for the value of a parameter in all public logs (not
+    uploaded by CI, as on the browse page) matching the filters (that have the
+    parameters stored), with the vehicle of the logs
+    :param name: parameter name
+    :param log_ids: list of log ids, or None
+    :param uuids: list of vehicle UUIDs, or None
+    :param start_time, end_time: UTC time window of the log start in unix
+                                 seconds (end excluded), or None
+    :param count_values: if True, query the number of logs per value instead
+                         (most common value first)
+    :return: tuple of (SQL query string, list of parameters)
+    """
+    sql_params = [name]
+    if uuids is not None or start_time is not None or end_time is not None:
+        # few logs out of many that have the parameter: go through the logs of
+        # the vehicles or time window (LogsGenerated_UUID_StartTime &
+        # LogsGenerated_StartTime indexes), then look up the parameter of each.
+        # CROSS JOIN makes sqlite keep this table order.
+        sql_from = ('FROM LogsGenerated '
+                    '   CROSS JOIN LogParameters on LogParameters.LogId=LogsGenerated.Id '
+                    '       AND LogParameters.Name = ? '
+                    '   CROSS JOIN Logs on Logs.Id=LogsGenerated.Id ')
+        sql_where = 'WHERE LogParameters.Value IS NOT NULL '
+    else:
+        sql_from = ('FROM LogParameters '
+                    '   CROSS JOIN Logs on Logs.Id=LogParameters.LogId '
+                    '   LEFT JOIN LogsGenerated on LogParameters.LogId=LogsGenerated.Id ')
+        sql_where = 'WHERE LogParameters.Name = ? AND LogParameters.Value IS NOT NULL '
+    sql_where += 'AND Logs.Public = 1 AND NOT Logs.Source = "CI" '
+    if log_ids is not None:
+        sql_where += 'AND LogParameters.LogId IN ('+', '.join(['?'] * len(log_ids))+') '
+        sql_params.extend(log_ids)
+    if uuids is not None:
+        sql_where += 'AND LogsGenerated.UUID IN ('+', '.join(['?'] * len(uuids))+') '
+        sql_params.extend(uuids)
+    if start_time is not None:
+        sql_where += 'AND LogsGenerated.StartTime >= ? '
+        sql_params.append(start_time)
+    if end_time is not None:
+        sql_where += 'AND LogsGenerated.StartTime < ? '
+        sql_params.append(end_time)
+    if count_values:
+        return ('SELECT LogParameters.Value, count(*) '+sql_from+sql_where+
+                'GROUP BY LogParameters.Value ORDER BY count(*) DESC', sql_params)
+    sql_params.append(MAX_QUERY_LOGS + 1)
+    return ('SELECT LogParameters.LogId, LogParameters.Value, LogsGenerated.UUID, '
+            '       Vehicle.Name, LogsGenerated.StartTime '
+            +sql_from+'   LEFT JOIN Vehicle on LogsGenerated.UUID=Vehicle.UUID '
+            +sql_where+'ORDER BY LogsGenerated.StartTime DESC LIMIT ?', sql_params)
+
+
+def query_log_parameter(cur, name, log_ids=None, uuids=None, start_time=None,
+                        end_time=None):
+    """
+    get the value of a parameter in all logs matching the filters (see
+    get_log_parameter_query)
+    :param cur: DB cursor
+    :return: dict with 'logs': list of dicts (log_id, value, vehicle_uuid,
+             vehicle_name & start_time) sorted by start time (newest first),
+             'values': list of dicts (value & num_logs) sorted by the number
+             of logs (the most common value first), and 'truncated': True if
+             there were more than MAX_QUERY_LOGS logs ('logs' then only
+             contains the newest, 'values' always counts all logs). NaN
+             values are returned as NAN_VALUE.
+    """
+    sql, sql_params = get_log_parameter_query(name, log_ids, uuids, start_time, end_time)
+    cur.execute(sql, sql_params)
+    rows = cur.fetchall()
+    truncated = len(rows) > MAX_QUERY_LOGS
+    sql, sql_params = get_log_parameter_query(name, log_ids, uuids, start_time, end_time,
+                                              count_values=True)
+    cur.execute(sql, sql_params)
+    return {
+        'logs': [{'log_id': log_id, 'value': value, 'vehicle_uuid': uuid or '',
+                  'vehicle_name': vehicle_name or '', 'start_time': start_time or 0}
+                 for log_id, value, uuid, vehicle_name, start_time in rows[:MAX_QUERY_LOGS]],
+        'values': [{'value': value, 'num_logs': num_logs}
+                   for value, num_logs in cur.fetchall()],
+        'truncated': truncated,
+        }
+
+
+def diff_log_parameters(parameters, reference_parameters):
+    """
+    get the parameters that differ between two logs
+    :param parameters, reference_parameters: LogParameters objects
+    :return: list of dicts (name, value & reference value, a value is None if
+             the log does not have the parameter, NAN_VALUE for NaN), sorted by
+             name
+    """
+    # compared as stored, so that NaN equals NaN
+    values = {name: _to_db_value(value)
+              for name, value in parameters.initial_parameters.items()}
+    reference_values = {name: _to_db_value(value)
+                        for name, value in reference_parameters.initial_parameters.items()}
+    return [{'name': name, 'value': values.get(name),
+             'reference': reference_values.get(name)}
+            for name in sorted(set(values) | set(reference_values))
+            if values.get(name) != reference_values.get(name)]
+
+
+def get_log_parameters(log_id):
+    """
+    get the parameters of a log from the DB. If they are not stored, the log
+    file is read & they are stored. Blocking (DB & file access).
+    :return: LogParameters object
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        parameters = read_log_parameters(cur, log_id)
+        if parameters is None:
+            parameters = LogParameters.from_ulog(load_ulog_file(get_log_filename(log_id)))
+            with con: # commits, or rolls back on error
+                write_log_parameters(cur, log_id, parameters)
+        return parameters
+    finally:
+        cur.close()
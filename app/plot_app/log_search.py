@@ -0,0 +1,175 @@
+""" Full-text search index of the log entries (SQLite FTS5 table LogsSearch) """
+
+from config import get_airframes_filename
+from db_connection import get_db_connection
+from db_entry import DBData
+from helper import get_airframe_data, flight_modes_table, add_metadata_refresh_callback
+
+# The trigram tokenizer allows for (case insensitive) substring matching, which
+# is what the browse page search box has always been doing.
+LOGS_SEARCH_TABLE_SQL = ("CREATE VIRTUAL TABLE LogsSearch USING fts5("
+                         "Id, " # log id
+                         "Date, " # upload date (YYYY-MM-DD, as shown on the browse page)
+                         "Rating, " # rating (as shown on the browse page)
+                         "Description, "
+                         "MavType, "
+                         "Airframe, " # airframe name (resolved from the autostart id)
+                         "Hardware, "
+                         "Software, "
+                         "SoftwareVersion, "
+                         "FlightModes, " # flight mode names, comma-separated
+                         "UUID, "
+                         "tokenize='trigram')")
+
+_SEARCH_COLUMNS = ['Date', 'Rating', 'Description', 'MavType', 'Airframe', 'Hardware',
+                   'Software', 'SoftwareVersion', 'FlightModes', 'UUID']
+
+# columns that are matched by a search
+_MATCH_COLUMNS = ['Id'] + _SEARCH_COLUMNS
+
+
+def _get_airframe_name(autostart_id):
+    """ get the airframe name of an autostart id ('' if unknown, or if the
+    airframes file is not downloaded yet) """
+    if autostart_id:
+        airframe_data = get_airframe_data(autostart_id)
+        if airframe_data is not None:
+            return airframe_data.get('name', '')
+    return ''
+
+
+def _get_search_values(date, rating, description, mav_type, autostart_id, hardware,
+                       software, software_version, flight_modes, vehicle_uuid):
+    """ get the list of column values for the search table, in the order of
+    _SEARCH_COLUMNS. The LogsGenerated values might be None (no entry yet) """
+    airframe = _get_airframe_name(autostart_id)
+    flight_mode_names = ''
+    if flight_modes:
+        flight_mode_names = ', '.join(flight_modes_table[int(x)][0]
+                                      for x in flight_modes.split(',')
+                                      if len(x) > 0 and int(x) in flight_modes_table)
+    # the date is a datetime or its string (depending on the connection)
+    return [str(date)[:10] if date else '', DBData.rating_str_static(rating),
+            description or '', mav_type or '', airframe, hardware or '',
+            software or '', software_version or '', flight_mode_names,
+            vehicle_uuid or '']
+
+
+def _match_log_id(log_id):
+    """ FTS5 query string matching the Id column of a log """
+    return '{Id} : "' + log_id.replace('"', '""') + '"'
+
+
+def delete_log_search_entry(cur, log_id):
+    """
+    delete the search index entry of a log (if there is any)
+    :param cur: DB cursor
+    """
+    cur.execute('DELETE FROM LogsSearch WHERE rowid IN '
+                '(SELECT rowid FROM LogsSearch WHERE LogsSearch MATCH ? AND Id = ?)',
+                [_match_log_id(log_id), log_id])
+
+
+def update_log_search_entry(cur, log_id):
+    """
+    (re-)generate the search index entry of a log from the Logs and
+    LogsGenerated tables. This needs to be called whenever one of the indexed
+    fields changes (the caller commits).
+    :param cur: DB cursor
+    """
+    cur.execute('SELECT Logs.Date, Logs.Rating, Logs.Description, LogsGenerated.MavType, '
+                '       LogsGenerated.AutostartId, LogsGenerated.Hardware, '
+                '       LogsGenerated.Software, LogsGenerated.SoftwareVersion, '
+                '       LogsGenerated.FlightModes, LogsGenerated.UUID '
+                'FROM Logs '
+                '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                'WHERE Logs.Id = ?', [log_id])
+    db_tuple = cur.fetchone()
+    delete_log_search_entry(cur, log_id)
+    if db_tuple is None:
+        return
+    cur.execute('INSERT INTO LogsSearch (Id, ' + ', '.join(_SEARCH_COLUMNS) + ') '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [log_id] + _get_search_values(*db_tuple))
+
+
+def rebuild_log_search_index(cur):
+    """
+    regenerate the whole search index from the Logs and LogsGenerated tables
+    :param cur: DB cursor
+    :return: number of indexed logs
+    """
+    cur.execute('DELETE FROM LogsSearch')
+    cur.execute('SELECT Logs.Id, Logs.Date, Logs.Rating, Logs.Description, '
+                '       LogsGenerated.MavType, '
+                '       LogsGenerated.AutostartId, LogsGenerated.Hardware, '
+                '       LogsGenerated.Software, LogsGenerated.SoftwareVersion, '
+                '       LogsGenerated.FlightModes, LogsGenerated.UUID '
+                'FROM Logs '
+                '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id')
+    rows = [[db_tuple[0]] + _get_search_values(*db_tuple[1:])
+            for db_tuple in cur.fetchall()]
+    cur.executemany('INSERT INTO LogsSearch (Id, ' + ', '.join(_SEARCH_COLUMNS) + ') '
+                    'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def get_log_search_filter(search_str, log_id_column='Logs.Id'):
+    """
+    get an SQL condition that restricts a query to the logs matching a search
+    string (case insensitive substring match over the indexed columns)
+    :param log_id_column: name of the log id column in the outer query
+    :return: tuple of (SQL condition string, list of parameters)
+    """
+    if len(search_str) >= 3:
+        # quoted as a single phrase: with the trigram tokenizer this is a
+        # substring match, independent of any FTS5 query syntax in the string
+        match_query = '{' + ' '.join(_MATCH_COLUMNS) + '} : "' + \
+            search_str.replace('"', '""') + '"'
+        return (log_id_column + ' IN (SELECT Id FROM LogsSearch WHERE LogsSearch MATCH ?)',
+                [match_query])
+
+    # the trigram index cannot be used for less than 3 characters, so we have
+    # to scan the (much smaller than the logs join) search table
+    like_pattern = '%' + search_str.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_') + '%'
+    like_condition = ' OR '.join(column + " LIKE ? ESCAPE '\\'" for column in _MATCH_COLUMNS)
+    return (log_id_column + ' IN (SELECT Id FROM LogsSearch WHERE ' + like_condition + ')',
+            [like_pattern] * len(_MATCH_COLUMNS))
+
+
+def update_log_search_airframes(cur):
+    """
+    update the airframe names in the search index after the airframes file
+    changed (the logs indexed before it was downloaded have no airframe name)
+    (the caller commits)
+    :param cur: DB cursor
+    :return: number of updated logs
+    """
+    cur.execute('SELECT LogsSearch.Id, LogsSearch.Airframe, LogsGenerated.AutostartId '
+                'FROM LogsSearch '
+                '   JOIN LogsGenerated on LogsGenerated.Id=LogsSearch.Id')
+    log_ids = [log_id for log_id, airframe, autostart_id in cur.fetchall()
+               if _get_airframe_name(autostart_id) != airframe]
+    for log_id in log_ids:
+        update_log_search_entry(cur, log_id)
+    return len(log_ids)
+
+
+def _airframes_refreshed(filename):
+    """ metadata refresh callback (runs in the metadata thread) """
+    if filename != get_airframes_filename():
+        return
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        with con: # commits, or rolls back on error
+            num_updated = update_log_search_airframes(cur)
+    finally:
+        cur.close()
+    if num_updated > 0:
+        print('Updated the airframe names of {} logs in the search index'.format(num_updated))
+
+
+# in every process that indexes logs, as any of them might download the file
+add_metadata_refresh_callback(_airframes_refreshed)
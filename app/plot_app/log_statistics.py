@@ -0,0 +1,207 @@
+""" Materialized (daily aggregated) statistics of the logs, for the statistics
+page. The tables are updated incrementally when logs are added or deleted. """
+
+# Statistics tables:
+# - StatisticsUploads: number of uploaded logs per 6 hour interval (all logs)
+# - StatisticsDaily: number of flights & flight duration per day and group
+#   (public, non-CI logs with a valid LogsGenerated entry). Category is one of
+#   the STATISTICS_* constants below, Name the group within the category.
+# - StatisticsBoards: number of flights per day and board (hardware & UUID),
+#   to count the unique boards
+STATISTICS_TABLES_SQL = [
+    "CREATE TABLE IF NOT EXISTS StatisticsUploads("
+    "Interval TIMESTAMP, " # start of the 6 hour interval
+    "Public INT, "
+    "NumLogs INT, "
+    "CONSTRAINT Interval_PK PRIMARY KEY (Public, Interval))",
+    "CREATE TABLE IF NOT EXISTS StatisticsDaily("
+    "Category TEXT, "
+    "Day TIMESTAMP, " # start of the day
+    "Name TEXT, "
+    "NumFlights INT, "
+    "Duration INT, " # flight duration in [s]
+    "CONSTRAINT Daily_PK PRIMARY KEY (Category, Day, Name))",
+    "CREATE TABLE IF NOT EXISTS StatisticsBoards("
+    "Day TIMESTAMP, " # start of the day
+    "Hardware TEXT, "
+    "UUID TEXT, "
+    "NumFlights INT, "
+    "CONSTRAINT Boards_PK PRIMARY KEY (Day, Hardware, UUID))",
+    ]
+
+STATISTICS_BOARD = 'board' # Name: hardware
+STATISTICS_AIRFRAME = 'airframe' # Name: autostart id
+STATISTICS_VERSION = 'version' # Name: release version or 'Not a Release'
+STATISTICS_FLIGHT_MODE = 'flight_mode' # Name: flight mode (int), Duration: time in that mode
+
+# number of changes of the statistics tables (a single row with Id 0, updated
+# in the same transaction), to invalidate the statistics page cached by each
+# server process
+STATISTICS_CHANGES_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS StatisticsChanges("
+                                "Id INT, "
+                                "Count INT, "
+                                "CONSTRAINT Id_PK PRIMARY KEY (Id))")
+
+_UPLOAD_INTERVAL_SQL = "datetime((strftime('%s', Date) / (6 * 60 * 60)) * 6 * 60 * 60, 'unixepoch')"
+
+_FLIGHT_COLUMNS_SQL = ("datetime(Logs.Date, 'start of day'), LogsGenerated.Duration, "
+                       "LogsGenerated.AutostartId, LogsGenerated.Hardware, "
+                       "LogsGenerated.SoftwareVersion, LogsGenerated.UUID, "
+                       "LogsGenerated.FlightModeDurations ")
+
+
+def _get_flight_rows(day, duration, autostart_id, hardware, sw_version,
+                     uuid, flight_mode_durations):
+    """
+    get the statistics rows of a public log, from the LogsGenerated values.
+    Bogus entries are filtered.
+    :return: tuple of (list of StatisticsDaily (category, day, name, duration)
+             tuples, StatisticsBoards (day, hardware, uuid) tuple), or None if
+             the log is not counted
+    """
+    # the version has typically the form 'v<i>.<j>.<k> <l>', where <l>
+    # indicates whether it's a development version (most of the time it's 0)
+    version = (sw_version or '').split(' ')
+    if version[0] in ('', 'v0.0.0'):
+        return None
+    if duration is None or duration > 7*24*3600: # probably bogus timestamp(s)
+        return None
+    if not autostart_id:
+        return None
+    try:
+        ver_major = int(version[0][1:].split('.')[0])
+    except ValueError:
+        return None
+    if ver_major >= 3 or ver_major == 0:
+        return None
+    is_release = len(version) > 1 and version[1] == '255'
+
+    daily_rows = [
+        (STATISTICS_BOARD, day, hardware, duration),
+        (STATISTICS_AIRFRAME, day, str(autostart_id), duration),
+        (STATISTICS_VERSION, day, version[0] if is_release else 'Not a Release', duration),
+        ]
+    mode_durations = {}
+    for mode_duration in (flight_mode_durations or '').split(','):
+        if len(mode_duration) > 0:
+            mode, mode_duration_s = mode_duration.split(':')
+            mode_durations[mode] = mode_durations.get(mode, 0) + int(mode_duration_s)
+    for mode in sorted(mode_durations):
+        daily_rows.append((STATISTICS_FLIGHT_MODE, day, mode, mode_durations[mode]))
+    return daily_rows, (day, hardware, uuid)
+
+
+def _update_flight_statistics(cur, flight_rows, delta):
+    """ add (delta=1) or subtract (delta=-1) the rows of a log """
+    daily_rows, board_row = flight_rows
+    for category, day, name, duration in daily_rows:
+        cur.execute('INSERT INTO StatisticsDaily (Category, Day, Name, NumFlights, Duration) '
+                    'values (?, ?, ?, ?, ?) ON CONFLICT (Category, Day, Name) DO UPDATE SET '
+                    'NumFlights = NumFlights + excluded.NumFlights, '
+                    'Duration = Duration + excluded.Duration',
+                    [category, day, name, delta, delta * duration])
+        if delta < 0:
+            cur.execute('DELETE FROM StatisticsDaily WHERE Category = ? AND Day = ? AND '
+                        'Name = ? AND NumFlights <= 0', [category, day, name])
+    cur.execute('INSERT INTO StatisticsBoards (Day, Hardware, UUID, NumFlights) '
+                'values (?, ?, ?, ?) ON CONFLICT (Day, Hardware, UUID) DO UPDATE SET '
+                'NumFlights = NumFlights + excluded.NumFlights',
+                list(board_row) + [delta])
+    if delta < 0:
+        cur.execute('DELETE FROM StatisticsBoards WHERE Day = ? AND Hardware = ? AND '
+                    'UUID = ? AND NumFlights <= 0', list(board_row))
+
+
+def _update_upload_statistics(cur, log_id, delta):
+    """ add (delta=1) or subtract (delta=-1) a log from the upload counts """
+    cur.execute('INSERT INTO StatisticsUploads (Interval, Public, NumLogs) '
+                'SELECT '+_UPLOAD_INTERVAL_SQL+', Public, ? FROM Logs WHERE Id = ? '
+                'ON CONFLICT (Public, Interval) DO UPDATE SET '
+                'NumLogs = NumLogs + excluded.NumLogs', [delta, log_id])
+    if delta < 0:
+        cur.execute('DELETE FROM StatisticsUploads WHERE NumLogs <= 0')
+
+
+def _count_statistics_change(cur):
+    """ increment the change count (see get_log_statistics_change_count) """
+    cur.execute('UPDATE StatisticsChanges SET Count = Count + 1 WHERE Id = 0')
+
+
+def _get_log_flight_rows(cur, log_id):
+    """ get the statistics rows of a log from the DB (see _get_flight_rows) """
+    cur.execute('SELECT '+_FLIGHT_COLUMNS_SQL+'FROM Logs '
+                '   JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                'WHERE Logs.Id = ? AND Logs.Public = 1 AND Logs.Source != "CI"', [log_id])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    return _get_flight_rows(*db_tuple)
+
+
+def add_log_upload_statistics(cur, log_id):
+    """
+    count a new log in the upload statistics. Call this after inserting the
+    Logs entry (the caller commits).
+    :param cur: DB cursor
+    """
+    _update_upload_statistics(cur, log_id, 1)
+    _count_statistics_change(cur)
+
+
+def add_log_flight_statistics(cur, log_id):
+    """
+    add a log to the flight statistics. Call this after inserting the
+    LogsGenerated entry (the caller commits).
+    :param cur: DB cursor
+    """
+    flight_rows = _get_log_flight_rows(cur, log_id)
+    if flight_rows is not None:
+        _update_flight_statistics(cur, flight_rows, 1)
+        _count_statistics_change(cur)
+
+
+def delete_log_statistics(cur, log_id):
+    """
+    remove a log from all statistics. Call this before deleting the Logs &
+    LogsGenerated entries (the caller commits).
+    :param cur: DB cursor
+    """
+    flight_rows = _get_log_flight_rows(cur, log_id)
+    if flight_rows is not None:
+        _update_flight_statistics(cur, flight_rows, -1)
+    _update_upload_statistics(cur, log_id, -1)
+    _count_statistics_change(cur)
+
+
+def get_log_statistics_change_count(cur):
+    """
+    get the number of (committed) changes of the statistics by any process
+    :param cur: DB cursor
+    """
+    cur.execute('SELECT Count FROM StatisticsChanges WHERE Id = 0')
+    db_tuple = cur.fetchone()
+    return 0 if db_tuple is None else db_tuple[0]
+
+
+def rebuild_log_statistics(cur):
+    """
+    regenerate all statistics tables from the Logs and LogsGenerated tables
+    :param cur: DB cursor
+    :return: number of logs counted in the flight statistics
+    """
+    cur.execute('DELETE FROM StatisticsUploads')
+    cur.execute('DELETE FROM StatisticsDaily')
+    cur.execute('DELETE FROM StatisticsBoards')
+    cur.execute('INSERT INTO StatisticsUploads (Interval, Public, NumLogs) '
+                'SELECT '+_UPLOAD_INTERVAL_SQL+' AS UploadInterval, Public, count(*) '
+                'FROM Logs GROUP BY UploadInterval, Public')
+    cur.execute('SELECT '+_FLIGHT_COLUMNS_SQL+'FROM Logs '
+                '   JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                'WHERE Logs.Public = 1 AND Logs.Source != "CI"')
+    num_logs = 0
+    for db_tuple in cur.fetchall():
+        flight_rows = _get_flight_rows(*db_tuple)
+        if flight_rows is not None:
+            _update_flight_statistics(cur, flight_rows, 1)
+            num_logs += 1
+    return num_logs
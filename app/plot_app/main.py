@@ -2,7 +2,6 @@
 
 from timeit import default_timer as timer
 import sys
-import sqlite3
 import traceback
 import os
 
@@ -16,9 +15,10 @@ from helper import *
 from config import *
 from colors import HTML_color_to_RGB
 from db_entry import *
+from db_connection import get_db_connection
 from configured_plots import generate_plots
 from pid_analysis_plots import get_pid_analysis_plots
-from statistics_plots import StatisticsPlots
+from statistics_plots import get_statistics_page_plots
 
 #pylint: disable=invalid-name, redefined-outer-name
 
@@ -28,52 +28,8 @@ if GET_arguments is not None and 'stats' in GET_arguments:
 
     # show the statistics page
 
-    plots = []
     start_time = timer()
-    statistics = StatisticsPlots(plot_config, debug_verbose_output())
-
-    print_timing("Data Loading Stats", start_time)
-    start_time = timer()
-
-
-    # title
-    div = Div(text="<h2>Statistics</h2>")
-    plots.append(column(div))
-
-    div = Div(text="<h3>All Logs</h3>")
-    plots.append(column(div))
-
-    p = statistics.plot_log_upload_statistics([colors8[0], colors8[1], colors8[3],
-                                               colors8[4], colors8[5]])
-    plots.append(p)
-    div_info = Div(text="Number of Continous Integration (Simulation Tests) Logs: %i<br />" \
-            "Total Number of Logs on the Server: %i" %
-                   (statistics.num_logs_ci(), statistics.num_logs_total()))
-    plots.append(column(div_info))
-
-    div = Div(text="<br/><h3>Public Logs</h3>")
-    div_info = Div(text="Total Flight Hours: %.1f"%
-                   statistics.total_public_flight_duration())
-    plots.append(column([div, div_info]))
-
-    p = statistics.plot_public_board_hours_statistics()
-    plots.append(p)
-
-    p = statistics.plot_public_board_flights_statistics()
-    plots.append(p)
-
-    p = statistics.plot_public_unique_boards_statistics()
-    plots.append(p)
-
-    p = statistics.plot_public_airframe_statistics()
-    plots.append(p)
-
-    p = statistics.plot_public_version_flights_statistics()
-    plots.append(p)
-
-    p = statistics.plot_public_flight_mode_statistics()
-    plots.append(p)
-
+    plots = get_statistics_page_plots(plot_config, debug_verbose_output())
     print_timing("Plotting Stats", start_time)
 
     curdoc().template_variables['is_stats_page'] = True
@@ -126,8 +82,7 @@ else:
         db_data = DBData()
         vehicle_data = None
         try:
-            con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
-            cur = con.cursor()
+            cur = get_db_connection().cursor()
             cur.execute('select Description, Feedback, Type, WindSpeed, Rating, VideoUrl, '
                         'ErrorLabels from Logs where Id = ?', [log_id])
             db_tuple = cur.fetchone()
@@ -160,7 +115,6 @@ else:
                         pass
 
             cur.close()
-            con.close()
         except:
             print("DB access failed:", sys.exc_info()[0], sys.exc_info()[1])
 
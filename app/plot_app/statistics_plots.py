@@ -1,65 +1,32 @@
 """ Class for statistics plots page """
-import sqlite3
 import datetime
-from dateutil.relativedelta import relativedelta
 
 import numpy as np
 
 from bokeh.plotting import figure
 from bokeh.palettes import viridis # alternatives: magma, inferno
+from bokeh.layouts import column
 from bokeh.models import (
     DatetimeTickFormatter,
     HoverTool, ColumnDataSource, LabelSet
     )
+from bokeh.models.widgets import Div
 
+from config import colors8
 from plotting import TOOLS, ACTIVE_SCROLL_TOOLS
-from config import get_db_filename
+from db_connection import get_db_connection
 from helper import get_airframe_data, flight_modes_table, get_sw_releases
+from log_statistics import STATISTICS_BOARD, STATISTICS_AIRFRAME, \
+    STATISTICS_VERSION, STATISTICS_FLIGHT_MODE
 
 
 #pylint: disable=invalid-name,consider-using-dict-items
 
 
-class _Log:
-    """
-    container class containing a DB entry for one log
-    """
-
-    def __init__(self, db_tuple):
-        self.log_id = db_tuple[0]
-        self.date = db_tuple[1]
-        self.source = db_tuple[2]
-        self.is_public = db_tuple[3]
-        self.rating = db_tuple[4]
-
-        self.duration = 0
-        self.autostart_id = 0
-        self.hardware = ""
-        self.uuid = ""
-        self.sw_version = ""
-        self.flight_mode_durations = []
-
-        self.is_release = False
-
-    def set_generated(self, db_tuple):
-        """ set from a LogsGenerated DB tuple """
-        self.duration = db_tuple[1]
-        self.autostart_id = db_tuple[4]
-        self.hardware = db_tuple[5]
-        self.uuid = db_tuple[11]
-        # the version has typically the form 'v<i>.<j>.<k> <l>', where <l>
-        # indicates whether it's a development version (most of the time it's 0)
-        version = db_tuple[10].split(' ')
-        self.sw_version = version[0]
-        self.is_release = len(version) > 1 and version[1] == '255'
-
-        self.flight_mode_durations = \
-            [tuple(map(int, x.split(':'))) for x in db_tuple[12].split(',') if len(x) > 0]
-
-
 class StatisticsPlots:
     """
-    Class to generate statistics plots from Database entries
+    Class to generate statistics plots from Database entries (the
+    materialized statistics tables, see log_statistics.py)
     """
 
     def __init__(self, plot_config, verbose_output=False):
@@ -72,125 +39,73 @@ class StatisticsPlots:
         self._num_logs_ci = 0
         self._num_flight_hours_total = 0
 
-        self._public_logs = []
+        # public logs within the last few months: category -> list of
+        # (day, name, number of flights, duration) tuples, ordered by day
+        self._public_daily = {}
+        # list of (hardware, uuid, first day) tuples
+        self._public_boards = []
 
         # read from the DB
-        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+        con = get_db_connection()
         with con:
             cur = con.cursor()
 
-            cur.execute("select count(Id) from Logs")
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                self._num_logs_total = db_tuple[0]
-
             cur.execute("select count(Id) from Logs where Source = 'CI'")
             db_tuple = cur.fetchone()
             if db_tuple is not None:
                 self._num_logs_ci = db_tuple[0]
 
-            # Get all log dates of specific types within 6 hour intervals
-            cur.execute('''
-select
-    Date,
-    count(*) cnt,
-    datetime((strftime('%s', Date) / (6 * 60 * 60)) * 6 * 60 * 60, 'unixepoch') new_date
-from Logs
-where Public = 1
-group by new_date
-order by new_date
-''')
+            # number of uploaded logs within 6 hour intervals
+            cur.execute('select Interval, NumLogs from StatisticsUploads '
+                        'where Public = 1 order by Interval')
             self._public_log_dates_intervals = cur.fetchall()
-            cur.execute('''
-select
-    Date,
-    count(*) cnt,
-    datetime((strftime('%s', Date) / (6 * 60 * 60)) * 6 * 60 * 60, 'unixepoch') new_date
-from Logs
-where Public = 0
-group by new_date
-order by new_date
-''')
+            cur.execute('select Interval, NumLogs from StatisticsUploads '
+                        'where Public = 0 order by Interval')
             self._private_log_dates_intervals = cur.fetchall()
+            self._num_logs_total = sum(x[1] for x in self._public_log_dates_intervals) + \
+                sum(x[1] for x in self._private_log_dates_intervals)
 
-            # Get all public logs within the last few months
-            cur.execute("select Id, Date, Source, Public, Rating from Logs where Public = 1 "
-                        "and Source != 'CI' and "
-                        "Date > date('now', '-90 day') order by Date")
-            db_tuples = cur.fetchall()
-            for db_tuple in db_tuples:
-                log = _Log(db_tuple)
-
-                cur.execute('select * from LogsGenerated where Id = ?', [log.log_id])
-                db_tuple = cur.fetchone()
-
-                if db_tuple is None:
-                    if self._verbose_output:
-                        print("Error: no generated data")
-                    continue
-
-                log.set_generated(db_tuple)
-
-                # filter bogus entries
-                if log.sw_version == 'v0.0.0':
-                    if self._verbose_output:
-                        print('Warning: %s with version=v0.0.0' % log.log_id)
-                    continue
-                if log.duration > 7*24*3600: # probably bogus timestamp(s)
-                    if self._verbose_output:
-                        print('Warning: %s with very high duration %i' %
-                              (log.log_id, log.duration))
-                    continue
-
-                if log.sw_version == '':
-                    # FIXME: does that still occur and if so why?
-                    if self._verbose_output:
-                        print('Warning: %s version not set' % log.log_id)
-                    continue
-
-                if log.autostart_id == 0:
-                    if self._verbose_output:
-                        print('Warning: %s with autostart_id=0' % log.log_id)
-                    continue
-
-                try:
-                    ver_major = int(log.sw_version[1:].split('.')[0])
-                    if ver_major >= 3 or ver_major == 0:
-                        if self._verbose_output:
-                            print('Warning: %s with large/small version %s' %
-                                  (log.log_id, log.sw_version))
-                        continue
-                except:
-                    continue
-
-                self._public_logs.append(log)
-                self._num_flight_hours_total += log.duration
-
-            self._num_flight_hours_total /= 3600
-
-
-    def get_data_for_plotting(self, groups_value_getter, empty_value=0,
-                              value_adder=lambda a, b: a+b):
+            for category in [STATISTICS_BOARD, STATISTICS_AIRFRAME,
+                             STATISTICS_VERSION, STATISTICS_FLIGHT_MODE]:
+                cur.execute('select Day, Name, NumFlights, Duration from StatisticsDaily '
+                            'where Category = ? and Day > date(\'now\', \'-90 day\') '
+                            'order by Day', [category])
+                self._public_daily[category] = cur.fetchall()
+
+            cur.execute('select Hardware, UUID, min(Day) from StatisticsBoards '
+                        'where Day > date(\'now\', \'-90 day\') group by Hardware, UUID')
+            # (min() returns the timestamp as string)
+            self._public_boards = [
+                (hardware, uuid, datetime.datetime.strptime(first_day, '%Y-%m-%d %H:%M:%S'))
+                for hardware, uuid, first_day in cur.fetchall()]
+
+            self._num_flight_hours_total = \
+                sum(x[3] for x in self._public_daily[STATISTICS_BOARD]) / 3600
+
+        if self._verbose_output:
+            print('Statistics: {} logs, {} public flights within the last 90 days'.format(
+                self._num_logs_total,
+                sum(x[2] for x in self._public_daily[STATISTICS_BOARD])))
+
+
+    def get_data_for_plotting(self, category, value_getter):
         """
         Get some data in a form that it can be used for plotting
+        :param category: StatisticsDaily category
+        :param value_getter: get the value from (number of flights, duration)
         :return: tuple of list(dates), dict(group, list(value)),
                  with len(list(dates)) == len(list(value))
         """
-        interval = relativedelta(days=1)
-        cur_interval_date = self._public_logs[0].date
-        dates = [cur_interval_date]
+        dates = []
         groups = {} # map with list of values for each group
-        for log in self._public_logs:
-            if log.date > cur_interval_date + interval:
-                dates.append(log.date)
+        for day, name, num_flights, duration in self._public_daily[category]:
+            if len(dates) == 0 or dates[-1] != day:
+                dates.append(day)
                 for group in groups:
-                    groups[group].append(empty_value)
-                cur_interval_date = log.date
-            groups_and_values = groups_value_getter(log)
-            for group, value in groups_and_values:
-                if group not in groups:
-                    groups[group] = [empty_value] * len(dates)
-                groups[group][-1] = value_adder(groups[group][-1], value)
+                    groups[group].append(0)
+            if name not in groups:
+                groups[name] = [0] * len(dates)
+            groups[name][-1] += value_getter(num_flights, duration)
         return dates, groups
 
 
@@ -222,7 +137,7 @@ order by new_date
             dates_list_subsampled = []
             counts_subsampled = []
             count_total = 0
-            for date, count, _ in data_points:
+            for date, count in data_points:
                 dates_list_subsampled.append(date)
                 count_total += count
                 counts_subsampled.append(count_total)
@@ -306,7 +221,8 @@ order by new_date
                                    airframe_type+' ('+airframe_id+')'
             return airframe_label
 
-        dates, groups = self.get_data_for_plotting(lambda log: [(str(log.autostart_id), 1)])
+        dates, groups = self.get_data_for_plotting(
+            STATISTICS_AIRFRAME, lambda num_flights, duration: num_flights)
         # Cumulative
         for group in groups:
             groups[group] = np.cumsum(groups[group])
@@ -328,8 +244,7 @@ order by new_date
                 return f'Unknown ({flight_mode})'
 
         dates, groups = self.get_data_for_plotting(
-            lambda log: [(str(mode), duration/3600)
-                         for mode, duration in log.flight_mode_durations])
+            STATISTICS_FLIGHT_MODE, lambda num_flights, duration: duration/3600)
         # Cumulative
         for group in groups:
             groups[group] = np.cumsum(groups[group])
@@ -343,7 +258,8 @@ order by new_date
         :return: bokeh plot
         """
 
-        dates, groups = self.get_data_for_plotting(lambda log: [(log.hardware, 1)])
+        dates, groups = self.get_data_for_plotting(
+            STATISTICS_BOARD, lambda num_flights, duration: num_flights)
         # Cumulative
         for group in groups:
             groups[group] = np.cumsum(groups[group])
@@ -357,7 +273,7 @@ order by new_date
         """
 
         dates, groups = self.get_data_for_plotting(
-            lambda log: [(log.hardware, log.duration / 3600)])
+            STATISTICS_BOARD, lambda num_flights, duration: duration / 3600)
         # Cumulative
         for group in groups:
             groups[group] = np.cumsum(groups[group])
@@ -371,7 +287,7 @@ order by new_date
         """
 
         dates, groups = self.get_data_for_plotting(
-            lambda log: [('Not a Release' if not log.is_release else log.sw_version, 1)])
+            STATISTICS_VERSION, lambda num_flights, duration: num_flights)
         # Cumulative
         for group in groups:
             groups[group] = np.cumsum(groups[group])
@@ -384,14 +300,17 @@ order by new_date
         :return: bokeh plot
         """
 
-        dates, groups = self.get_data_for_plotting(
-            lambda log: [(log.hardware, log.uuid)], [], lambda a, b: a + [b])
+        # number of boards that were seen for the first time on each day
+        dates = sorted({first_day for _, _, first_day in self._public_boards})
+        date_indices = {date: i for i, date in enumerate(dates)}
+        groups = {}
+        for hardware, _, first_day in self._public_boards:
+            if hardware not in groups:
+                groups[hardware] = [0] * len(dates)
+            groups[hardware][date_indices[first_day]] += 1
         # Cumulative
         for group in groups:
-            all_previous = set()
-            for i, date_list in enumerate(groups[group]):
-                all_previous.update(set(date_list))
-                groups[group][i] = len(all_previous)
+            groups[group] = np.cumsum(groups[group])
 
         return self.plot_groups_as_stack(dates, groups, "Number of Unique Boards", "Board Type")
 
@@ -485,3 +404,52 @@ order by new_date
         p.legend.location = "top_left"
         p.toolbar.logo = None
 
+
+
+def get_statistics_page_plots(plot_config, verbose_output=False):
+    """
+    create the content of the statistics page
+    :return: list of bokeh models
+    """
+    plots = []
+    statistics = StatisticsPlots(plot_config, verbose_output)
+
+    # title
+    div = Div(text="<h2>Statistics</h2>")
+    plots.append(column(div))
+
+    div = Div(text="<h3>All Logs</h3>")
+    plots.append(column(div))
+
+    p = statistics.plot_log_upload_statistics([colors8[0], colors8[1], colors8[3],
+                                               colors8[4], colors8[5]])
+    plots.append(p)
+    div_info = Div(text="Number of Continous Integration (Simulation Tests) Logs: %i<br />" \
+            "Total Number of Logs on the Server: %i" %
+                   (statistics.num_logs_ci(), statistics.num_logs_total()))
+    plots.append(column(div_info))
+
+    div = Div(text="<br/><h3>Public Logs</h3>")
+    div_info = Div(text="Total Flight Hours: %.1f"%
+                   statistics.total_public_flight_duration())
+    plots.append(column([div, div_info]))
+
+    p = statistics.plot_public_board_hours_statistics()
+    plots.append(p)
+
+    p = statistics.plot_public_board_flights_statistics()
+    plots.append(p)
+
+    p = statistics.plot_public_unique_boards_statistics()
+    plots.append(p)
+
+    p = statistics.plot_public_airframe_statistics()
+    plots.append(p)
+
+    p = statistics.plot_public_version_flights_statistics()
+    plots.append(p)
+
+    p = statistics.plot_public_flight_mode_statistics()
+    plots.append(p)
+
+    return plots
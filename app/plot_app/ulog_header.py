@@ -0,0 +1,96 @@
+""" Incremental parser of the ULog file header & definitions section, to get
+the info messages & initial parameters of an uploaded log while it arrives
+(without reading the file again) """
+
+import struct
+
+from pyulog import ULog
+
+# file header: magic (7 bytes), version (1 byte), timestamp (8 bytes)
+_FILE_HEADER_SIZE = 16
+# message header: size (uint16), type (uint8)
+_MESSAGE_HEADER_SIZE = 3
+
+# message types of the definitions section (any other type starts the data)
+_DEFINITION_MESSAGE_TYPES = (ULog.MSG_TYPE_FLAG_BITS, ULog.MSG_TYPE_FORMAT,
+                             ULog.MSG_TYPE_INFO, ULog.MSG_TYPE_INFO_MULTIPLE,
+                             ULog.MSG_TYPE_PARAMETER, ULog.MSG_TYPE_PARAMETER_DEFAULT)
+
+# stop if the definitions are larger than this (they are typically < 100 KB)
+MAX_DEFINITIONS_SIZE = 16 * 1024 * 1024
+
+
+class ULogHeaderParser:
+    """
+    Feed the file data in chunks of any size. The parsed attributes have the
+    same names as in ULog, so that the parser can be used instead of a ULog
+    object where only these are needed (e.g. helper.get_airframe_name,
+    PX4ULog.get_mav_type).
+    """
+
+    def __init__(self):
+        self.msg_info_dict = {}
+        self.initial_parameters = {}
+        # None until the file header is received, then whether it's a ULog file
+        self.is_ulog = None
+        # True when the definitions are parsed (the rest of the data is ignored)
+        self.is_complete = False
+        self._buf = bytearray()
+        self._pos = 0
+        self._num_bytes = 0
+
+    def feed(self, data):
+        """ parse the next chunk of the file (bytes-like) """
+        if self.is_complete:
+            return
+        self._buf += data
+        self._num_bytes += len(data)
+        self._parse()
+        if self._num_bytes > MAX_DEFINITIONS_SIZE:
+            self._set_complete()
+        del self._buf[:self._pos]
+        self._pos = 0
+
+    def _set_complete(self):
+        self.is_complete = True
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _parse(self):
+        """ parse the complete messages in the buffer """
+        if self.is_ulog is None:
+            if len(self._buf) < _FILE_HEADER_SIZE:
+                return
+            self.is_ulog = self._buf[:len(ULog.HEADER_BYTES)] == ULog.HEADER_BYTES
+            if not self.is_ulog:
+                self._set_complete()
+                return
+            self._pos = _FILE_HEADER_SIZE
+
+        while len(self._buf) - self._pos >= _MESSAGE_HEADER_SIZE:
+            msg_size, msg_type = struct.unpack_from('<HB', self._buf, self._pos)
+            if msg_type not in _DEFINITION_MESSAGE_TYPES:
+                self._set_complete()
+                return
+            start = self._pos + _MESSAGE_HEADER_SIZE
+            if len(self._buf) - start < msg_size:
+                return # not enough data yet
+            data = bytes(self._buf[start:start + msg_size])
+            self._pos = start + msg_size
+            try:
+                self._parse_message(msg_type, data)
+            except (struct.error, IndexError, UnicodeDecodeError):
+                # corrupt message: keep what we have (the log is fully
+                # parsed later, which handles corruption)
+                self._set_complete()
+                return
+
+    def _parse_message(self, msg_type, data):
+        """ parse a definitions message that is needed """
+        #pylint: disable=protected-access
+        if msg_type == ULog.MSG_TYPE_INFO:
+            msg_info = ULog._MessageInfo(data, None)
+            self.msg_info_dict[msg_info.key] = msg_info.value
+        elif msg_type == ULog.MSG_TYPE_PARAMETER:
+            msg_info = ULog._MessageInfo(data, None)
+            self.initial_parameters[msg_info.key] = msg_info.value
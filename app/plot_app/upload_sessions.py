@@ -0,0 +1,173 @@
+""" Sessions of resumable uploads (UploadSessions & UploadSessionRanges
+tables). The file of a session is preallocated in the log folder and the
+client uploads byte ranges of it, in any order and in parallel. The received
+ranges are stored in the DB, so that an upload can be resumed after a
+connection drop or server restart, and handled by any server process. """
+
+import datetime
+import json
+import os
+
+from config import get_log_filepath
+
+UPLOAD_SESSION_OPEN = 'open'
+UPLOAD_SESSION_FINALIZING = 'finalizing'
+
+# a session with writers can be finalized anyway if it did not receive data
+# for this long (writers of a server process that stopped during a PUT)
+STALE_WRITERS_AGE = datetime.timedelta(hours=1)
+
+UPLOAD_SESSIONS_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS UploadSessions("
+                             "Id TEXT, "
+                             "Size INT, " # file size in bytes
+                             "FileName TEXT, " # original file name
+                             "Options TEXT, " # JSON upload options (formdict)
+                             "State TEXT, " # one of the UPLOAD_SESSION_* constants
+                             "Writers INT DEFAULT 0, " # number of PUT requests writing to the file
+                             "Created TIMESTAMP, "
+                             "Updated TIMESTAMP, " # last received range
+                             "CONSTRAINT Id_PK PRIMARY KEY (Id))")
+
+# received byte ranges [Start, End)
+UPLOAD_SESSION_RANGES_TABLE_SQL = ("CREATE TABLE IF NOT EXISTS UploadSessionRanges("
+                                   "SessionId TEXT, "
+                                   "Start INT, "
+                                   "End INT)")
+
+UPLOAD_SESSION_RANGES_INDEX_SQL = ("CREATE INDEX IF NOT EXISTS UploadSessionRanges_SessionId "
+                                   "ON UploadSessionRanges (SessionId)")
+
+
+def get_upload_session_filename(session_id):
+    """ get the file name of the data of a session (in the log folder, so
+    that it can be renamed to the log file) """
+    return os.path.join(get_log_filepath(), session_id + '.upload')
+
+
+def create_upload_session(cur, session_id, size, file_name, options):
+    """
+    add a new session (the caller commits & creates the file)
+    :param cur: DB cursor
+    :param options: upload options (JSON-serializable dict)
+    """
+    now = datetime.datetime.now()
+    cur.execute('INSERT INTO UploadSessions (Id, Size, FileName, Options, State, '
+                'Created, Updated) values (?, ?, ?, ?, ?, ?, ?)',
+                [session_id, size, file_name, json.dumps(options), UPLOAD_SESSION_OPEN,
+                 now, now])
+
+
+def get_upload_session(cur, session_id):
+    """
+    get a session
+    :param cur: DB cursor
+    :return: dict with 'size', 'file_name', 'options', 'state' & 'writers',
+             or None if there is no such session
+    """
+    cur.execute('SELECT Size, FileName, Options, State, Writers FROM UploadSessions '
+                'WHERE Id = ?', [session_id])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    return {'size': db_tuple[0], 'file_name': db_tuple[1],
+            'options': json.loads(db_tuple[2]), 'state': db_tuple[3],
+            'writers': db_tuple[4]}
+
+
+def start_upload_session_write(cur, session_id):
+    """
+    register a request that writes a byte range to the file of an open
+    session: it cannot be finalized until end_upload_session_write or
+    add_upload_session_range (the caller commits)
+    :param cur: DB cursor
+    :return: False if the session does not exist or is not open
+    """
+    cur.execute('UPDATE UploadSessions SET Writers = Writers + 1, Updated = ? '
+                'WHERE Id = ? AND State = ?',
+                [datetime.datetime.now(), session_id, UPLOAD_SESSION_OPEN])
+    return cur.rowcount == 1
+
+
+def end_upload_session_write(cur, session_id):
+    """
+    unregister a request that failed to write its byte range (the caller
+    commits)
+    :param cur: DB cursor
+    """
+    cur.execute('UPDATE UploadSessions SET Writers = Writers - 1 WHERE Id = ? AND Writers > 0',
+                [session_id])
+
+
+def add_upload_session_range(cur, session_id, start, end):
+    """
+    record a received byte range [start, end) & unregister its writer (the
+    caller commits)
+    :param cur: DB cursor
+    """
+    cur.execute('INSERT INTO UploadSessionRanges (SessionId, Start, End) values (?, ?, ?)',
+                [session_id, start, end])
+    cur.execute('UPDATE UploadSessions SET Updated = ?, Writers = max(Writers - 1, 0) '
+                'WHERE Id = ?', [datetime.datetime.now(), session_id])
+
+
+def get_missing_upload_ranges(cur, session_id, size):
+    """
+    get the byte ranges of a session that were not received yet
+    :param cur: DB cursor
+    :return: list of [start, end) lists, sorted
+    """
+    cur.execute('SELECT Start, End FROM UploadSessionRanges WHERE SessionId = ? '
+                'ORDER BY Start', [session_id])
+    missing = []
+    position = 0
+    for start, end in cur.fetchall():
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+def claim_upload_session(cur, session_id):
+    """
+    mark an open session as being finalized (the caller commits). Only one
+    request gets it, and only while no byte range is being written.
+    :param cur: DB cursor
+    :return: True if claimed
+    """
+    cur.execute('UPDATE UploadSessions SET State = ? WHERE Id = ? AND State = ? '
+                'AND (Writers = 0 OR Updated < ?)',
+                [UPLOAD_SESSION_FINALIZING, session_id, UPLOAD_SESSION_OPEN,
+                 datetime.datetime.now() - STALE_WRITERS_AGE])
+    return cur.rowcount == 1
+
+
+def release_upload_session(cur, session_id):
+    """
+    reopen a session that could not be finalized (the caller commits)
+    :param cur: DB cursor
+    """
+    cur.execute('UPDATE UploadSessions SET State = ? WHERE Id = ?',
+                [UPLOAD_SESSION_OPEN, session_id])
+
+
+def delete_upload_session(cur, session_id):
+    """
+    delete a session from the DB (the caller commits & deletes the file)
+    :param cur: DB cursor
+    """
+    cur.execute('DELETE FROM UploadSessionRanges WHERE SessionId = ?', [session_id])
+    cur.execute('DELETE FROM UploadSessions WHERE Id = ?', [session_id])
+
+
+def get_expired_upload_sessions(cur, max_age):
+    """
+    get the sessions that did not receive data for a while
+    :param cur: DB cursor
+    :param max_age: datetime.timedelta
+    :return: list of session ids
+    """
+    cur.execute('SELECT Id FROM UploadSessions WHERE Updated < ?',
+                [datetime.datetime.now() - max_age])
+    return [db_tuple[0] for db_tuple in cur.fetchall()]
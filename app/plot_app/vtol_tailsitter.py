@@ -3,6 +3,18 @@
 from scipy.spatial.transform import Rotation as Rot
 import numpy as np
 
+from helper import get_vtol_state_per_sample
+
+def _get_fw_samples(vtol_states, timestamps):
+    """
+    get the samples in FW mode (states: 1=transition, 2=FW, 3=MC): strictly
+    between the start & the end of a FW segment, samples at the time of a
+    change are not converted
+    :return: boolean numpy array
+    """
+    return np.logical_and(get_vtol_state_per_sample(vtol_states, timestamps, 'left') == 2,
+                          get_vtol_state_per_sample(vtol_states, timestamps, 'right') == 2)
+
 def tailsitter_orientation(ulog, vtol_states):
     """
     corrections for VTOL tailsitter attitude and rates
@@ -41,32 +53,11 @@ def tailsitter_orientation(ulog, vtol_states):
         yaw_fw[yaw_fw < -180] = yaw_fw[yaw_fw < -180]+360
         yaw_fw = np.deg2rad(yaw_fw)
 
-        # temporary variables for storing VTOL states
-        is_vtol_fw = False
-        fw_start = np.nan
-        fw_end = np.nan
-
-        for i in vtol_states:
-        # states: 1=transition, 2=FW, 3=MC
-        # if in FW mode then used FW conversions
-            if is_vtol_fw:
-                fw_end = i[0]
-                roll[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
-                                roll_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
-                pitch[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
-                                pitch_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
-                yaw[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
-                                yaw_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
-                is_vtol_fw = False
-            if i[1] == 2:
-                fw_start = i[0]
-                is_vtol_fw = True
-
-        # if flight ended as FW, convert the final data segment to FW
-        if is_vtol_fw:
-            roll[quat_t > fw_start] = roll_fw[quat_t > fw_start]
-            pitch[quat_t > fw_start] = pitch_fw[quat_t > fw_start]
-            yaw[quat_t > fw_start] = yaw_fw[quat_t > fw_start]
+        # if in FW mode then use FW conversions
+        is_vtol_fw = _get_fw_samples(vtol_states, quat_t)
+        roll[is_vtol_fw] = roll_fw[is_vtol_fw]
+        pitch[is_vtol_fw] = pitch_fw[is_vtol_fw]
+        yaw[is_vtol_fw] = yaw_fw[is_vtol_fw]
 
         vtol_attitude = {'roll': roll, 'pitch': pitch, 'yaw': yaw}
 
@@ -84,29 +75,10 @@ def tailsitter_orientation(ulog, vtol_states):
         # fw rates and setpoints(roll and yaw swap, roll is negative axis)
         w_r_fw = w_y*-1
         w_y_fw = w_r*1 # *1 to get python to copy not reference
-        # temporary variables for storing VTOL states
-        is_vtol_fw = False
-        fw_start = np.nan
-        fw_end = np.nan
-
-        for i in vtol_states:
-        # states: 1=transition, 2=FW, 3=MC
-        # if in FW mode then used FW conversions
-            if is_vtol_fw:
-                fw_end = i[0]
-                w_r[np.logical_and(w_t > fw_start, w_t < fw_end)] = \
-                                w_r_fw[np.logical_and(w_t > fw_start, w_t < fw_end)]
-                w_y[np.logical_and(w_t > fw_start, w_t < fw_end)] = \
-                                w_y_fw[np.logical_and(w_t > fw_start, w_t < fw_end)]
-                is_vtol_fw = False
-            if i[1] == 2:
-                fw_start = i[0]
-                is_vtol_fw = True
-
-        # if flight ended as FW, convert the final data segment to FW
-        if is_vtol_fw:
-            w_r[quat_t > fw_start] = w_r_fw[quat_t > fw_start]
-            w_y[quat_t > fw_start] = w_y_fw[quat_t > fw_start]
+        # if in FW mode then use FW conversions
+        is_vtol_fw = _get_fw_samples(vtol_states, w_t)
+        w_r[is_vtol_fw] = w_r_fw[is_vtol_fw]
+        w_y[is_vtol_fw] = w_y_fw[is_vtol_fw]
 
         vtol_rates = {'roll': w_r, 'pitch': w_p, 'yaw': w_y}
 
@@ -127,30 +99,11 @@ def tailsitter_orientation(ulog, vtol_states):
 
         setp_r_fw = setp_y*-1
         setp_y_fw = setp_r*1
-        # temporary variables for storing VTOL states
-
-        is_vtol_fw = False
-        fw_start = np.nan
-        fw_end = np.nan
-
-        for i in vtol_states:
-        # states: 1=transition, 2=FW, 3=MC
-        # if in FW mode then used FW conversions
-            if is_vtol_fw:
-                fw_end = i[0]
-                setp_r[np.logical_and(w_t > fw_start, w_t < fw_end)] = \
-                                setp_r_fw[np.logical_and(w_t > fw_start, w_t < fw_end)]
-                setp_y[np.logical_and(w_t > fw_start, w_t < fw_end)] = \
-                                setp_y_fw[np.logical_and(w_t > fw_start, w_t < fw_end)]
-                is_vtol_fw = False
-            if i[1] == 2:
-                fw_start = i[0]
-                is_vtol_fw = True
-
-        # if flight ended as FW, convert the final data segment to FW
-        if is_vtol_fw:
-            setp_r[quat_t > fw_start] = setp_r_fw[quat_t > fw_start]
-            setp_y[quat_t > fw_start] = setp_y_fw[quat_t > fw_start]
+
+        # if in FW mode then use FW conversions
+        is_vtol_fw = _get_fw_samples(vtol_states, w_t)
+        setp_r[is_vtol_fw] = setp_r_fw[is_vtol_fw]
+        setp_y[is_vtol_fw] = setp_y_fw[is_vtol_fw]
 
         vtol_rates_setpoint = {'roll': setp_r, 'pitch': setp_p, 'yaw': setp_y}
 
@@ -12,6 +12,9 @@ import datetime
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename, get_overview_img_filepath
 from plot_app.helper import get_log_filename
+from plot_app.log_parameters import delete_log_parameters
+from plot_app.log_search import delete_log_search_entry
+from plot_app.log_statistics import delete_log_statistics
 
 
 parser = argparse.ArgumentParser(description='Remove old log files & DB entries')
@@ -82,6 +85,9 @@ with con:
     for log_id in log_ids_to_remove:
         print('Removing '+log_id)
         # db entry
+        delete_log_statistics(cur, log_id)
+        delete_log_search_entry(cur, log_id)
+        delete_log_parameters(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         num_deleted = cur.rowcount
@@ -5,11 +5,286 @@
 import sqlite3 as lite
 import sys
 import os
+import argparse
+import datetime
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename, get_log_filepath, \
     get_cache_filepath, get_kml_filepath, get_overview_img_filepath
+from plot_app.log_search import LOGS_SEARCH_TABLE_SQL, rebuild_log_search_index
+from plot_app.log_statistics import STATISTICS_TABLES_SQL, STATISTICS_CHANGES_TABLE_SQL, \
+    rebuild_log_statistics
+from plot_app.ingest_jobs import INGEST_JOBS_TABLE_SQL, INGEST_JOBS_INDEX_SQL, \
+    INGEST_MANIFEST_TABLE_SQL, INGEST_MANIFEST_INDEX_SQL
+from plot_app.upload_sessions import UPLOAD_SESSIONS_TABLE_SQL, \
+    UPLOAD_SESSION_RANGES_TABLE_SQL, UPLOAD_SESSION_RANGES_INDEX_SQL
+from plot_app.backfill_failures import BACKFILL_FAILURES_TABLE_SQL, \
+    BACKFILL_FAILURES_INDEX_SQL, UNLISTED_LOG_IDS_SQL
+from plot_app.flight_summary import FLIGHT_SUMMARY_COLUMNS
+from plot_app.log_parameters import LOG_PARAMETERS_TABLE_SQL, LOG_PARAMETERS_NAME_INDEX_SQL, \
+    get_log_parameter_query
+
+
+parser = argparse.ArgumentParser(description='Create or upgrade the DB')
+parser.add_argument('--check-query-plans', action='store_true', default=False,
+                    help='Check that the hot queries (browse, dbinfo, statistics) '
+                    'use indexes, exit with an error otherwise')
+
+args = parser.parse_args()
+
+
+def _create_query_indexes(cur):
+    """ indexes for the columns used in the browse, dbinfo & statistics queries """
+    # public log listing ordered by date (browse, dbinfo, statistics). Source
+    # is part of it to filter out the CI logs without a table lookup
+    cur.execute("CREATE INDEX IF NOT EXISTS Logs_Public_Date_Source ON Logs (Public, Date, Source)")
+    # CI log count & pruning of old logs of a certain source
+    cur.execute("CREATE INDEX IF NOT EXISTS Logs_Source_Date ON Logs (Source, Date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS LogsGenerated_StartTime ON LogsGenerated (StartTime)")
+    cur.execute("CREATE INDEX IF NOT EXISTS LogsGenerated_UUID ON LogsGenerated (UUID)")
+
+
+def _create_statistics_tables(cur):
+    """ materialized statistics tables for the statistics page """
+    for table_sql in STATISTICS_TABLES_SQL:
+        cur.execute(table_sql)
+    print('Building the statistics tables')
+    num_logs = rebuild_log_statistics(cur)
+    print('Added {} public logs to the statistics'.format(num_logs))
+
+
+def _create_ingest_jobs_table(cur):
+    """ queue for the background ingestion of uploaded logs """
+    cur.execute(INGEST_JOBS_TABLE_SQL)
+    cur.execute(INGEST_JOBS_INDEX_SQL)
+
+
+def _create_ingest_manifest_table(cur):
+    """ files ingested by ingest_logs.py """
+    cur.execute(INGEST_MANIFEST_TABLE_SQL)
+    cur.execute(INGEST_MANIFEST_INDEX_SQL)
+
+
+def _create_sha256_index(cur):
+    """ lookup of uploaded files by content (the hash of older logs is NULL) """
+    cur.execute("PRAGMA table_info('Logs')")
+    if 'Sha256' not in [x[1] for x in cur.fetchall()]:
+        cur.execute("ALTER TABLE Logs ADD COLUMN Sha256 TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS Logs_Sha256 ON Logs (Sha256)")
+
+
+def _create_upload_sessions_tables(cur):
+    """ sessions & received byte ranges of resumable uploads """
+    cur.execute(UPLOAD_SESSIONS_TABLE_SQL)
+    cur.execute(UPLOAD_SESSION_RANGES_TABLE_SQL)
+    cur.execute(UPLOAD_SESSION_RANGES_INDEX_SQL)
+
+
+def _create_log_parameters_table(cur):
+    """ parameters of the logs (filled at ingestion, or on the first parameter
+    download for existing logs) """
+    cur.execute(LOG_PARAMETERS_TABLE_SQL)
+
+
+def _create_log_parameters_index(cur):
+    """ lookup of a parameter over all logs (/parameters) """
+    cur.execute(LOG_PARAMETERS_NAME_INDEX_SQL)
+
+
+def _create_uuid_start_time_index(cur):
+    """ logs of a vehicle by start time (parameter queries of vehicles). Replaces
+    the UUID index. """
+    cur.execute("CREATE INDEX IF NOT EXISTS LogsGenerated_UUID_StartTime "
+                "ON LogsGenerated (UUID, StartTime)")
+    cur.execute("DROP INDEX IF EXISTS LogsGenerated_UUID")
+
+
+def _mark_stored_log_parameters(cur):
+    """ set LogsGenerated.ParametersStored for the logs that have their
+    parameters stored already """
+    cur.execute("PRAGMA table_info('LogsGenerated')")
+    if 'ParametersStored' not in [x[1] for x in cur.fetchall()]:
+        cur.execute("ALTER TABLE LogsGenerated ADD COLUMN ParametersStored INT DEFAULT 0")
+    cur.execute("UPDATE LogsGenerated SET ParametersStored = 1 "
+                "WHERE Id IN (SELECT DISTINCT LogId FROM LogParameters)")
+
+
+def _add_upload_session_writers(cur):
+    """ number of PUT requests writing to the file of an upload session """
+    cur.execute("PRAGMA table_info('UploadSessions')")
+    if 'Writers' not in [x[1] for x in cur.fetchall()]:
+        cur.execute("ALTER TABLE UploadSessions ADD COLUMN Writers INT DEFAULT 0")
+
+
+def _add_search_date_rating(cur):
+    """ the browse page search also matches the upload date & the rating """
+    cur.execute("PRAGMA table_info('LogsSearch')")
+    if 'Date' not in [x[1] for x in cur.fetchall()]:
+        cur.execute("DROP TABLE LogsSearch")
+        cur.execute(LOGS_SEARCH_TABLE_SQL)
+        print('Rebuilding the search index')
+        num_indexed = rebuild_log_search_index(cur)
+        print('Indexed {} logs'.format(num_indexed))
+
+
+def _add_ingest_job_crashes(cur):
+    """ process pool & number of crashed runs of the ingestion jobs (a job
+    fails after MAX_INGEST_CRASHES crashes) """
+    cur.execute("PRAGMA table_info('IngestJobs')")
+    column_names = [x[1] for x in cur.fetchall()]
+    if 'Worker' not in column_names:
+        cur.execute("ALTER TABLE IngestJobs ADD COLUMN Worker TEXT DEFAULT ''")
+    if 'Crashes' not in column_names:
+        cur.execute("ALTER TABLE IngestJobs ADD COLUMN Crashes INT DEFAULT 0")
+
+
+def _create_backfill_failures_table(cur):
+    """ logs for which the backfill failed (shared by the server processes) """
+    cur.execute(BACKFILL_FAILURES_TABLE_SQL)
+    cur.execute(BACKFILL_FAILURES_INDEX_SQL)
+
+
+def _add_flight_summary_columns(cur):
+    """ flight summary of the logs (computed by the backfill for existing logs,
+    see SummaryVersion) """
+    cur.execute("PRAGMA table_info('LogsGenerated')")
+    column_names = [x[1] for x in cur.fetchall()]
+    if 'SummaryVersion' not in column_names:
+        cur.execute("ALTER TABLE LogsGenerated ADD COLUMN SummaryVersion INT DEFAULT 0")
+    for _, column in FLIGHT_SUMMARY_COLUMNS:
+        if column not in column_names:
+            cur.execute("ALTER TABLE LogsGenerated ADD COLUMN "+column+" REAL")
+
+
+def _create_public_date_index(cur):
+    """ public logs ordered by date & rowid (dbinfo pages). The index contains
+    the rowid after Date, unlike Logs_Public_Date_Source, so the order needs
+    no sort. """
+    cur.execute("CREATE INDEX IF NOT EXISTS Logs_Public_Date ON Logs (Public, Date)")
+
+
+def _create_statistics_changes_table(cur):
+    """ change count of the statistics (shared by the server processes) """
+    cur.execute(STATISTICS_CHANGES_TABLE_SQL)
+    cur.execute("INSERT OR IGNORE INTO StatisticsChanges (Id, Count) values (0, 0)")
+
+
+# DB schema migrations: list of (version, description, method(cursor)).
+# Migrations are applied in order, once (the SchemaVersion table stores the
+# applied versions), but they must still be idempotent as the tables might
+# have been upgraded manually. Only ever append to this list.
+MIGRATIONS = [
+    (1, 'Indexes for hot query columns', _create_query_indexes),
+    (2, 'Daily statistics tables', _create_statistics_tables),
+    (3, 'Ingestion job queue', _create_ingest_jobs_table),
+    (4, 'Ingestion manifest of ingest_logs.py', _create_ingest_manifest_table),
+    (5, 'Index for upload deduplication', _create_sha256_index),
+    (6, 'Resumable upload sessions', _create_upload_sessions_tables),
+    (7, 'Log parameters table', _create_log_parameters_table),
+    (8, 'Index for parameter queries', _create_log_parameters_index),
+    (9, 'Index for parameter queries of vehicles', _create_uuid_start_time_index),
+    (10, 'Mark the logs with stored parameters', _mark_stored_log_parameters),
+    (11, 'Writers of resumable upload sessions', _add_upload_session_writers),
+    (12, 'Date & rating in the search index', _add_search_date_rating),
+    (13, 'Crash count of ingestion jobs', _add_ingest_job_crashes),
+    (14, 'Failures of the LogsGenerated backfill', _create_backfill_failures_table),
+    (15, 'Flight summary columns', _add_flight_summary_columns),
+    (16, 'Index for the dbinfo order', _create_public_date_index),
+    (17, 'Change count of the statistics', _create_statistics_changes_table),
+]
+
+
+def get_schema_version(cur):
+    """ get the current DB schema version (0 if no migration was applied yet) """
+    cur.execute("CREATE TABLE IF NOT EXISTS SchemaVersion("
+                "Version INTEGER, "
+                "Description TEXT, "
+                "Date TIMESTAMP, " # date & time when applied
+                "CONSTRAINT Version_PK PRIMARY KEY (Version))")
+    cur.execute("SELECT max(Version) FROM SchemaVersion")
+    version = cur.fetchone()[0]
+    return 0 if version is None else version
+
+
+def check_query_plans(cur):
+    """
+    run EXPLAIN QUERY PLAN on the queries that are executed for every browse,
+    dbinfo and statistics page request (and the parameter queries), and check
+    that they do not do a full table scan (or sort) of the logs.
+    Keep the queries in sync with the request handlers.
+    :return: True if all checks passed
+    """
+    public_logs = 'WHERE Logs.Public = 1 AND NOT Logs.Source = "CI" '
+    listed_logs = public_logs+'AND Logs.Id NOT IN ('+UNLISTED_LOG_IDS_SQL+') '
+    # list of (name, query, parameters, whether the plan must not sort)
+    queries = [
+        ('browse count',
+         'SELECT count(*) FROM Logs '+public_logs, [], False),
+        ('browse count of unlisted logs',
+         'SELECT count(*) FROM ('+UNLISTED_LOG_IDS_SQL+') AS Unlisted CROSS JOIN Logs '
+         +public_logs+'AND Logs.Id = Unlisted.Id', [], False),
+        ('browse page',
+         'SELECT Logs.Id, Logs.Date, Logs.Description, LogsGenerated.* FROM Logs '
+         '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+         +listed_logs+'ORDER BY Date DESC LIMIT ? OFFSET ?', [100, 0], True),
+        ('dbinfo',
+         'SELECT Logs.Id, Logs.Date, Vehicle.Name, LogsGenerated.* FROM Logs '
+         '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+         '   LEFT JOIN Vehicle on LogsGenerated.UUID=Vehicle.UUID '
+         +listed_logs+'ORDER BY Logs.Date DESC, Logs.rowid DESC LIMIT ? OFFSET ?',
+         [200, 0], True),
+        ('dbinfo next page',
+         'SELECT Logs.Id, Logs.Date, Vehicle.Name, LogsGenerated.* FROM Logs '
+         '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+         '   LEFT JOIN Vehicle on LogsGenerated.UUID=Vehicle.UUID '
+         +listed_logs+'AND Logs.Date <= ? AND (Logs.Date < ? OR Logs.rowid < ?) '
+         'ORDER BY Logs.Date DESC, Logs.rowid DESC LIMIT ?', ['', '', 0, 200], True),
+        ('statistics CI count',
+         "select count(Id) from Logs where Source = 'CI'", [], False),
+        ('statistics upload dates',
+         'select Interval, NumLogs from StatisticsUploads '
+         'where Public = 1 order by Interval', [], True),
+        ('statistics daily',
+         'select Day, Name, NumFlights, Duration from StatisticsDaily '
+         "where Category = ? and Day > date('now', '-90 day') order by Day", ['board'], True),
+        ('statistics boards',
+         'select Hardware, UUID, min(Day) from StatisticsBoards '
+         "where Day > date('now', '-90 day') group by Hardware, UUID", [], False),
+        ('generated data',
+         'select * from LogsGenerated where Id = ?', [''], False),
+        ('log parameters',
+         'SELECT Name, Value, SystemDefault, AirframeDefault FROM LogParameters '
+         'WHERE LogId = ?', [''], False),
+        ]
+    # parameter queries (/parameters) with the different filters
+    for filter_name, filters in [('all logs', {}), ('logs', {'log_ids': ['', '']}),
+                                 ('vehicles', {'uuids': ['', '']}),
+                                 ('time window', {'start_time': 0, 'end_time': 1}),
+                                 ('vehicles & time window',
+                                  {'uuids': [''], 'start_time': 0, 'end_time': 1})]:
+        for count_values in [False, True]:
+            query, params = get_log_parameter_query('MC_ROLLRATE_P', **filters,
+                                                    count_values=count_values)
+            queries.append(('parameter {}: {}'.format(
+                'value count' if count_values else 'query', filter_name),
+                            query, params, False))
+
+    all_passed = True
+    for name, query, params, must_not_sort in queries:
+        cur.execute('EXPLAIN QUERY PLAN '+query, params)
+        details = [db_tuple[3] for db_tuple in cur.fetchall()]
+        problems = [detail for detail in details
+                    if detail in ('SCAN Logs', 'SCAN LogsGenerated', 'SCAN StatisticsDaily',
+                                  'SCAN StatisticsBoards', 'SCAN LogParameters') or
+                    (must_not_sort and detail.startswith('USE TEMP B-TREE FOR'))]
+        print('{}: {}'.format('FAIL' if problems else 'OK', name))
+        for detail in details:
+            print('    '+detail)
+        if problems:
+            all_passed = False
+    return all_passed
+
 
 log_dir = get_log_filepath()
 if not os.path.exists(log_dir):
@@ -33,6 +308,9 @@ if not os.path.exists(cur_dir):
 
 print('creating DB at '+get_db_filename())
 con = lite.connect(get_db_filename())
+# write-ahead logging, so that readers are not blocked during uploads
+# (this is persistent, see also plot_app/db_connection.py)
+con.execute('PRAGMA journal_mode = WAL')
 with con:
     cur = con.cursor()
 
@@ -59,6 +337,7 @@ with con:
                 "ErrorLabels TEXT, " # the type of error (if any) that occurred during flight
                 "Public INT, " # if 1 this log can be publicly listed
                 "Token TEXT, " # Security token (currently used to delete the entry)
+                "Sha256 TEXT, " # hex digest of the log file (for deduplication)
                 "CONSTRAINT Id_PK PRIMARY KEY (Id))")
     else:
         # try to upgrade
@@ -112,6 +391,9 @@ with con:
                 "UUID TEXT, " # vehicle UUID (sys_uuid in log)
                 "FlightModeDurations TEXT, " # comma-separated list of <flight_mode_int>:<duration_sec>
                 "StartTime INT, " #UTC Timestap from GPS log (useful when uploading multiple logs)
+                "SummaryVersion INT DEFAULT 0, " # version of the flight summary columns (0: not computed)
+                "ParametersStored INT DEFAULT 0, " # 1 if the LogParameters are stored (a log can have none)
+                + "".join(column+" REAL, " for _, column in FLIGHT_SUMMARY_COLUMNS) + # flight summary
                 "CONSTRAINT Id_PK PRIMARY KEY (Id))")
 
     else:
@@ -144,5 +426,31 @@ with con:
                 "FlightTime INTEGER, " # latest flight time in seconds
                 "CONSTRAINT UUID_PK PRIMARY KEY (UUID))")
 
+
+    # LogsSearch table (full-text search index over Logs & LogsGenerated)
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'LogsSearch'")
+    if cur.fetchone() is None:
+        cur.execute(LOGS_SEARCH_TABLE_SQL)
+        print('Building the search index')
+        num_indexed = rebuild_log_search_index(cur)
+        print('Indexed {} logs'.format(num_indexed))
+
+    con.commit()
+
+    # versioned migrations
+    schema_version = get_schema_version(cur)
+    for version, description, migration in MIGRATIONS:
+        if version > schema_version:
+            print('Applying migration {}: {}'.format(version, description))
+            migration(cur)
+            cur.execute('INSERT INTO SchemaVersion (Version, Description, Date) '
+                        'values (?, ?, ?)', [version, description, datetime.datetime.now()])
+            con.commit()
+
+    if args.check_query_plans:
+        if not check_query_plans(cur):
+            con.close()
+            sys.exit(1)
+
 con.close()
 
@@ -0,0 +1,157 @@
+"""
+Background generation of missing LogsGenerated DB entries (and flight
+summaries & stored parameters) & the admin handler to monitor it
+"""
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import threading
+import tornado.web
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from backfill_failures import RECENT_BACKFILL_FAILURES_SQL, set_backfill_failure, \
+    delete_backfill_failure, get_backfill_failures
+from config import get_backfill_worker_threads
+from db_connection import get_db_connection, run_db_task
+from flight_summary import FLIGHT_SUMMARY_VERSION
+from ingest_jobs import is_ingest_job_pending, INGEST_FAILED_IDS_SQL
+
+#pylint: disable=relative-beyond-top-level
+from .auth import AuthMixin
+from .common import generate_db_data_from_log_file
+
+#pylint: disable=abstract-method
+
+_MAX_REPORTED_FAILURES = 20
+
+# The queue is per server process. Different processes might generate the same
+# entry, in which case the second insert is ignored. The failures are stored in
+# the DB (see backfill_failures.py).
+_lock = threading.Lock()
+_executor = None #pylint: disable=invalid-name
+_queued = set() # queued or running log ids
+_running = set()
+_counters = {'done': 0}
+
+
+def _get_executor():
+    """ get the backfill thread pool (created on first use) """
+    global _executor #pylint: disable=global-statement
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_backfill_worker_threads(),
+                                       thread_name_prefix='backfill')
+    return _executor
+
+
+def _generate_db_data(log_id):
+    """ worker: generate the LogsGenerated entry of a log """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        if is_ingest_job_pending(cur, log_id):
+            # the ingestion job generates the entry
+            with _lock:
+                _queued.discard(log_id)
+            return
+        with _lock:
+            _running.add(log_id)
+        try:
+            generate_db_data_from_log_file(log_id)
+            error = None
+        except Exception as e: #pylint: disable=broad-except
+            error = str(e) or type(e).__name__
+            print('Failed to generate DB data for log {}: {}'.format(log_id, error))
+        with _lock:
+            _running.discard(log_id)
+            _queued.discard(log_id)
+            if error is None:
+                _counters['done'] += 1
+        with con: # commits, or rolls back on error
+            if error is None:
+                delete_backfill_failure(cur, log_id)
+            else:
+                set_backfill_failure(cur, log_id, error)
+    finally:
+        cur.close()
+
+
+def request_generated_db_data(log_id):
+    """
+    queue the generation of the LogsGenerated entry of a log, for a listing
+    that does not have it yet (and shows placeholder values instead). The
+    listings do not include the logs for which it failed recently (see
+    backfill_failures.UNLISTED_LOG_IDS_SQL).
+    Can be called from any thread, and repeatedly for the same log.
+    """
+    with _lock:
+        if log_id in _queued:
+            return
+        _queued.add(log_id)
+        _get_executor().submit(_generate_db_data, log_id)
+
+
+def get_backfill_status():
+    """
+    get the state of the backfill queue (of this server process), with the
+    failures of all processes (runs in the DB thread pool)
+    :return: dict
+    """
+    cur = get_db_connection().cursor()
+    num_failures, failures = get_backfill_failures(cur, _MAX_REPORTED_FAILURES)
+    cur.close()
+    with _lock:
+        return {
+            'workers': get_backfill_worker_threads(),
+            'queued': len(_queued) - len(_running),
+            'running': sorted(_running),
+            'done': _counters['done'],
+            'failed': num_failures,
+            'recent_failures': [{'log_id': log_id, 'error': error}
+                                for log_id, error in failures],
+            }
+
+
+def _get_missing_log_ids(skip_recent_failures):
+    """ get the ids of all logs without LogsGenerated entry, (current) flight
+    summary or stored parameters (CI logs & logs with failed ingestion are
+    not listed, so they are ignored). Runs in the DB thread pool
+    :param skip_recent_failures: whether to leave out the logs that failed
+                                 within RETRY_FAILED_AFTER_SEC """
+    sql_where = ''
+    if skip_recent_failures:
+        sql_where = 'AND Logs.Id NOT IN ('+RECENT_BACKFILL_FAILURES_SQL+')'
+    cur = get_db_connection().cursor()
+    cur.execute('SELECT Logs.Id FROM Logs '
+                '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                'WHERE (LogsGenerated.Id IS NULL OR LogsGenerated.SummaryVersion != ? '
+                '       OR LogsGenerated.ParametersStored != 1) '
+                '   AND NOT Logs.Source = "CI" AND Logs.Id NOT IN ('+INGEST_FAILED_IDS_SQL+') '
+                +sql_where, [FLIGHT_SUMMARY_VERSION])
+    log_ids = [db_tuple[0] for db_tuple in cur.fetchall()]
+    cur.close()
+    return log_ids
+
+
+class BackfillHandler(AuthMixin, tornado.web.RequestHandler):
+    """ Admin page for the LogsGenerated backfill: GET returns the progress
+    (JSON), POST queues all logs that are missing the entry (except the
+    recently failed ones) """
+
+    async def get(self, *args, **kwargs):
+        """ GET request """
+        status = await run_db_task(get_backfill_status)
+        status['missing'] = len(await run_db_task(_get_missing_log_ids, False))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(status))
+
+    async def post(self, *args, **kwargs):
+        """ POST request """
+        num_missing = len(await run_db_task(_get_missing_log_ids, False))
+        log_ids = await run_db_task(_get_missing_log_ids, True)
+        for log_id in log_ids:
+            request_generated_db_data(log_id)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'missing': num_missing, 'queued': len(log_ids)}))
@@ -3,160 +3,409 @@ Tornado handler for the upload page
 """
 
 from __future__ import print_function
+import asyncio
 import datetime
 import os
 from html import escape
 import sys
 import uuid
 import binascii
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import traceback
 import zipfile
+import zlib
 import tornado.web
-from tornado.ioloop import IOLoop
 
 from pyulog import ULog
-from pyulog.px4 import PX4ULog
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from db_entry import DBVehicleData, DBData
-from config import get_db_filename, get_http_protocol, get_domain_name, \
-    email_notifications_config
-from helper import get_total_flight_time, validate_url, get_log_filename, \
-    load_ulog_file, get_airframe_name, ULogException
-from overview_generator import generate_overview_img_from_id
+from config import get_http_protocol, get_domain_name, get_ulge_private_key_path
+from db_connection import get_db_connection, run_db_task
+from helper import get_log_filename
+from ingest_jobs import add_ingest_job
+from log_search import update_log_search_entry
+from log_statistics import add_log_upload_statistics
 
 #pylint: disable=relative-beyond-top-level
-from .common import get_jinja_env, CustomHTTPError, generate_db_data_from_log_file, \
-    TornadoRequestHandlerBase
-from .send_email import send_notification_email, send_flightreport_email
-from .multipart_streamer import MultiPartStreamer
+from .common import get_jinja_env, CustomHTTPError, TornadoRequestHandlerBase, \
+    get_duplicate_log_id, LogUploadMixin, DUPLICATE_UPLOAD_MESSAGE
+from .ingest import submit_ingest_job, update_vehicle_db_entry
+from .upload import decrypt_upload
 from.auth import AuthMixin
 
 UPLOAD_TEMPLATE = 'bulk_upload.html'
+UPLOAD_RESULT_TEMPLATE = 'bulk_upload_result.html'
+
+# number of threads that extract the files of an uploaded zip file
+ZIP_EXTRACT_THREADS = 4
+# number of extracted logs that are inserted into the DB per transaction
+ZIP_INSERT_BATCH_SIZE = 50
+ZIP_COPY_BUFFER_SIZE = 1024 * 1024
 
 
 #pylint: disable=attribute-defined-outside-init,too-many-statements, unused-argument
 
-def save_uploaded_log(con,cur,ulog_file,formdict):
+def insert_bulk_log_db_entry(cur, log_id, original_filename, formdict, queue_ingestion=True,
+                             sha256=None, ulog_header=None):
     """
-    Save a log that's already persisted on the filesystem into the database and into a folder we control.
-    :param con: DB connection
+    Insert the Logs entry of a saved log file & queue its ingestion (the caller
+    commits)
     :param cur: DB cursor
-    :param ulog_file: File-like object containing ULog
     :param formdict: Dict of options passed from upload page
-    :param preserve_old_files: (Default False) Whether to leave the persisted copy on disk
-    :return log_id: ID of the newly saved ULog file
+    :param queue_ingestion: whether to add an ingestion job (False if the
+                            caller ingests the log itself)
+    :param sha256: hex digest of the log file
+    :param ulog_header: ULogHeaderParser of the uploaded file, to write the
+                        Vehicle entry right away (not for CI uploads)
     """
-    # generate a log ID and persistence filename
-    while True:
-        log_id = str(uuid.uuid4())
-        new_file_name = get_log_filename(log_id)
-        if not os.path.exists(new_file_name):
-            break
-    # if preserve_old_files:
-    #     print('Copying old file to', new_file_name)
-    #     ulog_file.copy(new_file_name)
-    # else:
-    print('Moving uploaded file to', new_file_name)
-    ulog_file.move(new_file_name)
-    # Load the ulog file but only if not uploaded via CI.
-    ulog = None
-    if formdict['source'] != 'CI':
-        ulog_file_name = get_log_filename(log_id)
-        ulog = load_ulog_file(ulog_file_name)
     # generate a token: secure random string (url-safe)
     token = str(binascii.hexlify(os.urandom(16)), 'ascii')
-    # put additional data into a DB
     cur.execute(
         'insert into Logs (Id, Title, Description, '
         'OriginalFilename, Date, AllowForAnalysis, Obfuscated, '
         'Source, Email, WindSpeed, Rating, Feedback, Type, '
-        'videoUrl, ErrorLabels, Public, Token) values '
-        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-        [log_id, formdict['title'], formdict['description'], ulog_file.get_filename(),
-        datetime.datetime.now(), 1,
-        0, formdict['source'], formdict['email'], formdict['wind_speed'], formdict['rating'],
-        formdict['feedback'], formdict['upload_type'], formdict['video_url'], formdict['error_labels'], formdict['is_public'], token])
-    if ulog is not None:
-        vehicle_data = update_vehicle_db_entry(cur, ulog, log_id, formdict['vehicle_name'])
-        vehicle_name = vehicle_data.name
-    con.commit()
-    generate_db_data_from_log_file(log_id, con)
-    con.commit()
-    return log_id
+        'videoUrl, ErrorLabels, Public, Token, Sha256) values '
+        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [log_id, formdict['title'], formdict['description'], original_filename,
+         datetime.datetime.now(), formdict['allow_for_analysis'],
+         formdict['obfuscated'], formdict['source'], formdict['email'],
+         formdict['wind_speed'], formdict['rating'],
+         formdict['feedback'], formdict['upload_type'], formdict['video_url'],
+         formdict['error_labels'], formdict['is_public'], token, sha256])
+    update_log_search_entry(cur, log_id)
+    add_log_upload_statistics(cur, log_id)
+    if queue_ingestion:
+        ingest_options = {'vehicle_name': formdict['vehicle_name'],
+                          'email': formdict['email'], 'notify': False}
+        if ulog_header is not None and formdict['source'] != 'CI':
+            update_vehicle_db_entry(cur, ulog_header, log_id, formdict['vehicle_name'])
+            ingest_options['vehicle_updated'] = True
+        add_ingest_job(cur, log_id, ingest_options)
+
+
+def generate_log_id():
+    """ generate a new log ID
+    :return: tuple of (log id, file name where to store the log) """
+    while True:
+        log_id = str(uuid.uuid4())
+        new_file_name = get_log_filename(log_id)
+        if not os.path.exists(new_file_name):
+            return log_id, new_file_name
 
-def update_vehicle_db_entry(cur, ulog, log_id, vehicle_name):
+
+def save_uploaded_log(con, cur, ulog_file, formdict):
     """
-    Update the Vehicle DB entry
+    Save a log that's already persisted on the filesystem into the database and
+    into a folder we control, and queue its ingestion (see ingest.py). The
+    moved file is removed if the DB entry cannot be stored.
+    :param con: DB connection
     :param cur: DB cursor
-    :param ulog: ULog object
-    :param vehicle_name: new vehicle name or '' if not updated
-    :return vehicle_data: DBVehicleData object
+    :param ulog_file: File-like object containing ULog (ULogStreamedPart)
+    :param formdict: Dict of options passed from upload page
+    :return log_id: ID of the newly saved ULog file
     """
+    log_id, new_file_name = generate_log_id()
+    print('Moving uploaded file to', new_file_name)
+    ulog_file.move(new_file_name)
+    try:
+        insert_bulk_log_db_entry(cur, log_id, ulog_file.get_filename(), formdict,
+                                 sha256=ulog_file.get_sha256(),
+                                 ulog_header=ulog_file.ulog_header)
+        con.commit()
+    except Exception:
+        con.rollback()
+        os.remove(new_file_name)
+        raise
+    return log_id
 
-    vehicle_data = DBVehicleData()
-    if 'sys_uuid' in ulog.msg_info_dict:
-        vehicle_data.uuid = escape(ulog.msg_info_dict['sys_uuid'])
-
-        if vehicle_name == '':
-            cur.execute('select Name '
-                        'from Vehicle where UUID = ?', [vehicle_data.uuid])
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                vehicle_data.name = db_tuple[0]
-            print('reading vehicle name from db:'+vehicle_data.name)
-        else:
-            vehicle_data.name = vehicle_name
-            print('vehicle name from uploader:'+vehicle_data.name)
-
-        vehicle_data.log_id = log_id
-        flight_time = get_total_flight_time(ulog)
-        if flight_time is not None:
-            vehicle_data.flight_time = flight_time
-
-        # update or insert the DB entry
-        cur.execute('insert or replace into Vehicle (UUID, LatestLogId, Name, FlightTime)'
-                    'values (?, ?, ?, ?)',
-                    [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
-                     vehicle_data.flight_time])
-    return vehicle_data
+
+def save_decrypted_log(log_id, original_filename, formdict, sha256, ulog_header):
+    """
+    Save a decrypted .ulge upload, which is already stored as the file of
+    log_id, into the database and queue its ingestion (runs in the DB thread
+    pool). The file is removed if it is a duplicate or cannot be saved.
+    :param sha256: hex digest of the decrypted file
+    :param ulog_header: ULogHeaderParser of the decrypted file
+    :return: tuple of (log id, whether it is a duplicate of an existing log)
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        duplicate_log_id = get_duplicate_log_id(cur, sha256, formdict['is_public'],
+                                                formdict['source'])
+        if duplicate_log_id is not None:
+            print('Upload of {} is a duplicate of log {}'.format(
+                original_filename, duplicate_log_id))
+            os.remove(get_log_filename(log_id))
+            return duplicate_log_id, True
+        try:
+            with con: # commits, or rolls back on error
+                insert_bulk_log_db_entry(cur, log_id, original_filename, formdict,
+                                         sha256=sha256, ulog_header=ulog_header)
+        except Exception:
+            os.remove(get_log_filename(log_id))
+            raise
+    finally:
+        cur.close()
+    submit_ingest_job(log_id)
+    return log_id, False
+
+
+def _extract_zip_entry(zip_file_name, entry_name):
+    """
+    Extract a ULog file from a zip file into the log folder. The entry is
+    streamed to its final location (and hashed) and the ULog header is checked.
+    Runs in parallel: each call opens the zip file itself.
+    :return: tuple of (log id or None, SHA-256 hex digest, error message or '')
+    """
+    log_id, new_file_name = generate_log_id()
+    sha256 = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(zip_file_name) as zip_file, \
+                zip_file.open(entry_name) as entry, \
+                open(new_file_name, 'wb') as output_file:
+            data = entry.read(len(ULog.HEADER_BYTES))
+            if data != ULog.HEADER_BYTES:
+                raise ValueError('Not a ULog file')
+            while len(data) > 0:
+                sha256.update(data)
+                output_file.write(data)
+                data = entry.read(ZIP_COPY_BUFFER_SIZE)
+    except (ValueError, OSError, EOFError, zipfile.BadZipFile, zlib.error) as e:
+        if os.path.exists(new_file_name):
+            os.remove(new_file_name)
+        return None, None, str(e) or type(e).__name__
+    return log_id, sha256.hexdigest(), ''
+
+
+def _get_zip_entry_names(zip_file_name):
+    """ get the names of the files in a zip file """
+    with zipfile.ZipFile(zip_file_name) as zip_file:
+        return [entry.filename for entry in zip_file.infolist() if not entry.is_dir()]
+
+
+def _remove_log_files(log_ids):
+    """ remove the files of logs that were not stored in the DB """
+    for log_id in log_ids:
+        file_name = get_log_filename(log_id)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def insert_zip_batch(batch, original_filename, formdict):
+    """
+    Insert a batch of logs extracted from a zip file in one transaction & queue
+    their ingestion (runs in the DB thread pool). A log that cannot be
+    inserted is skipped (the others are still stored). The extracted files
+    that are not stored are removed.
+    :param batch: list of (log id, SHA-256 hex digest) of the extracted files
+    :param original_filename: file name of the zip file
+    :param formdict: Dict of options passed from upload page
+    :return: list of (log id or None, error message or '') per log of the
+             batch. For a duplicate file, the log id is the one of the existing
+             log (with DUPLICATE_UPLOAD_MESSAGE).
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    results = []
+    try:
+        with con: # commits, or rolls back on error
+            # the savepoints need an explicit transaction (releasing the
+            # outermost savepoint would commit)
+            cur.execute('BEGIN')
+            for log_id, sha256 in batch:
+                # an error only rolls back the entry of this log
+                cur.execute('SAVEPOINT zip_entry')
+                try:
+                    duplicate_log_id = get_duplicate_log_id(
+                        cur, sha256, formdict['is_public'], formdict['source'])
+                    if duplicate_log_id is not None:
+                        results.append((duplicate_log_id, DUPLICATE_UPLOAD_MESSAGE))
+                    else:
+                        insert_bulk_log_db_entry(cur, log_id, original_filename, formdict,
+                                                 sha256=sha256)
+                        results.append((log_id, ''))
+                except sqlite3.Error as error:
+                    print('Failed to insert log {} of {}: {}'.format(
+                        log_id, original_filename, error))
+                    cur.execute('ROLLBACK TO zip_entry')
+                    results.append((None, 'Failed to store the log: {}'.format(error)))
+                cur.execute('RELEASE zip_entry')
+    except sqlite3.Error as error:
+        print('Failed to insert the logs of {}: {}'.format(original_filename, error))
+        _remove_log_files([log_id for log_id, _ in batch])
+        return [(None, 'Failed to store the log: {}'.format(error))] * len(batch)
+    except Exception:
+        _remove_log_files([log_id for log_id, _ in batch])
+        raise
+    finally:
+        cur.close()
+
+    # the files of duplicates (& failed logs) are not needed
+    _remove_log_files([log_id for (log_id, _), (result_log_id, _) in zip(batch, results)
+                       if result_log_id != log_id])
+    for (log_id, _), (result_log_id, _) in zip(batch, results):
+        if result_log_id == log_id:
+            submit_ingest_job(log_id)
+    return results
+
+
+async def save_uploaded_zip(ulog_file, formdict):
+    """
+    Extract & save all ULog files in an uploaded zip file into the database
+    and into a folder we control, and submit their ingestion.
+    The files are extracted in parallel by a separate thread pool, only the
+    inserts (in batches) run in the DB thread pool. A file that cannot be
+    extracted or stored is reported and skipped.
+    :param ulog_file: uploaded zip file (MultiPartStreamer part)
+    :param formdict: Dict of options passed from upload page
+    :return: list of (file name in the zip, log id or None, error message or
+             '') tuples, in the order of the zip file (see insert_zip_batch)
+    """
+    zip_file_name = ulog_file.f_out.name
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=ZIP_EXTRACT_THREADS)
+    extract_futures = {} # entry name -> future, until it is awaited
+    batch = [] # (log id, sha256) of the extracted logs that are not inserted yet
+    try:
+        entry_names = await loop.run_in_executor(executor, _get_zip_entry_names,
+                                                 zip_file_name)
+        for entry_name in entry_names:
+            # make sure we're dealing with a ulog file (the content is
+            # checked when extracting)
+            _, ext = os.path.splitext(entry_name)
+            if ext not in ['.ulg', '.ulog']:
+                print(f'Skipping extracting non-ULog file {zip_file_name}//{entry_name}')
+                continue
+            extract_futures[entry_name] = executor.submit(
+                _extract_zip_entry, zip_file_name, entry_name)
+
+        results = []
+        batch_indexes = [] # indexes into results
+        async def insert_batch():
+            """ insert the extracted logs of the batch (insert_zip_batch
+            removes the files that it does not store) """
+            batch_logs = list(batch)
+            batch_result_indexes = list(batch_indexes)
+            batch.clear()
+            batch_indexes.clear()
+            batch_results = await run_db_task(insert_zip_batch, batch_logs,
+                                              ulog_file.get_filename(), formdict)
+            for result_index, (log_id, error) in zip(batch_result_indexes, batch_results):
+                results[result_index] = (results[result_index][0], log_id, error)
+
+        for entry_name in entry_names:
+            if entry_name not in extract_futures:
+                results.append((entry_name, None, 'Skipped (not a .ulg file)'))
+                continue
+            log_id, sha256, error = await asyncio.wrap_future(extract_futures[entry_name])
+            del extract_futures[entry_name]
+            results.append((entry_name, log_id, error))
+            if log_id is None:
+                print(f'Failed to extract {zip_file_name}//{entry_name}: {error}')
+                continue
+            batch.append((log_id, sha256))
+            batch_indexes.append(len(results) - 1)
+            if len(batch) == ZIP_INSERT_BATCH_SIZE:
+                await insert_batch()
+        if len(batch) > 0:
+            await insert_batch()
+    finally:
+        # do not block the IOLoop (the futures are all done, unless on error)
+        executor.shutdown(wait=False, cancel_futures=True)
+        # on error: remove the extracted files that were not stored
+        unstored_log_ids = [log_id for log_id, _ in batch]
+        running_futures = [future for future in extract_futures.values()
+                           if not future.cancelled()]
+        if len(running_futures) > 0:
+            await asyncio.wait([asyncio.wrap_future(future) for future in running_futures])
+        for future in running_futures:
+            if future.exception() is None and future.result()[0] is not None:
+                unstored_log_ids.append(future.result()[0])
+        _remove_log_files(unstored_log_ids)
+    return results
+
+
+def save_uploaded_file(ulog_file, formdict):
+    """
+    Save an uploaded ULog file & submit the ingestion (runs in the DB thread
+    pool).
+    :param ulog_file: uploaded file (MultiPartStreamer part)
+    :param formdict: Dict of options passed from upload page
+    :return: tuple of (ID of the saved ULog file, whether it is a duplicate of
+             an existing log)
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        # the same file was uploaded before: return the existing log
+        duplicate_log_id = get_duplicate_log_id(cur, ulog_file.get_sha256(),
+                                                formdict['is_public'], formdict['source'])
+        if duplicate_log_id is not None:
+            print('Upload of {} is a duplicate of log {}'.format(
+                ulog_file.get_filename(), duplicate_log_id))
+            return duplicate_log_id, True
+        log_id = save_uploaded_log(con, cur, ulog_file, formdict)
+        submit_ingest_job(log_id)
+        return log_id, False
+    finally:
+        # discard uncommitted changes on error (the connection is shared)
+        con.rollback()
+        cur.close()
+
+
+def get_upload_formdict(form_data):
+    """
+    get the upload options of the DB entries from the form values of an upload
+    :param form_data: dict of form values (bytes), see MultiPartStreamer.get_values
+    :return: formdict (see insert_bulk_log_db_entry)
+    """
+    description = escape(form_data['description'].decode("utf-8"))
+    email = form_data.get('email', bytes("(no email provided)", 'utf-8')).decode("utf-8")
+    upload_type = form_data.get('type', bytes("personal", 'utf-8')).decode("utf-8")
+    source = form_data.get('source', bytes("webui", 'utf-8')).decode("utf-8")
+    title = '' # may be used in future...
+    obfuscated = {'true': 1, 'false': 0}.get(form_data.get('obfuscated', b'false').decode('utf-8'), 0)
+    allow_for_analysis = {'true': 1, 'false': 0}.get(form_data.get('allowForAnalysis', b'false').decode('utf-8'), 0)
+    feedback = escape(form_data.get('feedback', b'').decode("utf-8"))
+
+    wind_speed = -1
+    rating = ''
+    video_url = ''
+    is_public = 1
+    vehicle_name = escape(form_data.get('vehicleName', bytes("", 'utf-8')).decode("utf-8"))
+    error_labels = ''
+
+    # TODO: make the format of formdict a little more compatible with form_data above
+    formdict = {}
+    formdict['description'] = description
+    formdict['email'] = email
+    formdict['upload_type'] = upload_type
+    formdict['source'] = source
+    formdict['title'] = title
+    formdict['obfuscated'] = obfuscated
+    formdict['allow_for_analysis'] = allow_for_analysis
+    formdict['feedback'] = feedback
+    formdict['wind_speed'] = wind_speed
+    formdict['rating'] = rating
+    formdict['video_url'] = video_url
+    formdict['is_public'] = is_public
+    formdict['vehicle_name'] = vehicle_name
+    formdict['error_labels'] = error_labels
+    return formdict
 
 
 @tornado.web.stream_request_body
-class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
+class BulkUploadHandler(LogUploadMixin, AuthMixin, TornadoRequestHandlerBase):
     """ Upload log file Tornado request handler: handles page requests and POST
     data """
 
-    def initialize(self):
-        """ initialize the instance """
-        self.multipart_streamer = None
-
-    def prepare(self):
-        """ called before a new request """
-        super().prepare()
-        if self.request.method.upper() == 'POST':
-            if 'expected_size' in self.request.arguments:
-                self.request.connection.set_max_body_size(
-                    int(self.get_argument('expected_size')))
-            try:
-                total = int(self.request.headers.get("Content-Length", "0"))
-            except KeyError:
-                total = 0
-            self.multipart_streamer = MultiPartStreamer(total)
-
-    def data_received(self, chunk):
-        """ called whenever new data is received """
-        if self.multipart_streamer:
-            self.multipart_streamer.data_received(chunk)
-
-    def get(self, *args, **kwargs):
-        """ GET request callback """
-        template = get_jinja_env().get_template(UPLOAD_TEMPLATE)
-        self.write(template.render())
+    upload_template = UPLOAD_TEMPLATE
 
-    def post(self, *args, **kwargs):
+    async def post(self, *args, **kwargs):
         """ POST request callback """
         if self.multipart_streamer:
             try:
@@ -167,38 +416,8 @@ class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
                      'feedback', 'windSpeed', 'rating', 'videoUrl', 'public',
                      'vehicleName'])
 
-                description = escape(form_data['description'].decode("utf-8"))
-                email = form_data.get('email', bytes("(no email provided)", 'utf-8')).decode("utf-8")
-                upload_type = form_data.get('type', bytes("personal", 'utf-8')).decode("utf-8")
-                source = form_data.get('source', bytes("webui", 'utf-8')).decode("utf-8")
-                title = '' # may be used in future...
-                obfuscated = {'true': 1, 'false': 0}.get(form_data.get('obfuscated', b'false').decode('utf-8'), 0)
-                allow_for_analysis = {'true': 1, 'false': 0}.get(form_data.get('allowForAnalysis', b'false').decode('utf-8'), 0)
-                feedback = escape(form_data.get('feedback', b'').decode("utf-8"))
-
-                wind_speed = -1
-                rating = ''
-                video_url = ''
-                is_public = 1
-                vehicle_name = escape(form_data.get('vehicleName', bytes("", 'utf-8')).decode("utf-8"))
-                error_labels = ''
-
-                # TODO: make the format of formdict a little more compatible with form_data above
-                formdict = {}
-                formdict['description'] = description
-                formdict['email'] = email
-                formdict['upload_type'] = upload_type
-                formdict['source'] = source
-                formdict['title'] = title
-                formdict['obfuscated'] = obfuscated
-                formdict['allow_for_analysis'] = allow_for_analysis
-                formdict['feedback'] = feedback
-                formdict['wind_speed'] = wind_speed
-                formdict['rating'] = rating
-                formdict['video_url'] = video_url
-                formdict['is_public'] = is_public
-                formdict['vehicle_name'] = vehicle_name
-                formdict['error_labels'] = error_labels
+                formdict = get_upload_formdict(form_data)
+                source = formdict['source']
 
                 # we don't bother parsing any of the "flight report" metadata, it's not very useful to us
                 # stored_email = ''
@@ -223,22 +442,29 @@ class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
                 #         if form_data['public'].decode("utf-8") == 'true':
                 #             is_public = 1
 
-                # open the database connection
-                con = sqlite3.connect(get_db_filename())
-                cur = con.cursor()
-
-
                 file_obj = self.multipart_streamer.get_parts_by_name('filearg')[0]
                 upload_file_name = file_obj.get_filename()
 
                 # read file header and ensure validity
-                peek_ulog_header = file_obj.get_payload_partial(len(ULog.HEADER_BYTES))
                 peek_zip_header = file_obj.get_payload_partial(4)
                 zip_headers = [b'\x50\x4b\x03\x04', b'\x50\x4b\x05\x06', b'\x50\x4b\x07\x08']
+                # is the file encrypted (.ulge)? (needs the private key)
+                ulge_key_path = get_ulge_private_key_path()
+                is_encrypted = ulge_key_path and upload_file_name.lower().endswith('.ulge')
                 # we check that it is either a well formed zip or ULog
                 # is file a ULog? then continue as we were :)
-                if (peek_ulog_header == ULog.HEADER_BYTES):
-                    log_id = save_uploaded_log(con, cur, file_obj, formdict)
+                if is_encrypted or file_obj.ulog_header.is_ulog: # parsed while receiving
+                    if is_encrypted:
+                        # decrypted into the log folder
+                        log_id, new_file_name = generate_log_id()
+                        sha256, ulog_header = await decrypt_upload(
+                            file_obj, new_file_name, ulge_key_path)
+                        log_id, is_duplicate = await run_db_task(
+                            save_decrypted_log, log_id, upload_file_name, formdict, sha256,
+                            ulog_header)
+                    else:
+                        log_id, is_duplicate = await run_db_task(
+                            save_uploaded_file, file_obj, formdict)
 
 
                     # generate URL info and redirect
@@ -247,59 +473,28 @@ class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
                     print(full_plot_url)
                     # do not redirect for QGC
                     if source != 'QGroundControl':
-                        self.redirect(url)
+                        if is_duplicate:
+                            # show that the options of this upload were not stored
+                            template = get_jinja_env().get_template(UPLOAD_RESULT_TEMPLATE)
+                            self.write(template.render(
+                                upload_filename=upload_file_name,
+                                results=[(upload_file_name, log_id, DUPLICATE_UPLOAD_MESSAGE)],
+                                num_failed=0, num_duplicates=1))
+                        else:
+                            self.redirect(url)
 
                 # is the file a zip? read the magic numbers and unzip it
                 elif (peek_zip_header in zip_headers):
-                    with zipfile.ZipFile(file_obj.f_out) as zip:
-                        for log_filename in zip.namelist():
-                            # make sure we're dealing with a ulog file
-                            # TODO: do actual validation here, don't just check filename
-                            _, ext = os.path.splitext(log_filename)
-                            if ext not in ['.ulg', '.ulog']:
-                                print(f'Skipping extracting non-ULog file {file_obj.f_out.name}//{log_filename}')
-                                continue
-                            # TODO: switch to save_uploaded_log
-                            # generate a log ID and persistence filename
-                            while True:
-                                log_id = str(uuid.uuid4())
-                                new_file_name = get_log_filename(log_id)
-                                if not os.path.exists(new_file_name):
-                                    break
-                            # extract and rename the ulog file to something we control
-                            print(f'Extracting uploaded log {file_obj.f_out.name}//{log_filename} file to', new_file_name)
-                            zip.extract(log_filename, path = os.path.dirname(new_file_name))
-                            os.rename(os.path.join(os.path.dirname(new_file_name), log_filename), new_file_name)
-                            # Load the ulog file but only if not uploaded via CI.
-                            ulog = None
-                            if source != 'CI':
-                                ulog_file_name = get_log_filename(log_id)
-                                ulog = load_ulog_file(ulog_file_name)
-                            # generate a token: secure random string (url-safe)
-                            token = str(binascii.hexlify(os.urandom(16)), 'ascii')
-                            # put additional data into a DB
-                            cur.execute(
-                                'insert into Logs (Id, Title, Description, '
-                                'OriginalFilename, Date, AllowForAnalysis, Obfuscated, '
-                                'Source, Email, WindSpeed, Rating, Feedback, Type, '
-                                'videoUrl, ErrorLabels, Public, Token) values '
-                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                                [log_id, title, description, upload_file_name,
-                                datetime.datetime.now(), allow_for_analysis,
-                                obfuscated, source, email, wind_speed, rating,
-                                feedback, upload_type, video_url, error_labels, is_public, token])
-                            if ulog is not None:
-                                vehicle_data = update_vehicle_db_entry(cur, ulog, log_id, vehicle_name)
-                                vehicle_name = vehicle_data.name
-                            con.commit()
-                            generate_db_data_from_log_file(log_id, con)
-                            con.commit()
-
-                            # generate URL info and redirect
-                            url = '/plot_app?log='+log_id
-                            full_plot_url = get_http_protocol()+'://'+get_domain_name()+url
-                            print(full_plot_url)
-                        self.redirect('/browse')
+                    try:
+                        results = await save_uploaded_zip(file_obj, formdict)
+                    except zipfile.BadZipFile as e:
+                        raise CustomHTTPError(400, 'Invalid zip file') from e
+                    template = get_jinja_env().get_template(UPLOAD_RESULT_TEMPLATE)
+                    self.write(template.render(
+                        upload_filename=upload_file_name, results=results,
+                        num_failed=sum(log_id is None for _, log_id, _ in results),
+                        num_duplicates=sum(log_id is not None and error != ''
+                                           for _, log_id, error in results)))
                 # is file neither a zip nor a ULog? error out :)
                 else:
                     if upload_file_name[-7:].lower() == '.px4log':
@@ -388,10 +583,6 @@ class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
             except CustomHTTPError:
                 raise
 
-            except ULogException as e:
-                raise CustomHTTPError(
-                    400,
-                    'Failed to parse the file. It is most likely corrupt.') from e
             except Exception as e:
                 print('Fatal error when handling POST data', sys.exc_info()[0],
                       sys.exc_info()[1])
@@ -399,9 +590,6 @@ class BulkUploadHandler(AuthMixin, TornadoRequestHandlerBase):
                 raise CustomHTTPError(500) from e
 
             finally:
-                # close our DB connections
-                cur.close()
-                con.close()
                 # free the uploaded files
                 self.multipart_streamer.release_parts()
 
@@ -12,8 +12,17 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from config import get_upload_deduplication
 from db_entry import DBDataGenerated
-from config import get_db_filename
+from db_connection import get_db_connection
+from flight_summary import get_flight_summary_from_tuple, write_flight_summary
+from log_parameters import write_log_parameters
+from log_search import update_log_search_entry
+from log_statistics import add_log_flight_statistics
+from ulog_header import ULogHeaderParser
+
+#pylint: disable=relative-beyond-top-level
+from .multipart_streamer import MultiPartStreamer, TemporaryFileStreamedPart
 
 #pylint: disable=abstract-method
 
@@ -49,86 +58,180 @@ class TornadoRequestHandlerBase(tornado.web.RequestHandler):
         self.write(html_template.format(status_code=status_code,
                                         error_message=error_message))
 
+class ULogStreamedPart(TemporaryFileStreamedPart):
+    """ streamed part of an upload that also parses the ULog header &
+    definitions as the data arrives (ulog_header attribute). Parsing stops
+    early if the data is not a ULog file. """
+
+    def __init__(self, streamer, headers, tmp_dir=None):
+        super().__init__(streamer, headers, tmp_dir)
+        self.ulog_header = ULogHeaderParser()
+
+    def feed(self, data):
+        """ write the data into the temporary file & parse it """
+        super().feed(data)
+        self.ulog_header.feed(data)
+
+
+class ULogMultiPartStreamer(MultiPartStreamer):
+    """ MultiPartStreamer for log uploads """
+
+    def create_part(self, headers):
+        """ create a ULogStreamedPart """
+        return ULogStreamedPart(self, headers)
+
+
+class LogUploadMixin:
+    """
+    request handler mixin for the log upload pages: serves the page
+    (upload_template) & streams the body of a POST request into a
+    ULogMultiPartStreamer (multipart_streamer attribute). Must come before the
+    other base classes (prepare calls theirs first).
+    """
+    upload_template = None
+
+    def initialize(self):
+        """ initialize the instance """
+        self.multipart_streamer = None
+
+    def prepare(self):
+        """ called before a new request """
+        super().prepare()
+        if self.request.method.upper() == 'POST':
+            if 'expected_size' in self.request.arguments:
+                self.request.connection.set_max_body_size(
+                    int(self.get_argument('expected_size')))
+            try:
+                total = int(self.request.headers.get("Content-Length", "0"))
+            except KeyError:
+                total = 0
+            self.multipart_streamer = ULogMultiPartStreamer(total)
+
+    def data_received(self, chunk):
+        """ called whenever new data is received """
+        if self.multipart_streamer:
+            self.multipart_streamer.data_received(chunk)
+
+    def get(self, *args, **kwargs):
+        """ GET request callback """
+        template = get_jinja_env().get_template(self.upload_template)
+        self.write(template.render())
+
+
+def insert_generated_db_data(cur, log_id, db_data_gen):
+    """
+    Insert the LogsGenerated entry of a log (with the flight summary) & update
+    the search index, the statistics and the stored parameters (the caller
+    commits).
+    :param cur: DB cursor
+    :param db_data_gen: DBDataGenerated object
+    :raise sqlite3.IntegrityError: if the entry exists already
+    """
+    cur.execute(
+        'insert into LogsGenerated (Id, Duration, '
+        'Mavtype, Estimator, AutostartId, Hardware, '
+        'Software, NumLoggedErrors, NumLoggedWarnings, '
+        'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime) values '
+        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [log_id, db_data_gen.duration_s, db_data_gen.mav_type,
+         db_data_gen.estimator, db_data_gen.sys_autostart_id,
+         db_data_gen.sys_hw, db_data_gen.ver_sw,
+         db_data_gen.num_logged_errors,
+         db_data_gen.num_logged_warnings,
+         ','.join(map(str, db_data_gen.flight_modes)),
+         db_data_gen.ver_sw_release, db_data_gen.vehicle_uuid,
+         db_data_gen.flight_mode_durations_str(),
+         db_data_gen.start_time_utc])
+    if db_data_gen.flight_summary is not None:
+        write_flight_summary(cur, log_id, db_data_gen.flight_summary)
+    update_log_search_entry(cur, log_id)
+    add_log_flight_statistics(cur, log_id)
+    if db_data_gen.parameters is not None:
+        write_log_parameters(cur, log_id, db_data_gen.parameters)
+
+
+# shown to the uploader if an upload is a duplicate (see get_duplicate_log_id)
+DUPLICATE_UPLOAD_MESSAGE = 'Uploaded before: the existing log is used, the description ' \
+    'and other details of this upload were not stored'
+
+
+def get_duplicate_log_id(cur, sha256, is_public, source):
+    """
+    get an existing log with the same file content (SHA-256), public flag &
+    source, if upload deduplication is enabled. This is a best effort lookup:
+    the same file uploaded concurrently can still be stored twice.
+    :param cur: DB cursor
+    :param sha256: hex digest of the uploaded file
+    :param is_public: Public flag of the upload (0 or 1)
+    :param source: Source of the upload
+    :return: log id or None
+    """
+    if not get_upload_deduplication() or sha256 is None:
+        return None
+    cur.execute('SELECT Id FROM Logs WHERE Sha256 = ? AND Public = ? AND Source = ? LIMIT 1',
+                [sha256, is_public, source])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        return None
+    return db_tuple[0]
+
+
 def generate_db_data_from_log_file(log_id, db_connection=None):
     """
     Extract necessary information from the log file and insert as an entry to
     the LogsGenerated table (faster information retrieval later on).
     This is an expensive operation.
     It's ok to call this a second time for the same log, the call will just
-    silently fail (but still read the whole log and will not update the DB entry)
+    silently fail (but still read the whole log and will not update the DB entry,
+    only the flight summary & the stored parameters)
 
     :return: DBDataGenerated object
     """
 
     db_data_gen = DBDataGenerated.from_log_file(log_id)
 
-    need_closing = False
     if db_connection is None:
-        db_connection = sqlite3.connect(get_db_filename())
-        need_closing = True
+        db_connection = get_db_connection()
 
     db_cursor = db_connection.cursor()
     try:
-        db_cursor.execute(
-            'insert into LogsGenerated (Id, Duration, '
-            'Mavtype, Estimator, AutostartId, Hardware, '
-            'Software, NumLoggedErrors, NumLoggedWarnings, '
-            'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime) values '
-            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            [log_id, db_data_gen.duration_s, db_data_gen.mav_type,
-             db_data_gen.estimator, db_data_gen.sys_autostart_id,
-             db_data_gen.sys_hw, db_data_gen.ver_sw,
-             db_data_gen.num_logged_errors,
-             db_data_gen.num_logged_warnings,
-             ','.join(map(str, db_data_gen.flight_modes)),
-             db_data_gen.ver_sw_release, db_data_gen.vehicle_uuid,
-             db_data_gen.flight_mode_durations_str(),
-             db_data_gen.start_time_utc])
-        db_connection.commit()
+        # commits, or rolls back on error
+        with db_connection:
+            insert_generated_db_data(db_cursor, log_id, db_data_gen)
     except sqlite3.IntegrityError:
-        # someone else already inserted it (race). just ignore it
-        pass
+        # someone else already inserted it (race), or the log was added before
+        # the flight summary & parameters were stored (backfill): only store these
+        with db_connection:
+            write_flight_summary(db_cursor, log_id, db_data_gen.flight_summary)
+            write_log_parameters(db_cursor, log_id, db_data_gen.parameters)
 
     db_cursor.close()
-    if need_closing:
-        db_connection.close()
 
     return db_data_gen
 
 
-def get_generated_db_data_from_log(log_id, con, cur):
+def get_generated_db_data_from_tuple(db_tuple):
     """
-    try to get the additional data from the DB (or generate it if it does not
-    exist)
-    :param con: db connection
-    :param cur: db cursor
-    :return: DBDataGenerated or None
+    get the generated data from a LogsGenerated table row
+    :param db_tuple: all LogsGenerated columns (select *)
+    :return: DBDataGenerated
     """
-    cur.execute('select * from LogsGenerated where Id = ?', [log_id])
-    db_tuple = cur.fetchone()
-    if db_tuple is None: # need to generate from file
-        try:
-            # Note that this is not necessary in most cases, as the entry is
-            # also generated after uploading (but with a timeout)
-            db_data_gen = generate_db_data_from_log_file(log_id, con)
-        except Exception as e:
-            print('Failed to load log file: '+str(e))
-            return None
-    else: # get it from the DB
-        db_data_gen = DBDataGenerated()
-        db_data_gen.duration_s = db_tuple[1]
-        db_data_gen.mav_type = db_tuple[2]
-        db_data_gen.estimator = db_tuple[3]
-        db_data_gen.sys_autostart_id = db_tuple[4]
-        db_data_gen.sys_hw = db_tuple[5]
-        db_data_gen.ver_sw = db_tuple[6]
-        db_data_gen.num_logged_errors = db_tuple[7]
-        db_data_gen.num_logged_warnings = db_tuple[8]
-        db_data_gen.flight_modes = \
-            {int(x) for x in db_tuple[9].split(',') if len(x) > 0}
-        db_data_gen.ver_sw_release = db_tuple[10]
-        db_data_gen.vehicle_uuid = db_tuple[11]
-        db_data_gen.flight_mode_durations = \
-            [tuple(map(int, x.split(':'))) for x in db_tuple[12].split(',') if len(x) > 0]
+    db_data_gen = DBDataGenerated()
+    db_data_gen.duration_s = db_tuple[1]
+    db_data_gen.mav_type = db_tuple[2]
+    db_data_gen.estimator = db_tuple[3]
+    db_data_gen.sys_autostart_id = db_tuple[4]
+    db_data_gen.sys_hw = db_tuple[5]
+    db_data_gen.ver_sw = db_tuple[6]
+    db_data_gen.num_logged_errors = db_tuple[7]
+    db_data_gen.num_logged_warnings = db_tuple[8]
+    db_data_gen.flight_modes = \
+        {int(x) for x in db_tuple[9].split(',') if len(x) > 0}
+    db_data_gen.ver_sw_release = db_tuple[10]
+    db_data_gen.vehicle_uuid = db_tuple[11]
+    db_data_gen.flight_mode_durations = \
+        [tuple(map(int, x.split(':'))) for x in db_tuple[12].split(',') if len(x) > 0]
+    db_data_gen.start_time_utc = db_tuple[13] or 0 # NULL for old entries
+    db_data_gen.flight_summary = get_flight_summary_from_tuple(db_tuple[14:])
     return db_data_gen
 
@@ -3,80 +3,281 @@ Tornado handler for the JSON public log list retrieval
 """
 from __future__ import print_function
 import json
-import sqlite3
 import os
 import sys
 import tornado.web
+from tornado.iostream import StreamClosedError
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_filename
-from db_entry import DBData
+from backfill_failures import UNLISTED_LOG_IDS_SQL
+from db_connection import get_db_connection, run_db_task
+from db_entry import DBData, DBDataGenerated
+from flight_summary import FLIGHT_SUMMARY_COLUMNS
 from helper import get_airframe_data
+from log_search import get_log_search_filter
 
 
 #pylint: disable=relative-beyond-top-level
-from .common import get_generated_db_data_from_log
+from .backfill import request_generated_db_data
+from .common import get_generated_db_data_from_tuple
 
 #pylint: disable=abstract-method
 
-class DBInfoHandler(tornado.web.RequestHandler):
-    """ Get database info (JSON list of public logs) Tornado request handler """
+# number of logs per query (page) & written chunk of the JSON list
+CHUNK_NUM_LOGS = 200
 
-    def get(self, *args, **kwargs):
-        """ GET request """
 
-        jsonlist = []
-
-        # get the logs (but only the public ones)
-        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
-        cur = con.cursor()
-
-        # get vehicle name information from vehicle table
-        cur.execute('select UUID, Name from Vehicle')
-        db_tuples = cur.fetchall()
-        vehicle_table = {db_tuple[0]: db_tuple[1] for db_tuple in db_tuples}
-
-        cur.execute('SELECT Id, Date, Description, WindSpeed, Rating, VideoUrl, ErrorLabels, '
-                    'Source, Feedback, Type FROM Logs WHERE Public = 1 AND NOT Source = "CI"')
-        # need to fetch all here, because we will do more SQL calls while
-        # iterating (having multiple cursor's does not seem to work)
-        db_tuples = cur.fetchall()
-        for db_tuple in db_tuples:
-            jsondict = {}
-            db_data = DBData()
-            log_id = db_tuple[0]
-            jsondict['log_id'] = log_id
-            jsondict['log_date'] = db_tuple[1].strftime('%Y-%m-%d')
-            db_data.description = db_tuple[2]
-            db_data.wind_speed = db_tuple[3]
-            db_data.rating = db_tuple[4]
-            db_data.video_url = db_tuple[5]
-            db_data.error_labels = sorted([int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
-                if db_tuple[6] else []
-            db_data.source = db_tuple[7]
-            db_data.feedback = db_tuple[8]
-            db_data.type = db_tuple[9]
-            jsondict.update(db_data.to_json_dict())
-
-            db_data_gen = get_generated_db_data_from_log(log_id, con, cur)
-            if db_data_gen is None:
+def get_db_info_query(filters, last_key):
+    """
+    build the query for the public logs matching the filters (joined with the
+    LogsGenerated & Vehicle tables, newest first)
+    :param filters: dict of filters (see DBInfoHandler.get_filters)
+    :param last_key: (Date, rowid) of the last log of the previous page, or
+                     None for the first page
+    :return: tuple of (SQL query string, list of parameters)
+    """
+    sql_where = 'WHERE Logs.Public = 1 AND NOT Logs.Source = "CI" ' \
+        'AND Logs.Id NOT IN ('+UNLISTED_LOG_IDS_SQL+') '
+    sql_params = []
+
+    def add_in_condition(column, values):
+        """ column must match one of the values """
+        nonlocal sql_where
+        sql_where += 'AND '+column+' IN ('+', '.join(['?'] * len(values))+') '
+        sql_params.extend(values)
+
+    def add_list_condition(column, ids):
+        """ the comma-separated list in column must contain all ids """
+        nonlocal sql_where
+        for list_id in ids:
+            sql_where += "AND ',' || "+column+" || ',' LIKE ? "
+            sql_params.append('%,'+str(list_id)+',%')
+
+    if filters['search'] != '':
+        search_filter, search_params = get_log_search_filter(filters['search'])
+        sql_where += 'AND '+search_filter+' '
+        sql_params.extend(search_params)
+    if filters['mav_type']:
+        add_in_condition('lower(LogsGenerated.MavType)',
+                         [mav_type.lower() for mav_type in filters['mav_type']])
+    if filters['rating']:
+        add_in_condition('lower(Logs.Rating)', [rating.lower() for rating in filters['rating']])
+    if filters['error_labels']:
+        add_list_condition('Logs.ErrorLabels', filters['error_labels'])
+    if filters['flight_modes']:
+        add_list_condition('LogsGenerated.FlightModes', filters['flight_modes'])
+    if filters['uuid']:
+        add_in_condition('LogsGenerated.UUID', filters['uuid'])
+    if filters['log_id']:
+        add_in_condition("replace(Logs.Id, '-', '')",
+                         [log_id.replace('-', '') for log_id in filters['log_id']])
+    if filters['vehicle_name'] is not None:
+        sql_where += 'AND Vehicle.Name = ? '
+        sql_params.append(filters['vehicle_name'])
+    # the latest log per vehicle is selected before filtering by source &
+    # git hash (as download_logs.py did), so these are then done in Python
+    if not filters['latest_per_vehicle']:
+        if filters['source'] is not None:
+            sql_where += 'AND Logs.Source = ? '
+            sql_params.append(filters['source'])
+        if filters['git_hash'] is not None:
+            sql_where += 'AND LogsGenerated.Software = ? '
+            sql_params.append(filters['git_hash'])
+    for column, operator, value in filters['flight_summary']:
+        sql_where += 'AND LogsGenerated.'+column+' '+operator+' ? '
+        sql_params.append(value)
+    if last_key is not None:
+        # keyset pagination: continue after the last log of the previous page
+        # (the rowid makes the order unique for logs with the same date)
+        sql_where += 'AND Logs.Date <= ? AND (Logs.Date < ? OR Logs.rowid < ?) '
+        sql_params.extend([last_key[0], last_key[0], last_key[1]])
+
+    sql = ('SELECT Logs.Id, Logs.Date, Logs.Description, Logs.WindSpeed, Logs.Rating, '
+           '       Logs.VideoUrl, Logs.ErrorLabels, Logs.Source, Logs.Feedback, Logs.Type, '
+           '       Logs.rowid, Vehicle.Name, LogsGenerated.* '
+           'FROM Logs '
+           '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+           '   LEFT JOIN Vehicle on LogsGenerated.UUID=Vehicle.UUID '
+           +sql_where+'ORDER BY Logs.Date DESC, Logs.rowid DESC')
+    return sql, sql_params
+
+
+def get_db_info_page(filters, page):
+    """
+    get the next page of the list of public logs matching the filters (runs in
+    the DB thread pool). Each page is a separate query, so that no read
+    transaction is kept open while the response is sent.
+    :param filters: dict of filters (see DBInfoHandler.get_filters)
+    :param page: dict with the pagination state, updated for the next page
+                 (see DBInfoHandler.get)
+    :return: list of JSON strings of the logs
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+
+    sql, sql_params = get_db_info_query(filters, page['last_key'])
+    # the airframe & latest per vehicle filters cannot be done in SQL
+    filter_in_python = filters['airframe_name'] is not None or \
+        filters['airframe_type'] is not None or filters['latest_per_vehicle']
+    num_rows = CHUNK_NUM_LOGS
+    if not filter_in_python:
+        if 0 <= page['num_left'] < num_rows:
+            num_rows = page['num_left']
+        sql += ' LIMIT ? OFFSET ?'
+        sql_params += [num_rows, page['num_skip']]
+        page['num_skip'] = 0
+    else:
+        sql += ' LIMIT ?'
+        sql_params.append(num_rows)
+    cur.execute(sql, sql_params)
+    db_tuples = cur.fetchall()
+    cur.close()
+    if len(db_tuples) < num_rows:
+        page['done'] = True
+    if len(db_tuples) > 0:
+        page['last_key'] = (db_tuples[-1][1], db_tuples[-1][10])
+
+    json_entries = []
+    for db_tuple in db_tuples:
+        if page['num_left'] == 0:
+            break
+        jsondict = {}
+        db_data = DBData()
+        log_id = db_tuple[0]
+        jsondict['log_id'] = log_id
+        jsondict['log_date'] = db_tuple[1].strftime('%Y-%m-%d')
+        db_data.description = db_tuple[2]
+        db_data.wind_speed = db_tuple[3]
+        db_data.rating = db_tuple[4]
+        db_data.video_url = db_tuple[5]
+        db_data.error_labels = sorted([int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
+            if db_tuple[6] else []
+        db_data.source = db_tuple[7]
+        db_data.feedback = db_tuple[8]
+        db_data.type = db_tuple[9]
+        jsondict.update(db_data.to_json_dict())
+
+        vehicle_name = db_tuple[11]
+        if db_tuple[12] is None:
+            # not generated yet: use placeholders, it's done in the background
+            request_generated_db_data(log_id)
+            db_data_gen = DBDataGenerated()
+        else:
+            db_data_gen = get_generated_db_data_from_tuple(db_tuple[12:])
+
+        jsondict.update(db_data_gen.to_json_dict())
+        # add vehicle name
+        jsondict['vehicle_name'] = vehicle_name or ''
+        airframe_data = get_airframe_data(jsondict['sys_autostart_id'])
+        jsondict['airframe_name'] = airframe_data.get('name', '') \
+            if airframe_data is not None else ''
+        jsondict['airframe_type'] = airframe_data.get('type', jsondict['sys_autostart_id']) \
+            if airframe_data is not None else jsondict['sys_autostart_id']
+
+        if filter_in_python:
+            if filters['airframe_name'] is not None and \
+                    jsondict['airframe_name'] != filters['airframe_name']:
+                continue
+            if filters['airframe_type'] is not None and \
+                    jsondict['airframe_type'] != filters['airframe_type']:
+                continue
+            if filters['latest_per_vehicle']:
+                # the logs are sorted by date: only use the first of each vehicle
+                if jsondict['vehicle_uuid'] in page['vehicle_uuids']:
+                    continue
+                page['vehicle_uuids'].add(jsondict['vehicle_uuid'])
+                if filters['source'] is not None and jsondict['source'] != filters['source']:
+                    continue
+                if filters['git_hash'] is not None and jsondict['ver_sw'] != filters['git_hash']:
+                    continue
+            if page['num_skip'] > 0:
+                page['num_skip'] -= 1
                 continue
 
-            jsondict.update(db_data_gen.to_json_dict())
-            # add vehicle name
-            jsondict['vehicle_name'] = vehicle_table.get(jsondict['vehicle_uuid'], '')
-            airframe_data = get_airframe_data(jsondict['sys_autostart_id'])
-            jsondict['airframe_name'] = airframe_data.get('name', '') \
-                if airframe_data is not None else ''
-            jsondict['airframe_type'] = airframe_data.get('type', jsondict['sys_autostart_id']) \
-                if airframe_data is not None else jsondict['sys_autostart_id']
+        json_entries.append(json.dumps(jsondict))
+        page['num_left'] -= 1
 
-            jsonlist.append(jsondict)
+    if page['num_left'] == 0:
+        page['done'] = True
+    return json_entries
 
-        cur.close()
-        con.close()
 
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps(jsonlist))
+class DBInfoHandler(tornado.web.RequestHandler):
+    """ Get database info (JSON list of public logs) Tornado request handler
 
+    Optional query arguments (the logs must match all of them):
+    - search: search string (same as on the browse page)
+    - mav_type, rating, uuid, log_id: must match one of the given values
+      (can be repeated, mav_type & rating are case insensitive)
+    - error_labels, flight_modes: ids, the log must contain all of them (can
+      be repeated)
+    - vehicle_name, airframe_name, airframe_type, source, git_hash
+    - latest_per_vehicle=1: only the latest log of each vehicle
+    - min_<metric>, max_<metric>: range (inclusive) of a flight summary
+      metric, e.g. min_distance_m=1000 (see flight_summary.py for the metrics)
+    - start, length: pagination (the logs are sorted by date, newest first)
+    """
+
+    def get_filters(self):
+        """ get the filter arguments of the request """
+        def get_optional(name):
+            value = self.get_argument(name, None)
+            if value is None or value == '':
+                return None
+            return value
+        try:
+            filters = {
+                'search': self.get_argument('search', '').lower(),
+                'mav_type': self.get_arguments('mav_type'),
+                'rating': self.get_arguments('rating'),
+                'error_labels': [int(x) for x in self.get_arguments('error_labels')],
+                'flight_modes': [int(x) for x in self.get_arguments('flight_modes')],
+                'uuid': self.get_arguments('uuid'),
+                'log_id': self.get_arguments('log_id'),
+                'vehicle_name': get_optional('vehicle_name'),
+                'airframe_name': get_optional('airframe_name'),
+                'airframe_type': get_optional('airframe_type'),
+                'latest_per_vehicle': self.get_argument('latest_per_vehicle', '0') == '1',
+                'source': get_optional('source'),
+                'git_hash': get_optional('git_hash'),
+                'start': max(0, int(self.get_argument('start', '0'))),
+                'length': int(self.get_argument('length', '-1')),
+                'flight_summary': [], # list of (column, SQL operator, value)
+                }
+            for key, column in FLIGHT_SUMMARY_COLUMNS:
+                for prefix, operator in [('min_', '>='), ('max_', '<=')]:
+                    value = get_optional(prefix+key)
+                    if value is not None:
+                        filters['flight_summary'].append((column, operator, float(value)))
+        except ValueError as error:
+            raise tornado.web.HTTPError(400, 'Invalid Parameter') from error
+        if filters['length'] < 0:
+            filters['length'] = -1 # all
+        return filters
+
+    async def get(self, *args, **kwargs):
+        """ GET request """
+        filters = self.get_filters()
+        page = {
+            'last_key': None, # (Date, rowid) of the last log of the previous page
+            'num_skip': filters['start'],
+            'num_left': filters['length'],
+            'vehicle_uuids': set(), # for latest_per_vehicle
+            'done': False,
+            }
+
+        self.set_header('Content-Type', 'application/json')
+        separator = '[' # start of the list, then between the entries
+        try:
+            # query & send the list page by page: a slow client slows down the
+            # queries, without blocking a DB thread or buffering the whole list
+            while not page['done']:
+                json_entries = await run_db_task(get_db_info_page, filters, page)
+                if len(json_entries) > 0:
+                    self.write(separator+','.join(json_entries))
+                    separator = ','
+                    await self.flush()
+            self.write('[]' if separator == '[' else ']')
+        except StreamClosedError:
+            pass # client disconnected
@@ -3,15 +3,19 @@ Tornado handler to delete a log entry (authenticated, no token required)
 """
 
 import os
-import sqlite3
 import sys
 import tornado.web
 
 sys.path.append(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "../plot_app")
 )
-from config import get_db_filename, get_kml_filepath, get_overview_img_filepath
+from config import get_overview_img_filepath
+from kml_export import get_kml_filename
+from db_connection import get_db_connection, run_db_task
 from helper import clear_ulog_cache, get_log_filename
+from log_parameters import delete_log_parameters
+from log_search import delete_log_search_entry
+from log_statistics import delete_log_statistics
 
 from .auth import AuthMixin
 
@@ -19,10 +23,10 @@ from .auth import AuthMixin
 class DeleteLogHandler(AuthMixin, tornado.web.RequestHandler):
     """Delete a log entry, requires authentication"""
 
-    def post(self):
+    async def post(self):
         log_id = self.get_body_argument("log")
 
-        if self._delete_log(log_id):
+        if await run_db_task(self._delete_log, log_id):
             self.redirect("/browse")
         else:
             self.set_status(400)
@@ -33,20 +37,19 @@ class DeleteLogHandler(AuthMixin, tornado.web.RequestHandler):
         """
         Delete a log entry (DB & files) without token validation.
         Authentication is enforced by AuthMixin.
+        Runs in the DB thread pool.
 
         :return: True on success
         """
-        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+        con = get_db_connection()
         cur = con.cursor()
         cur.execute("SELECT Id FROM Logs WHERE Id = ?", (log_id,))
         if cur.fetchone() is None:
             cur.close()
-            con.close()
             return False
 
         # kml file
-        kml_path = get_kml_filepath()
-        kml_file_name = os.path.join(kml_path, log_id.replace("/", ".") + ".kml")
+        kml_file_name = get_kml_filename(log_id)
         if os.path.exists(kml_file_name):
             os.unlink(kml_file_name)
 
@@ -62,11 +65,13 @@ class DeleteLogHandler(AuthMixin, tornado.web.RequestHandler):
         if os.path.exists(log_file_name):
             os.unlink(log_file_name)
 
+        delete_log_statistics(cur, log_id)
+        delete_log_search_entry(cur, log_id)
+        delete_log_parameters(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         con.commit()
         cur.close()
-        con.close()
 
         clear_ulog_cache()
         return True
@@ -3,32 +3,174 @@ Tornado handler for the download page
 """
 
 from __future__ import print_function
+import datetime
 import os
+import re
 from html import escape
 import sys
-import uuid
-import shutil
-import sqlite3
 import tornado.web
 
-from pyulog.ulog2kml import convert_ulog2kml
-
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from helper import get_log_filename, validate_log_id, \
-    flight_modes_table, load_ulog_file, get_default_parameters
-
-from config import get_db_filename, get_kml_filepath
+from helper import get_log_filename, validate_log_id, get_default_parameters
+from log_parameters import get_log_parameters
+from kml_export import request_kml_file
+from db_connection import get_db_connection, run_db_task
 
 #pylint: disable=relative-beyond-top-level
 from .common import CustomHTTPError, TornadoRequestHandlerBase
 
 #pylint: disable=abstract-method, unused-argument
 
+# files are sent in chunks of this size
+FILE_CHUNK_SIZE = 1024 * 1024
+# clients should retry a KML download after this many seconds while the file
+# is generated
+KML_RETRY_AFTER_SEC = 2
+
+_BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_byte_range(range_header, size):
+    """
+    parse the Range header of a request (a single byte range)
+    :param range_header: header value ('bytes=<first>-<last>', 'bytes=<first>-'
+                         or 'bytes=-<suffix length>')
+    :param size: file size
+    :return: tuple of (start, end) with end exclusive, None if the header is
+             not supported (the whole file is sent), or (0, 0) if the range
+             is not satisfiable
+    """
+    match = _BYTE_RANGE_RE.match(range_header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '': # suffix
+        if int(last) == 0:
+            return 0, 0
+        return max(size - int(last), 0), size
+    start = int(first)
+    end = size if last == '' else min(int(last) + 1, size)
+    if start >= size or start >= end:
+        return 0, 0
+    return start, end
+
+
+def _read_file_range(file_name, start, length):
+    """ read part of a file """
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        return file.read(length)
+
+
+def format_parameters(param_values):
+    """
+    format parameters as QGC parameter file
+    :param param_values: list of (name, value) tuples
+    :return: str
+    """
+    delimiter = '\t'
+    lines = []
+    for param_name, param_value in param_values:
+        # sysid, compid, name, value & type: 6 for an int, 9 otherwise
+        lines.append(delimiter.join([
+            '1', '1', param_name, str(param_value),
+            '6' if isinstance(param_value, int) else '9'])+'\n')
+    return ''.join(lines)
+
+
+def get_non_default_parameters(parameters, default_params):
+    """
+    get the parameters of a log that are not set to their default
+    :param parameters: LogParameters or ULog object
+    :param default_params: defaults from the parameter metadata (see
+                           helper.get_default_parameters), used if the log has
+                           no defaults (None otherwise)
+    :return: list of (name, value) tuples, sorted by name (with default_params,
+             the values are str)
+    """
+    system_defaults = parameters.get_default_parameters(0)
+    airframe_defaults = parameters.get_default_parameters(1)
+    param_values = []
+    for param_key, param_value in sorted(parameters.initial_parameters.items()):
+        try:
+            if default_params is None:
+                is_default = True
+                if param_key in airframe_defaults:
+                    is_default = param_value == airframe_defaults[param_key]
+                elif param_key in system_defaults:
+                    is_default = param_value == system_defaults[param_key]
+            else:
+                # compared & written as str (so with type 9), as before the
+                # parameters were stored
+                param_value = str(param_value)
+                is_default = False
+                if param_key in default_params:
+                    default_param = default_params[param_key]
+                    if default_param['type'] == 'FLOAT':
+                        is_default = abs(float(default_param['default']) -
+                                         float(param_value)) < 0.00001
+                    else:
+                        is_default = int(default_param['default']) == int(param_value)
+            if not is_default:
+                param_values.append((param_key, param_value))
+        except (KeyError, ValueError, TypeError):
+            pass
+    return param_values
+
+
 class DownloadHandler(TornadoRequestHandlerBase):
     """ Download log file Tornado request handler """
 
-    def get(self, *args, **kwargs):
+    async def send_file(self, file_name):
+        """ send a file and finish the request, like tornado's
+        StaticFileHandler: supports a Range request (to resume a download) and
+        conditional requests (ETag & If-None-Match). Each chunk is read in the
+        thread pool and flushed before reading the next, so that other
+        requests are served in between and slow clients do not pile up data in
+        memory """
+        file_stat = await run_db_task(os.stat, file_name)
+        size = file_stat.st_size
+        # the files do not change once created, so size & time identify them
+        etag = '"{:x}-{:x}"'.format(file_stat.st_mtime_ns, size)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', datetime.datetime.fromtimestamp(
+            file_stat.st_mtime, datetime.timezone.utc))
+        self.set_header('Accept-Ranges', 'bytes')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        start, end = 0, size
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if range_header is not None and if_range in (None, etag):
+            byte_range = get_byte_range(range_header, size)
+            if byte_range == (0, 0):
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(size))
+                self.finish()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, end - 1, size))
+        self.set_header('Content-Length', end - start)
+
+        position = start
+        while position < end:
+            data = await run_db_task(_read_file_range, file_name, position,
+                                     min(FILE_CHUNK_SIZE, end - position))
+            if not data: # the file was truncated
+                break
+            position += len(data)
+            self.write(data)
+            await self.flush()
+        self.finish()
+
+    async def get(self, *args, **kwargs):
         """ GET request callback """
         log_id = self.get_argument('log')
         if not validate_log_id(log_id):
@@ -42,193 +184,66 @@ class DownloadHandler(TornadoRequestHandlerBase):
         def get_original_filename(default_value, new_file_suffix):
             """
             get the uploaded file name & exchange the file extension
+            (runs in the DB thread pool)
             """
             try:
-                con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
-                cur = con.cursor()
+                cur = get_db_connection().cursor()
                 cur.execute('select OriginalFilename '
                             'from Logs where Id = ?', [log_id])
                 db_tuple = cur.fetchone()
+                cur.close()
                 if db_tuple is not None:
                     original_file_name = escape(db_tuple[0])
                     if original_file_name[-4:].lower() == '.ulg':
                         original_file_name = original_file_name[:-4]
                     return original_file_name + new_file_suffix
-                cur.close()
-                con.close()
             except:
                 print("DB access failed:", sys.exc_info()[0], sys.exc_info()[1])
             return default_value
 
-        if download_type == '1': # download the parameters
-            ulog = load_ulog_file(log_file_name)
-            param_keys = sorted(ulog.initial_parameters.keys())
+        if download_type in ('1', '3'): # download the (non-default) parameters
+            parameters = await run_db_task(get_log_parameters, log_id)
+            if download_type == '1':
+                param_values = sorted(parameters.initial_parameters.items())
+                file_name = 'vehicle.params'
+            else:
+                # use defaults from log if available
+                default_params = None
+                if not parameters.has_default_parameters:
+                    default_params = await run_db_task(get_default_parameters)
+                param_values = get_non_default_parameters(parameters, default_params)
+                file_name = 'non-default.params'
 
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header("Content-Description", "File Transfer")
-            self.set_header('Content-Disposition', 'attachment; filename=vehicle.params')
-
-            delimiter = '	'
-            for param_key in param_keys:
-                self.write("1") #sysid
-                self.write(delimiter)
-                self.write("1") #compid
-                self.write(delimiter)
-                self.write(param_key)
-                self.write(delimiter)
-                self.write(str(ulog.initial_parameters[param_key]))
-
-                #if the value is an int write a 6, if not write a 9
-                if isinstance(ulog.initial_parameters[param_key], int):
-                    self.write(delimiter)
-                    self.write("6")
-                else:
-                    self.write(delimiter)
-                    self.write("9")
-
-                self.write('\n')
+            self.set_header('Content-Disposition', 'attachment; filename='+file_name)
+            self.write(format_parameters(param_values))
 
         elif download_type == '2': # download the kml file
-            kml_path = get_kml_filepath()
-            kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
-
-            # check if chached file exists
-            if not os.path.exists(kml_file_name):
-                print('need to create kml file', kml_file_name)
-
-                def kml_colors(flight_mode):
-                    """ flight mode colors for KML file """
-                    if flight_mode not in flight_modes_table: flight_mode = 0
-
-                    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
-
-                    # increase brightness to match colors with template
-                    rgb = [int(color_str[2*x:2*x+2], 16) for x in range(3)]
-                    for i in range(3):
-                        rgb[i] += 40
-                        if rgb[i] > 255: rgb[i] = 255
-
-                    color_str = "".join(map(lambda x: format(x, '02x'), rgb))
-
-                    return 'ff'+color_str[4:6]+color_str[2:4]+color_str[0:2] # KML uses aabbggrr
-
-                style = {'line_width': 2}
-                # create in random temporary file, then move it (to avoid races)
-                try:
-                    temp_file_name = kml_file_name+'.'+str(uuid.uuid4())
-                    convert_ulog2kml(log_file_name, temp_file_name,
-                                     'vehicle_global_position', kml_colors,
-                                     style=style,
-                                     camera_trigger_topic_name='camera_capture')
-                    shutil.move(temp_file_name, kml_file_name)
-                except Exception as e:
-                    print('Error creating KML file', sys.exc_info()[0], sys.exc_info()[1])
-                    raise CustomHTTPError(400, 'No Position Data in log') from e
-
-
-            kml_dl_file_name = get_original_filename('track.kml', '.kml')
+            # generated in the background (parsing the log can take a while)
+            kml_file_name, error = request_kml_file(log_id)
+            if error is not None:
+                raise CustomHTTPError(400, 'No Position Data in log')
+            if kml_file_name is None:
+                self.set_status(202)
+                self.set_header('Retry-After', KML_RETRY_AFTER_SEC)
+                # browsers reload the page until the file is ready
+                self.write('<html><head><meta http-equiv="refresh" content="{}"></head>'
+                           '<body>Generating the KML file...</body></html>'.format(
+                               KML_RETRY_AFTER_SEC))
+                return
+
+            kml_dl_file_name = await run_db_task(get_original_filename, 'track.kml', '.kml')
 
             # send the whole KML file
             self.set_header("Content-Type", "application/vnd.google-earth.kml+xml")
             self.set_header('Content-Disposition', 'attachment; filename='+kml_dl_file_name)
-            with open(kml_file_name, 'rb') as kml_file:
-                while True:
-                    data = kml_file.read(4096)
-                    if not data:
-                        break
-                    self.write(data)
-                self.finish()
-
-        elif download_type == '3': # download the non-default parameters
-            ulog = load_ulog_file(log_file_name)
-            param_keys = sorted(ulog.initial_parameters.keys())
-
-            self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header("Content-Description", "File Transfer")
-            self.set_header('Content-Disposition', 'attachment; filename=non-default.params')
-            delimiter = '	'
-
-            # Use defaults from log if available
-            if ulog.has_default_parameters:
-                system_defaults = ulog.get_default_parameters(0)
-                airframe_defaults = ulog.get_default_parameters(1)
-                for param_key in param_keys:
-                    try:
-                        param_value = ulog.initial_parameters[param_key]
-                        is_default = True
-                        if param_key in airframe_defaults:
-                            is_default = param_value == airframe_defaults[param_key]
-                        elif param_key in system_defaults:
-                            is_default = param_value == system_defaults[param_key]
-
-                        if not is_default:
-                            self.write("1") # sysid
-                            self.write(delimiter)
-                            self.write("1") # compid
-                            self.write(delimiter)
-                            self.write(param_key)
-                            self.write(delimiter)
-                            self.write(str(param_value))
-
-                            #if the value is an int write a 6, if not write a 9
-                            if isinstance(param_value, int):
-                                self.write(delimiter)
-                                self.write("6")
-                            else:
-                                self.write(delimiter)
-                                self.write("9")
-
-                            self.write('\n')
-                    except:
-                        pass
-
-            else:
-                default_params = get_default_parameters()
-
-                for param_key in param_keys:
-                    try:
-                        param_value = str(ulog.initial_parameters[param_key])
-                        is_default = False
-
-                        if param_key in default_params:
-                            default_param = default_params[param_key]
-                            if default_param['type'] == 'FLOAT':
-                                is_default = abs(float(default_param['default']) -
-                                                 float(param_value)) < 0.00001
-                            else:
-                                is_default = int(default_param['default']) == int(param_value)
-
-                        if not is_default:
-                            self.write("1") # sysid
-                            self.write(delimiter)
-                            self.write("1") # compid
-                            self.write(delimiter)
-                            self.write(param_key)
-                            self.write(delimiter)
-                            self.write(param_value)
-
-                            #if the value is an int write a 6, if not write a 9
-                            if isinstance(param_value, int):
-                                self.write(delimiter)
-                                self.write("6")
-                            else:
-                                self.write(delimiter)
-                                self.write("9")
-
-                            self.write('\n')
-                    except:
-                        pass
+            await self.send_file(kml_file_name)
 
         else: # download the log file
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header("Content-Description", "File Transfer")
             self.set_header('Content-Disposition', 'attachment; filename={}'.format(
                 os.path.basename(log_file_name)))
-            with open(log_file_name, 'rb') as log_file:
-                while True:
-                    data = log_file.read(4096)
-                    if not data:
-                        break
-                    self.write(data)
-                self.finish()
+            await self.send_file(log_file_name)
 
@@ -4,14 +4,18 @@ Tornado handler to edit/delete a log upload entry
 from __future__ import print_function
 import os
 from html import escape
-import sqlite3
 import sys
 import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_filename, get_kml_filepath, get_overview_img_filepath
+from config import get_overview_img_filepath
+from kml_export import get_kml_filename
+from db_connection import get_db_connection, run_db_task
 from helper import clear_ulog_cache, get_log_filename
+from log_parameters import delete_log_parameters
+from log_search import delete_log_search_entry
+from log_statistics import delete_log_statistics
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env
@@ -24,7 +28,7 @@ EDIT_TEMPLATE = 'edit.html'
 class EditEntryHandler(tornado.web.RequestHandler):
     """ Edit a log entry, with confirmation (currently only delete) """
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
         """ GET request """
         log_id = escape(self.get_argument('log'))
         action = self.get_argument('action')
@@ -33,7 +37,7 @@ class EditEntryHandler(tornado.web.RequestHandler):
 
         if action == 'delete':
             if confirmed == '1':
-                if self.delete_log_entry(log_id, token):
+                if await run_db_task(self.delete_log_entry, log_id, token):
                     content = """
 <h3>Log File deleted</h3>
 <p>
@@ -67,11 +71,12 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
     @staticmethod
     def delete_log_entry(log_id, token):
         """
-        delete a log entry (DB & file), validate token first
+        delete a log entry (DB & file), validate token first.
+        Runs in the DB thread pool.
 
         :return: True on success
         """
-        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+        con = get_db_connection()
         cur = con.cursor()
         cur.execute('select Token from Logs where Id = ?', (log_id,))
         db_tuple = cur.fetchone()
@@ -81,8 +86,7 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
             return False
 
         # kml file
-        kml_path = get_kml_filepath()
-        kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
+        kml_file_name = get_kml_filename(log_id)
         if os.path.exists(kml_file_name):
             os.unlink(kml_file_name)
 
@@ -94,11 +98,13 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
         log_file_name = get_log_filename(log_id)
         print('deleting log entry {} and file {}'.format(log_id, log_file_name))
         os.unlink(log_file_name)
+        delete_log_statistics(cur, log_id)
+        delete_log_search_entry(cur, log_id)
+        delete_log_parameters(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         con.commit()
         cur.close()
-        con.close()
 
         # need to clear the cache as well
         clear_ulog_cache()
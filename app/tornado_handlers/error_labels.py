@@ -5,7 +5,6 @@ from __future__ import print_function
 
 import sys
 import os
-import sqlite3
 import tornado.web
 
 # this is needed for the following imports
@@ -13,11 +12,12 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_
 from config import *
 from db_entry import *
 from helper import validate_log_id, validate_error_ids
+from db_connection import get_db_connection, run_db_task
 
 class UpdateErrorLabelHandler(tornado.web.RequestHandler):
     """ Update the error label of a flight log."""
 
-    def post(self, *args, **kwargs):
+    async def post(self, *args, **kwargs):
         """ POST request """
 
         data = tornado.escape.json_decode(self.request.body)
@@ -36,7 +36,14 @@ class UpdateErrorLabelHandler(tornado.web.RequestHandler):
             if error_ix < len(error_ids)-1:
                 error_id_str += ","
 
-        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+        await run_db_task(self.update_error_labels, log_id, error_id_str)
+
+        self.write('OK')
+
+    @staticmethod
+    def update_error_labels(log_id, error_id_str):
+        """ store the error labels of a log (runs in the DB thread pool) """
+        con = get_db_connection()
         cur = con.cursor()
 
         cur.execute(
@@ -45,9 +52,6 @@ class UpdateErrorLabelHandler(tornado.web.RequestHandler):
 
         con.commit()
         cur.close()
-        con.close()
-
-        self.write('OK')
 
     def data_received(self, chunk):
         """ called whenever new data is received """
@@ -0,0 +1,371 @@
+"""
+Ingestion of uploaded logs in a process pool (parsing the log, Vehicle &
+LogsGenerated DB entries, overview image & notification emails), and the
+handler to query the progress of a log
+"""
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+import os
+from html import escape
+import sqlite3
+import sys
+import threading
+
+from pyulog.px4 import PX4ULog
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from config import get_http_protocol, get_domain_name, email_notifications_config, \
+    get_ingest_worker_processes, get_kml_generate_at_ingest
+from db_connection import get_db_connection, run_db_task
+from db_entry import DBVehicleData, DBData, DBDataGenerated
+from helper import get_total_flight_time, get_log_filename, load_ulog_file, \
+    get_airframe_name, validate_log_id, ULogException
+from kml_export import write_kml_file
+from ingest_jobs import INGEST_DONE, INGEST_FAILED, INGEST_QUEUED, \
+    claim_ingest_job, set_ingest_job_state, get_queued_ingest_jobs, get_ingest_job_status, \
+    requeue_crashed_ingest_job
+from overview_generator import generate_overview_img
+
+#pylint: disable=relative-beyond-top-level
+from .common import CustomHTTPError, insert_generated_db_data, \
+    TornadoRequestHandlerBase
+from .send_email import send_notification_email, send_flightreport_email
+
+#pylint: disable=abstract-method
+
+# The pool is per server process. Different processes might submit the same
+# job, only the one that claims it in the DB runs it.
+_lock = threading.Lock()
+_executor = None #pylint: disable=invalid-name
+_executor_pid = None #pylint: disable=invalid-name
+_executor_worker = None #pylint: disable=invalid-name
+_num_executors = 0 #pylint: disable=invalid-name
+_submitted = set() # log ids of the jobs submitted by this process
+
+
+def update_vehicle_db_entry(cur, ulog, log_id, vehicle_name):
+    """
+    Update the Vehicle DB entry
+    :param cur: DB cursor
+    :param ulog: ULog or ULogHeaderParser object
+    :param vehicle_name: new vehicle name or '' if not updated
+    :return vehicle_data: DBVehicleData object
+    """
+
+    vehicle_data = DBVehicleData()
+    if 'sys_uuid' in ulog.msg_info_dict:
+        vehicle_data.uuid = escape(ulog.msg_info_dict['sys_uuid'])
+        vehicle_data.log_id = log_id
+        flight_time = get_total_flight_time(ulog)
+        if flight_time is not None:
+            vehicle_data.flight_time = flight_time
+        write_vehicle_db_entry(cur, vehicle_data, vehicle_name)
+    return vehicle_data
+
+
+def write_vehicle_db_entry(cur, vehicle_data, vehicle_name):
+    """
+    Insert or update a Vehicle DB entry
+    :param cur: DB cursor
+    :param vehicle_data: DBVehicleData object with uuid, log_id & flight_time
+                         set. The name is set by this method
+    :param vehicle_name: new vehicle name or '' if not updated
+    """
+    if vehicle_name == '':
+        cur.execute('select Name '
+                    'from Vehicle where UUID = ?', [vehicle_data.uuid])
+        db_tuple = cur.fetchone()
+        if db_tuple is not None:
+            vehicle_data.name = db_tuple[0]
+    else:
+        vehicle_data.name = vehicle_name
+
+    # update or insert the DB entry
+    cur.execute('insert or replace into Vehicle (UUID, LatestLogId, Name, FlightTime)'
+                'values (?, ?, ?, ?)',
+                [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
+                 vehicle_data.flight_time])
+
+
+def get_ulog_notification_info(ulog):
+    """
+    get the information from the log for the notification emails
+    :param ulog: ULog or ULogHeaderParser object (only the info messages &
+                 initial parameters are used), or None
+    :return: dict
+    """
+    info = {}
+    info['type'] = ''
+    info['airframe'] = ''
+    info['hardware'] = ''
+    info['uuid'] = ''
+    info['software'] = ''
+
+    if ulog is not None:
+        px4_ulog = PX4ULog(ulog)
+        info['type'] = px4_ulog.get_mav_type()
+        airframe_name_tuple = get_airframe_name(ulog)
+        if airframe_name_tuple is not None:
+            airframe_name, airframe_id = airframe_name_tuple
+            if len(airframe_name) == 0:
+                info['airframe'] = airframe_id
+            else:
+                info['airframe'] = airframe_name
+        sys_hardware = ''
+        if 'ver_hw' in ulog.msg_info_dict:
+            sys_hardware = escape(ulog.msg_info_dict['ver_hw'])
+            info['hardware'] = sys_hardware
+        if 'sys_uuid' in ulog.msg_info_dict and sys_hardware != 'SITL':
+            info['uuid'] = escape(ulog.msg_info_dict['sys_uuid'])
+        branch_info = ''
+        if 'ver_sw_branch' in ulog.msg_info_dict:
+            branch_info = ' (branch: '+ulog.msg_info_dict['ver_sw_branch']+')'
+        if 'ver_sw' in ulog.msg_info_dict:
+            ver_sw = escape(ulog.msg_info_dict['ver_sw'])
+            info['software'] = ver_sw + branch_info
+    return info
+
+
+def _get_notification_info(ulog_info, db_data, upload_file_name, vehicle_name):
+    """ get the information for the notification emails
+    :param ulog_info: see get_ulog_notification_info """
+    info = dict(ulog_info)
+    info['description'] = db_data.description
+    info['feedback'] = db_data.feedback
+    info['upload_filename'] = upload_file_name
+    info['rating'] = db_data.rating
+    if len(vehicle_name) > 0:
+        info['vehicle_name'] = vehicle_name
+    return info
+
+
+def _ingest_log(con, cur, log_id, options):
+    """ do the actual ingestion of a log (see run_ingest_job) """
+    cur.execute('select Description, OriginalFilename, Source, WindSpeed, Rating, '
+                'Feedback, Type, Public, Token from Logs where Id = ?', [log_id])
+    db_tuple = cur.fetchone()
+    if db_tuple is None:
+        raise ValueError('the log was deleted')
+    db_data = DBData()
+    db_data.description = db_tuple[0]
+    upload_file_name = db_tuple[1]
+    source = db_tuple[2]
+    db_data.wind_speed = db_tuple[3]
+    db_data.rating = db_tuple[4]
+    db_data.feedback = db_tuple[5]
+    upload_type = db_tuple[6]
+    is_public = db_tuple[7]
+    token = db_tuple[8]
+    is_public_flightreport = upload_type == 'flightreport' and is_public and source != 'CI'
+
+    # Load the ulog file but only if not uploaded via CI
+    ulog = None
+    vehicle_name = options['vehicle_name']
+    if source != 'CI':
+        ulog = load_ulog_file(get_log_filename(log_id))
+        db_data_gen = DBDataGenerated.from_log_file(log_id) # uses the cached ulog
+        with con: # commits, or rolls back on error
+            if not options.get('vehicle_updated', False):
+                vehicle_name = update_vehicle_db_entry(cur, ulog, log_id, vehicle_name).name
+            try:
+                insert_generated_db_data(cur, log_id, db_data_gen)
+            except sqlite3.IntegrityError:
+                pass # generated already (e.g. by the backfill)
+        if is_public_flightreport:
+            generate_overview_img(ulog, log_id)
+        if get_kml_generate_at_ingest():
+            try:
+                write_kml_file(ulog, log_id)
+            except Exception as e: #pylint: disable=broad-except
+                # e.g. no position data: the download reports it
+                print('Failed to generate the KML file of log {}: {}'.format(log_id, e))
+
+    if not options['notify']:
+        return
+
+    full_plot_url = get_http_protocol()+'://'+get_domain_name()+'/plot_app?log='+log_id
+    delete_url = get_http_protocol()+'://'+get_domain_name()+ \
+        '/edit_entry?action=delete&log='+log_id+'&token='+token
+    # the upload handler gets it from the streamed header
+    ulog_info = options.get('ulog_info')
+    if ulog_info is None:
+        ulog_info = get_ulog_notification_info(ulog)
+    info = _get_notification_info(ulog_info, db_data, upload_file_name, vehicle_name)
+
+    if is_public_flightreport:
+        destinations = set(email_notifications_config['public_flightreport'])
+        if db_data.rating in ['unsatisfactory', 'crash_sw_hw', 'crash_pilot']:
+            destinations = destinations | \
+                set(email_notifications_config['public_flightreport_bad'])
+        send_flightreport_email(
+            list(destinations),
+            full_plot_url,
+            DBData.rating_str_static(db_data.rating),
+            DBData.wind_speed_str_static(db_data.wind_speed), delete_url,
+            options['email'], info)
+
+    send_notification_email(options['email'], full_plot_url, delete_url, info)
+
+
+def run_ingest_job(log_id, worker=''):
+    """
+    run a queued ingestion job (in a worker process, or directly). Does
+    nothing if the job is not queued (anymore).
+    :param worker: name of the process pool (see claim_ingest_job)
+    :return: error message if the ingestion failed, '' otherwise
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    with con:
+        options = claim_ingest_job(cur, log_id, worker)
+    if options is None:
+        cur.close()
+        return ''
+    try:
+        _ingest_log(con, cur, log_id, options)
+        error = ''
+    except ULogException:
+        error = 'Failed to parse the file. It is most likely corrupt.'
+        # The log is not listed anymore (see INGEST_FAILED_IDS_SQL), but the
+        # Logs entry is kept for the ingestion status
+        try:
+            os.unlink(get_log_filename(log_id))
+        except OSError:
+            pass
+    except Exception as e: #pylint: disable=broad-except
+        error = str(e) or type(e).__name__
+    if error:
+        print('Failed to ingest log {}: {}'.format(log_id, error))
+    with con:
+        set_ingest_job_state(cur, log_id, INGEST_FAILED if error else INGEST_DONE, error)
+    cur.close()
+    return error
+
+
+def _get_executor():
+    """
+    get the ingestion process pool (created on first use)
+    :return: tuple of (executor, name of the pool)
+    """
+    global _executor, _executor_pid, _executor_worker, _num_executors #pylint: disable=global-statement
+    with _lock:
+        # processes of the parent are not usable after a fork
+        if _executor is None or _executor_pid != os.getpid():
+            # The server process runs other threads, so it must not fork. The
+            # fork server imports serve.py (it does not run the server when
+            # imported) & with it all the modules once, and forks the worker
+            # processes from there.
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload(['__main__'])
+            _executor = ProcessPoolExecutor(max_workers=get_ingest_worker_processes(),
+                                            mp_context=mp_context)
+            _executor_pid = os.getpid()
+            _num_executors += 1
+            _executor_worker = '{}-{}'.format(_executor_pid, _num_executors)
+        return _executor, _executor_worker
+
+
+def _reset_broken_executor(worker):
+    """ discard the pool after a worker process died (e.g. out of memory) """
+    global _executor #pylint: disable=global-statement
+    with _lock:
+        if _executor_worker == worker:
+            _executor = None
+
+
+def _ingest_job_done(log_id, worker, future):
+    """ called when a submitted job finished (from another thread) """
+    with _lock:
+        _submitted.discard(log_id)
+    error = future.exception()
+    if error is not None and not isinstance(error, BrokenProcessPool):
+        print('Failed to run the ingestion job of log {}: {}'.format(log_id, error))
+    if isinstance(error, BrokenProcessPool):
+        _reset_broken_executor(worker)
+        # The pool terminates all its processes, so we cannot tell which job
+        # crashed it: all the jobs that were running are queued again (and
+        # fail after MAX_INGEST_CRASHES), the others are submitted again.
+        con = get_db_connection()
+        cur = con.cursor()
+        with con:
+            state = requeue_crashed_ingest_job(cur, log_id, worker)
+            if state is None:
+                cur.execute('SELECT State FROM IngestJobs WHERE Id = ?', [log_id])
+                db_tuple = cur.fetchone()
+                state = None if db_tuple is None else db_tuple[0]
+        cur.close()
+        if state == INGEST_FAILED:
+            print('Ingestion worker process died while ingesting log {}, giving up'
+                  .format(log_id))
+        elif state == INGEST_QUEUED:
+            submit_ingest_job(log_id)
+
+
+def submit_ingest_job(log_id):
+    """
+    run a queued ingestion job in the process pool. Call this after committing
+    the job (see ingest_jobs.add_ingest_job). Can be called from any thread.
+    """
+    with _lock:
+        if log_id in _submitted:
+            return
+        _submitted.add(log_id)
+    executor, worker = _get_executor()
+    try:
+        future = executor.submit(run_ingest_job, log_id, worker)
+    except BrokenProcessPool:
+        _reset_broken_executor(worker)
+        executor, worker = _get_executor()
+        future = executor.submit(run_ingest_job, log_id, worker)
+    future.add_done_callback(lambda future: _ingest_job_done(log_id, worker, future))
+
+
+def _get_queued_jobs():
+    """ get the queued jobs (runs in the DB thread pool) """
+    cur = get_db_connection().cursor()
+    log_ids = get_queued_ingest_jobs(cur)
+    cur.close()
+    return log_ids
+
+
+async def start_ingest_workers():
+    """
+    start the ingestion processes & submit the jobs that are still queued.
+    Call this once per server process.
+    """
+    # start the fork server & a first worker process
+    _get_executor()[0].submit(os.getpid)
+    log_ids = await run_db_task(_get_queued_jobs)
+    if len(log_ids) > 0:
+        print('Resuming {} queued log ingestion jobs'.format(len(log_ids)))
+    for log_id in log_ids:
+        submit_ingest_job(log_id)
+
+
+def _get_ingest_status(log_id):
+    """ get the ingestion state of a log (runs in the DB thread pool) """
+    cur = get_db_connection().cursor()
+    status = get_ingest_job_status(cur, log_id)
+    cur.close()
+    return status
+
+
+class IngestStatusHandler(TornadoRequestHandlerBase):
+    """ Ingestion progress of an uploaded log (JSON): /ingest_status?log=<id>
+    The state is one of 'queued', 'running', 'done' or 'failed' (with the
+    error message in 'error') """
+
+    async def get(self, *args, **kwargs):
+        """ GET request """
+        log_id = self.get_argument('log')
+        if not validate_log_id(log_id):
+            raise CustomHTTPError(400, 'Invalid Parameter')
+        status = await run_db_task(_get_ingest_status, log_id)
+        if status is None:
+            raise CustomHTTPError(404, 'Log not found')
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(status))
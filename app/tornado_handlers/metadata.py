@@ -0,0 +1,34 @@
+"""
+Tornado handler to monitor & trigger the background refresh of the downloaded
+metadata files (airframes, parameters, events & releases)
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import tornado.web
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from helper import get_metadata_files_status, refresh_metadata_files
+
+#pylint: disable=relative-beyond-top-level
+from .auth import AuthMixin
+
+#pylint: disable=abstract-method
+
+
+class MetadataHandler(AuthMixin, tornado.web.RequestHandler):
+    """ Admin page for the metadata files: GET returns the refresh status
+    (JSON), POST starts a refresh of all files """
+
+    def get(self, *args, **kwargs):
+        """ GET request """
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(get_metadata_files_status()))
+
+    def post(self, *args, **kwargs):
+        """ POST request """
+        refresh_metadata_files(force=True)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(get_metadata_files_status()))
@@ -1,5 +1,6 @@
 
 """Multipart/form-data streamer for tornado 4.3"""
+import hashlib
 import os
 import re
 import tempfile
@@ -40,7 +41,9 @@ class StreamedPart:
     def feed(self, data):
         """Feed data into the stream.
 
-        :param data: Binary string that has arrived from the client."""
+        :param data: Data that has arrived from the client (a memoryview into
+                     the receive buffer, which is only valid during the call).
+        """
         raise NotImplementedError
 
     def finalize(self):
@@ -147,14 +150,17 @@ class TemporaryFileStreamedPart(StreamedPart):
         self.is_moved = False
         self.is_finalized = False
         self.f_out = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        # hashed while streaming, so that the file is not read again
+        self._sha256 = hashlib.sha256()
 
     def feed(self, data):
         """Feed data into the stream.
 
-        :param data: Binary string that has arrived from the client.
+        :param data: Data that has arrived from the client (memoryview).
 
         This version writes data into a temporary file."""
         self.f_out.write(data)
+        self._sha256.update(data)
 
     def finalize(self):
         try:
@@ -163,6 +169,12 @@ class TemporaryFileStreamedPart(StreamedPart):
         finally:
             super().finalize()
 
+    def get_sha256(self):
+        """Get the SHA-256 hex digest of the part data."""
+        if not self.is_finalized:
+            raise RuntimeError("Cannot hash temporary file: stream is not finalized yet.")
+        return self._sha256.hexdigest()
+
     def move(self, file_path):
         """Move the temporary file to a new location.
 
@@ -235,9 +247,13 @@ class MultiPartStreamer:
         :param total: Total number of bytes in the stream. This is what the http
                       client sends as the Content-Length header of the whole form.
         """
-        self.buf = b""
+        # received data that is not parsed yet starts at buf[pos:]. The data
+        # before pos is dropped when the next chunk arrives (in place).
+        self.buf = bytearray()
+        self.pos = 0
         self.dlen = None
         self.delimiter = None
+        self.boundary = None # SEP + delimiter: end of a part
         self.in_data = False
         self.headers = []
         self.parts = []
@@ -245,20 +261,21 @@ class MultiPartStreamer:
         self.received = 0
         self.part = None
 
-    def _get_raw_header(self, data):
+    def _get_raw_header(self):
         """Return raw header data.
 
         Internal method. Do not call directly.
 
-        :param data: A string containing raw data from the form part
-        :return: A tuple of (header_value, tail) where header_value is the first
-                 line of the form part. If there is no first line yet (e.g. the
-                 whole data is a single line) then header_value will be None.
+        :return: The next line of the buffered data (without separator), which
+                 is then consumed. If there is no complete line yet then None is
+                 returned.
         """
-        idx = data.find(self.SEP)
+        idx = self.buf.find(self.SEP, self.pos)
         if idx >= 0:
-            return data[:idx], data[idx + self.L_SEP:]
-        return None, data
+            header = bytes(self.buf[self.pos:idx])
+            self.pos = idx + self.L_SEP
+            return header
+        return None
 
     def _parse_header(self, header):
         """Parse raw header data.
@@ -300,6 +317,13 @@ class MultiPartStreamer:
         self.part._size += len(data)
         self.part.feed(data)
 
+    def _feed_buffer(self, end):
+        """Internal method to feed buf[pos:end] to the current part, without
+        copying it. The part must not keep a reference to the data."""
+        with memoryview(self.buf) as view:
+            self._feed_part(view[self.pos:end])
+        self.pos = end
+
     def _end_part(self):
         """Internal method called when receiving the current part has finished.
 
@@ -320,13 +344,18 @@ class MultiPartStreamer:
         """
         self.received += len(chunk)
         self.on_progress(self.received, self.total)
+        # only a few bytes are left over from the previous chunk (the data is
+        # fed up to the last 2 * dlen bytes), so this is cheap
+        del self.buf[:self.pos]
+        self.pos = 0
         self.buf += chunk
 
         if not self.delimiter:
-            self.delimiter, self.buf = self._get_raw_header(self.buf)
+            self.delimiter = self._get_raw_header()
             if self.delimiter:
                 self.delimiter += self.SEP
                 self.dlen = len(self.delimiter)
+                self.boundary = self.SEP + self.delimiter
             elif len(self.buf) > 1000:
                 raise ParseError("Cannot find multipart delimiter")
             else:
@@ -334,23 +363,22 @@ class MultiPartStreamer:
 
         while True:
             if self.in_data:
-                if len(self.buf) > 3 * self.dlen:
-                    idx = self.buf.find(self.SEP + self.delimiter)
+                if len(self.buf) - self.pos > 3 * self.dlen:
+                    idx = self.buf.find(self.boundary, self.pos)
                     if idx >= 0:
-                        self._feed_part(self.buf[:idx])
+                        self._feed_buffer(idx)
                         self._end_part()
-                        self.buf = self.buf[idx + len(self.SEP + self.delimiter):]
+                        self.pos += len(self.boundary)
                         self.in_data = False
                     else:
-                        limit = len(self.buf) - 2 * self.dlen
-                        self._feed_part(self.buf[:limit])
-                        self.buf = self.buf[limit:]
+                        # keep the tail, it might be the start of a boundary
+                        self._feed_buffer(len(self.buf) - 2 * self.dlen)
                         return
                 else:
                     return
             if not self.in_data:
                 while True:
-                    header, self.buf = self._get_raw_header(self.buf)
+                    header = self._get_raw_header()
                     if header == b"":
                         assert self.delimiter
                         self.in_data = True
@@ -369,9 +397,9 @@ class MultiPartStreamer:
 
         You MUST call this before using the parts."""
         if self.in_data:
-            idx = self.buf.rfind(self.SEP + self.delimiter[:-2])
-            if idx > 0:
-                self._feed_part(self.buf[:idx])
+            idx = self.buf.rfind(self.SEP + self.delimiter[:-2], self.pos)
+            if idx > self.pos:
+                self._feed_buffer(idx)
             self._end_part()
 
     def create_part(self, headers):
@@ -0,0 +1,120 @@
+"""
+Tornado handlers to query the stored parameters of the logs (JSON): the value
+of a parameter across logs, vehicles or a time window, and the differences
+between two logs
+"""
+from __future__ import print_function
+import datetime
+import json
+import os
+import sys
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from db_connection import get_db_connection, run_db_task
+from helper import validate_log_id, get_log_filename
+from log_parameters import query_log_parameter, get_log_parameters, diff_log_parameters
+
+#pylint: disable=relative-beyond-top-level
+from .auth import AuthMixin
+from .common import CustomHTTPError, TornadoRequestHandlerBase
+
+#pylint: disable=abstract-method, unused-argument
+
+
+def _parse_time(value):
+    """ parse an ISO 8601 date or date & time (UTC if no time zone is given)
+    :return: unix timestamp in seconds """
+    time = datetime.datetime.fromisoformat(value)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return int(time.timestamp())
+
+
+def _query_log_parameter(*args):
+    """ query a parameter (runs in the DB thread pool) """
+    cur = get_db_connection().cursor()
+    try:
+        return query_log_parameter(cur, *args)
+    finally:
+        cur.close()
+
+
+def _is_log_listed(cur, log_id):
+    """ check whether a log is public & not uploaded by CI (as the logs of the
+    parameter queries) """
+    cur.execute('SELECT Id FROM Logs WHERE Id = ? AND Public = 1 AND NOT Source = "CI"',
+                [log_id])
+    return cur.fetchone() is not None
+
+
+def _diff_log_parameters(log_id, reference_log_id):
+    """ get the parameter differences of two logs (runs in the DB thread pool)
+    :return: list of differences, or None if a log does not exist or is not
+             public """
+    cur = get_db_connection().cursor()
+    try:
+        if not _is_log_listed(cur, log_id) or not _is_log_listed(cur, reference_log_id):
+            return None
+    finally:
+        cur.close()
+    if not os.path.exists(get_log_filename(log_id)) or \
+            not os.path.exists(get_log_filename(reference_log_id)):
+        return None
+    return diff_log_parameters(get_log_parameters(log_id),
+                               get_log_parameters(reference_log_id))
+
+
+class ParameterQueryHandler(AuthMixin, TornadoRequestHandlerBase):
+    """ Value of a parameter in many logs (JSON):
+    /parameters?name=<param>[&log=<id>][&uuid=<vehicle uuid>][&start=<time>][&end=<time>]
+    - log, uuid: the log or its vehicle must match one of the given values (can
+      be repeated)
+    - start, end: time window of the log start (ISO 8601, UTC by default, end
+      excluded). Logs without GPS time are not in any window.
+    The logs are sorted by start time (newest first), 'values' contains the
+    number of logs per value (the most common first). Only public logs (not
+    uploaded by CI) with stored parameters are included (see /admin/backfill
+    for older logs).
+    """
+
+    async def get(self, *args, **kwargs):
+        """ GET request """
+        name = self.get_argument('name')
+        log_ids = self.get_arguments('log') or None
+        if log_ids is not None and not all(validate_log_id(log_id) for log_id in log_ids):
+            raise CustomHTTPError(400, 'Invalid Parameter')
+        uuids = self.get_arguments('uuid') or None
+        try:
+            start_time = _parse_time(self.get_argument('start')) \
+                if self.get_argument('start', '') else None
+            end_time = _parse_time(self.get_argument('end')) \
+                if self.get_argument('end', '') else None
+        except ValueError as e:
+            raise CustomHTTPError(400, 'Invalid time') from e
+
+        result = await run_db_task(_query_log_parameter, name, log_ids, uuids,
+                                   start_time, end_time)
+        result['name'] = name
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result))
+
+
+class ParameterDiffHandler(AuthMixin, TornadoRequestHandlerBase):
+    """ Parameters that differ between a log and a reference log (JSON):
+    /parameters/diff?log=<id>&reference=<id>
+    A value is null if the log does not have the parameter. Both logs must be
+    public (and not uploaded by CI). """
+
+    async def get(self, *args, **kwargs):
+        """ GET request """
+        log_id = self.get_argument('log')
+        reference_log_id = self.get_argument('reference')
+        if not validate_log_id(log_id) or not validate_log_id(reference_log_id):
+            raise CustomHTTPError(400, 'Invalid Parameter')
+        differences = await run_db_task(_diff_log_parameters, log_id, reference_log_id)
+        if differences is None:
+            raise CustomHTTPError(404, 'Log not found')
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'log': log_id, 'reference': reference_log_id,
+                               'differences': differences}))
@@ -0,0 +1,451 @@
+"""
+Tornado handlers for resumable uploads of (large) ULog files:
+- POST /upload/resumable?size=<bytes>&filename=<name>&<upload form fields>
+  creates a session (the file is preallocated in the log folder)
+- PUT /upload/resumable/<session> with a 'Content-Range: bytes <first>-<last>/<size>'
+  header writes a byte range of the file. Ranges can be uploaded in any order
+  and in parallel, and are retried after a connection drop.
+- GET /upload/resumable/<session> returns the missing byte ranges
+- POST /upload/resumable/<session> finalizes the upload: the file becomes a
+  log and is ingested like an upload of the upload page
+- DELETE /upload/resumable/<session> aborts the upload
+All responses are JSON.
+"""
+
+import asyncio
+import datetime
+import errno
+import hashlib
+import json
+import os
+import re
+import sys
+import uuid
+import tornado.web
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from config import get_resumable_upload_max_size_mb, get_resumable_upload_expiry_hours
+from db_connection import get_db_connection, run_db_task
+from ulog_header import ULogHeaderParser
+from upload_sessions import UPLOAD_SESSION_OPEN, get_upload_session_filename, \
+    create_upload_session, get_upload_session, start_upload_session_write, \
+    end_upload_session_write, add_upload_session_range, get_missing_upload_ranges, \
+    claim_upload_session, release_upload_session, delete_upload_session, \
+    get_expired_upload_sessions
+
+#pylint: disable=relative-beyond-top-level
+from .common import CustomHTTPError, TornadoRequestHandlerBase, get_duplicate_log_id, \
+    DUPLICATE_UPLOAD_MESSAGE
+from .bulk_upload import generate_log_id, get_upload_formdict, insert_bulk_log_db_entry
+from .ingest import submit_ingest_job
+from .auth import AuthMixin
+
+#pylint: disable=attribute-defined-outside-init,unused-argument
+
+# chunk size recommended to the clients (any size up to the file size works)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# buffer size for hashing & parsing the header of a finalized upload
+FINALIZE_READ_SIZE = 1024 * 1024
+
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+def _get_session_url(session_id):
+    return '/upload/resumable/'+session_id
+
+
+def _remove_upload_session(cur, session_id):
+    """ delete a session & its file (the caller commits) """
+    delete_upload_session(cur, session_id)
+    file_name = get_upload_session_filename(session_id)
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+def _get_session_status(cur, session_id, session):
+    """ get the JSON status of a session """
+    missing = get_missing_upload_ranges(cur, session_id, session['size'])
+    return {'session': session_id, 'url': _get_session_url(session_id),
+            'size': session['size'],
+            'received': session['size'] - sum(end - start for start, end in missing),
+            'missing': missing, 'complete': len(missing) == 0}
+
+
+def _create_session(size, file_name, formdict):
+    """ create a session & preallocate its file (runs in the DB thread pool)
+    :return: session id """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        max_age = datetime.timedelta(hours=get_resumable_upload_expiry_hours())
+        for expired_session_id in get_expired_upload_sessions(cur, max_age):
+            print('Removing expired upload session', expired_session_id)
+            _remove_upload_session(cur, expired_session_id)
+        con.commit()
+
+        session_id = str(uuid.uuid4())
+        with open(get_upload_session_filename(session_id), 'wb') as session_file:
+            try:
+                # reserves the disk space (fails early if the disk is full)
+                os.posix_fallocate(session_file.fileno(), 0, size)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    os.remove(session_file.name)
+                    raise
+                # not supported by the file system: sparse file
+                session_file.truncate(size)
+        create_upload_session(cur, session_id, size, file_name, formdict)
+        con.commit()
+        return session_id
+    finally:
+        con.rollback()
+        cur.close()
+
+
+def _write_file_range(file_descriptor, data, offset):
+    """ write data to a file at an offset """
+    data = memoryview(data)
+    while len(data) > 0:
+        num_written = os.pwrite(file_descriptor, data, offset)
+        data = data[num_written:]
+        offset += num_written
+
+
+def _get_session(session_id):
+    """ get a session (runs in the DB thread pool) """
+    cur = get_db_connection().cursor()
+    session = get_upload_session(cur, session_id)
+    cur.close()
+    return session
+
+
+def _start_write(session_id):
+    """ register a PUT request of a session (runs in the DB thread pool)
+    :return: False if the session is not open anymore """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        started = start_upload_session_write(cur, session_id)
+        con.commit()
+        return started
+    finally:
+        con.rollback()
+        cur.close()
+
+
+def _end_write(session_id):
+    """ unregister a failed PUT request (runs in the DB thread pool) """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        end_upload_session_write(cur, session_id)
+        con.commit()
+    finally:
+        con.rollback()
+        cur.close()
+
+
+def _get_status(session_id):
+    """ get the status of a session (runs in the DB thread pool)
+    :return: status dict or None if there is no such session """
+    cur = get_db_connection().cursor()
+    try:
+        session = get_upload_session(cur, session_id)
+        if session is None:
+            return None
+        return _get_session_status(cur, session_id, session)
+    finally:
+        cur.close()
+
+
+def _add_range(session_id, start, end):
+    """ record a received range & get the status (runs in the DB thread pool)
+    :return: status dict or None if the session was deleted or finalized in
+             the meantime (e.g. expired) """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        session = get_upload_session(cur, session_id)
+        if session is None:
+            return None
+        if session['state'] != UPLOAD_SESSION_OPEN:
+            end_upload_session_write(cur, session_id)
+            con.commit()
+            return None
+        add_upload_session_range(cur, session_id, start, end)
+        con.commit()
+        return _get_session_status(cur, session_id, session)
+    finally:
+        con.rollback()
+        cur.close()
+
+
+def _abort_session(session_id):
+    """ delete an open session (runs in the DB thread pool)
+    :return: False if there is no open session """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        session = get_upload_session(cur, session_id)
+        if session is None or session['state'] != UPLOAD_SESSION_OPEN:
+            return False
+        _remove_upload_session(cur, session_id)
+        con.commit()
+        return True
+    finally:
+        con.rollback()
+        cur.close()
+
+
+def _read_session_file(file_name):
+    """ hash a finalized upload & parse its header
+    :return: tuple of (SHA-256 hex digest, ULogHeaderParser) """
+    sha256 = hashlib.sha256()
+    ulog_header = ULogHeaderParser()
+    with open(file_name, 'rb') as session_file:
+        while True:
+            data = session_file.read(FINALIZE_READ_SIZE)
+            if len(data) == 0:
+                break
+            sha256.update(data)
+            ulog_header.feed(data)
+    return sha256.hexdigest(), ulog_header
+
+
+def _finalize_claimed_session(con, cur, session_id, session):
+    """ finalize a session that was claimed by this request (see
+    _finalize_session)
+    :return: tuple of (result, value) """
+    status = _get_session_status(cur, session_id, session)
+    if not status['complete']:
+        release_upload_session(cur, session_id)
+        con.commit()
+        return 'incomplete', status
+
+    session_file_name = get_upload_session_filename(session_id)
+    sha256, ulog_header = _read_session_file(session_file_name)
+    if not ulog_header.is_ulog:
+        _remove_upload_session(cur, session_id)
+        con.commit()
+        return 'invalid', None
+
+    duplicate_log_id = get_duplicate_log_id(cur, sha256, session['options']['is_public'],
+                                            session['options']['source'])
+    if duplicate_log_id is not None:
+        print('Upload of {} is a duplicate of log {}'.format(
+            session['file_name'], duplicate_log_id))
+        _remove_upload_session(cur, session_id)
+        con.commit()
+        return 'done', (duplicate_log_id, True)
+
+    log_id, new_file_name = generate_log_id()
+    print('Moving uploaded file to', new_file_name)
+    os.rename(session_file_name, new_file_name)
+    try:
+        insert_bulk_log_db_entry(cur, log_id, session['file_name'], session['options'],
+                                 sha256=sha256, ulog_header=ulog_header)
+        delete_upload_session(cur, session_id)
+        con.commit()
+    except Exception:
+        os.rename(new_file_name, session_file_name)
+        raise
+    return 'done', (log_id, False)
+
+
+def _finalize_session(session_id):
+    """
+    turn a completely uploaded session into a log & queue its ingestion (runs
+    in the DB thread pool)
+    :return: tuple of (result, value): ('not_found', None), ('incomplete',
+             status dict), ('invalid', None) or ('done', (log id, whether it is
+             a duplicate of an existing log))
+    """
+    con = get_db_connection()
+    cur = con.cursor()
+    try:
+        session = get_upload_session(cur, session_id)
+        if session is None:
+            return 'not_found', None
+        if not claim_upload_session(cur, session_id):
+            # finalized by another request, or byte ranges are being written
+            return 'incomplete', _get_session_status(cur, session_id, session)
+        con.commit()
+        try:
+            result, value = _finalize_claimed_session(con, cur, session_id, session)
+        except Exception:
+            # reopen the session, so that finalizing can be retried
+            con.rollback()
+            release_upload_session(cur, session_id)
+            con.commit()
+            raise
+    finally:
+        # discard uncommitted changes on error (the connection is shared)
+        con.rollback()
+        cur.close()
+    if result == 'done' and not value[1]:
+        submit_ingest_job(value[0])
+    return result, value
+
+
+class ResumableUploadHandler(AuthMixin, TornadoRequestHandlerBase):
+    """ Creates resumable upload sessions """
+
+    async def post(self, *args, **kwargs):
+        """ POST request: create a session """
+        try:
+            size = int(self.get_argument('size'))
+        except ValueError as e:
+            raise CustomHTTPError(400, 'Invalid size') from e
+        if size <= 0 or size > get_resumable_upload_max_size_mb() * 1024 * 1024:
+            raise CustomHTTPError(400, 'Invalid size')
+        file_name = os.path.basename(self.get_argument('filename'))
+
+        # the upload form fields, as for an upload of the upload page
+        form_data = {name: values[0] for name, values in self.request.arguments.items()}
+        form_data.setdefault('description', b'')
+        formdict = get_upload_formdict(form_data)
+
+        try:
+            session_id = await run_db_task(_create_session, size, file_name, formdict)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            raise CustomHTTPError(507, 'Not enough disk space') from e
+        url = _get_session_url(session_id)
+        self.set_status(201)
+        self.set_header('Location', url)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'session': session_id, 'url': url, 'size': size,
+                               'chunk_size': UPLOAD_CHUNK_SIZE}))
+
+
+@tornado.web.stream_request_body
+class ResumableUploadSessionHandler(AuthMixin, TornadoRequestHandlerBase):
+    """ Receives the byte ranges of a resumable upload session, and returns its
+    status, finalizes or aborts it """
+
+    def initialize(self):
+        """ initialize the instance """
+        self.upload_fd = None
+        self.upload_write = None
+        self.upload_session_id = None # set while registered as writer
+
+    async def prepare(self):
+        """ called before a new request: opens the session file for a PUT
+        request (the body is written to it while it is received) """
+        super().prepare()
+        if self._finished or self.request.method.upper() != 'PUT':
+            return
+        session_id = self.path_args[0]
+        match = _CONTENT_RANGE_RE.match(self.request.headers.get('Content-Range', ''))
+        if match is None:
+            raise CustomHTTPError(400, 'Missing or invalid Content-Range header')
+        first, last, size = (int(value) for value in match.groups())
+        session = await run_db_task(_get_session, session_id)
+        if session is None:
+            raise CustomHTTPError(404, 'Upload session not found')
+        if session['state'] != UPLOAD_SESSION_OPEN:
+            raise CustomHTTPError(409, 'Upload session is being finalized')
+        if size != session['size'] or first > last or last >= size:
+            raise CustomHTTPError(416, 'Invalid range')
+        self.range_start = first
+        self.range_end = last + 1
+        if int(self.request.headers.get('Content-Length', -1)) != self.range_end - first:
+            raise CustomHTTPError(400, 'Content-Length does not match the range')
+        self.request.connection.set_max_body_size(self.range_end - first)
+        self.upload_position = first
+        upload_fd = os.open(get_upload_session_filename(session_id), os.O_WRONLY)
+        # the session cannot be finalized while the range is written
+        if not await run_db_task(_start_write, session_id):
+            os.close(upload_fd)
+            raise CustomHTTPError(409, 'Upload session is being finalized')
+        self.upload_fd = upload_fd
+        self.upload_session_id = session_id
+
+    async def data_received(self, chunk):
+        """ called whenever new data is received """
+        if self.upload_fd is None:
+            return
+        # the client is not read from until the data is written
+        self.upload_write = asyncio.ensure_future(run_db_task(
+            _write_file_range, self.upload_fd, chunk, self.upload_position))
+        await self.upload_write
+        self.upload_position += len(chunk)
+
+    def on_finish(self):
+        """ called after the request finished """
+        self._close_upload_file()
+
+    def on_connection_close(self):
+        """ called if the client disconnected (e.g. during a PUT) """
+        self._close_upload_file()
+
+    def _close_upload_file(self):
+        upload_fd = self.upload_fd
+        if upload_fd is None:
+            return
+        self.upload_fd = None
+        # still registered as writer if the range was not recorded
+        session_id = self.upload_session_id
+        self.upload_session_id = None
+
+        def close(_=None):
+            os.close(upload_fd)
+            if session_id is not None:
+                asyncio.ensure_future(run_db_task(_end_write, session_id))
+
+        if self.upload_write is not None and not self.upload_write.done():
+            # the client disconnected during a write: close after it
+            self.upload_write.add_done_callback(close)
+        else:
+            close()
+
+    def _write_json(self, value):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(value))
+
+    async def put(self, session_id):
+        """ PUT request: a byte range was received """
+        if self.upload_position != self.range_end:
+            raise CustomHTTPError(400, 'Incomplete range')
+        await run_db_task(os.fsync, self.upload_fd)
+        # the writer is unregistered when the range is recorded
+        self.upload_session_id = None
+        self._close_upload_file()
+        status = await run_db_task(_add_range, session_id, self.range_start, self.range_end)
+        if status is None:
+            raise CustomHTTPError(409, 'Upload session was finalized or deleted')
+        self._write_json(status)
+
+    async def get(self, session_id):
+        """ GET request: status of the upload """
+        status = await run_db_task(_get_status, session_id)
+        if status is None:
+            raise CustomHTTPError(404, 'Upload session not found')
+        self._write_json(status)
+
+    async def post(self, session_id):
+        """ POST request: finalize the upload """
+        result, value = await run_db_task(_finalize_session, session_id)
+        if result == 'not_found':
+            raise CustomHTTPError(404, 'Upload session not found')
+        if result == 'incomplete':
+            self.set_status(409)
+            self._write_json(value)
+            return
+        if result == 'invalid':
+            raise CustomHTTPError(400, 'Invalid File')
+        log_id, is_duplicate = value
+        response = {'url': '/plot_app?log='+log_id,
+                    'status_url': '/ingest_status?log='+log_id,
+                    'duplicate': is_duplicate}
+        if is_duplicate:
+            response['message'] = DUPLICATE_UPLOAD_MESSAGE
+        self._write_json(response)
+
+    async def delete(self, session_id):
+        """ DELETE request: abort the upload """
+        if not await run_db_task(_abort_session, session_id):
+            raise CustomHTTPError(404, 'Upload session not found')
+        self._write_json({'session': session_id, 'deleted': True})
@@ -0,0 +1,101 @@
+"""
+Tornado handler for the statistics page (rendered as standalone bokeh page and
+cached, as it is the same for all visitors)
+"""
+from __future__ import print_function
+import asyncio
+import os
+import sys
+import time
+
+from bokeh.embed import file_html
+from bokeh.layouts import column
+from bokeh.resources import Resources
+from bokeh.themes import Theme
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from config import plot_config, debug_verbose_output, get_statistics_cache_ttl_sec
+from db_connection import get_db_connection, run_db_task, run_render_task
+from log_statistics import get_log_statistics_change_count
+from statistics_plots import get_statistics_page_plots
+
+#pylint: disable=relative-beyond-top-level
+from .common import get_jinja_env, TornadoRequestHandlerBase
+
+#pylint: disable=abstract-method
+
+STATISTICS_TEMPLATE = 'index.html'
+
+_THEME = Theme(filename=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                     '../plot_app/theme.yaml'))
+
+# the cached page. Only accessed from the IOLoop thread
+_cache = {
+    'html': None,
+    'time': 0, # time.monotonic() when the rendering started
+    'change_count': -1, # statistics change count when the rendering started
+    'pending': None, # rendering task, shared by all requests waiting for it
+    }
+
+
+def render_statistics_page():
+    """
+    generate the statistics page (runs in the render thread pool)
+    :return: HTML string
+    """
+    plots = get_statistics_page_plots(plot_config, debug_verbose_output())
+    # the JS & CSS are served by the bokeh server
+    resources = Resources(mode='server', root_url='/')
+    return file_html(column(plots, sizing_mode='scale_width'), resources,
+                     'Flight Review - Statistics',
+                     template=get_jinja_env().get_template(STATISTICS_TEMPLATE),
+                     template_variables={'is_stats_page': True}, theme=_THEME)
+
+
+def _get_change_count():
+    """ get the statistics change count (runs in the DB thread pool) """
+    cur = get_db_connection().cursor()
+    try:
+        return get_log_statistics_change_count(cur)
+    finally:
+        cur.close()
+
+
+async def _update_statistics_page(change_count):
+    """ render the page & update the cache
+    :param change_count: statistics change count before rendering """
+    try:
+        start_time = time.monotonic()
+        html = await run_render_task(render_statistics_page)
+        _cache['html'] = html
+        _cache['time'] = start_time
+        _cache['change_count'] = change_count
+        return html
+    finally:
+        _cache['pending'] = None
+
+
+async def get_statistics_page():
+    """
+    get the statistics page from the cache, or render it if it expired or
+    logs were added or deleted since (by any process). Concurrent requests
+    share the rendering.
+    :return: HTML string
+    """
+    change_count = await run_db_task(_get_change_count)
+    if _cache['html'] is not None and \
+            time.monotonic() - _cache['time'] < get_statistics_cache_ttl_sec() and \
+            _cache['change_count'] == change_count:
+        return _cache['html']
+    if _cache['pending'] is None:
+        _cache['pending'] = asyncio.ensure_future(_update_statistics_page(change_count))
+    return await _cache['pending']
+
+
+class StatisticsHandler(TornadoRequestHandlerBase):
+    """ Tornado Request Handler for the statistics page """
+
+    async def get(self, *args, **kwargs):
+        """ GET request callback """
+        self.write(await get_statistics_page())
@@ -4,110 +4,141 @@ Tornado handler for the upload page
 
 from __future__ import print_function
 import datetime
+import hashlib
 import json
 import os
 from html import escape
 import sys
 import uuid
 import binascii
-import sqlite3
 import tornado.web
-from tornado.ioloop import IOLoop
-
-from pyulog import ULog
-from pyulog.px4 import PX4ULog
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from db_entry import DBVehicleData, DBData
-from config import get_db_filename, get_http_protocol, get_domain_name, \
-    email_notifications_config, get_ulge_private_key_path
-from helper import get_total_flight_time, validate_url, get_log_filename, \
-    load_ulog_file, get_airframe_name, ULogException, decrypt_ulge_payload
-from overview_generator import generate_overview_img_from_id
+from config import get_http_protocol, get_domain_name, get_ulge_private_key_path
+from db_connection import get_db_connection, run_db_task
+from helper import validate_url, get_log_filename, decrypt_ulge_chunks
+from ingest_jobs import add_ingest_job
+from log_search import update_log_search_entry
+from log_statistics import add_log_upload_statistics
+from ulog_header import ULogHeaderParser
 from .auth import AuthMixin
 
 #pylint: disable=relative-beyond-top-level
-from .common import get_jinja_env, CustomHTTPError, generate_db_data_from_log_file, \
-    TornadoRequestHandlerBase
-from .send_email import send_notification_email, send_flightreport_email
-from .multipart_streamer import MultiPartStreamer
+from .common import get_jinja_env, CustomHTTPError, TornadoRequestHandlerBase, \
+    get_duplicate_log_id, LogUploadMixin, DUPLICATE_UPLOAD_MESSAGE
+from .ingest import submit_ingest_job, update_vehicle_db_entry, get_ulog_notification_info
 
 
 UPLOAD_TEMPLATE = 'upload.html'
+UPLOAD_RESULT_TEMPLATE = 'bulk_upload_result.html'
 
 
 #pylint: disable=attribute-defined-outside-init,too-many-statements, unused-argument
 
 
-def update_vehicle_db_entry(cur, ulog, log_id, vehicle_name):
+def insert_log_db_entry(log_values, ingest_options, ulog_header):
+    """
+    Insert a new entry into the Logs table, update the search index & queue
+    the log for ingestion (runs in the DB thread pool)
+    :param log_values: list of the Logs column values (in the order of the
+                       insert statement)
+    :param ingest_options: options dict of the ingestion job (see
+                           ingest_jobs.add_ingest_job)
+    :param ulog_header: ULogHeaderParser of the uploaded file: the Vehicle
+                        entry & the information for the notification emails
+                        are taken from it. None to skip these (CI uploads)
     """
-    Update the Vehicle DB entry
-    :param cur: DB cursor
-    :param ulog: ULog object
-    :param vehicle_name: new vehicle name or '' if not updated
-    :return vehicle_data: DBVehicleData object
+    log_id = log_values[0]
+    con = get_db_connection()
+    cur = con.cursor()
+    if ulog_header is not None:
+        # the job does not need to get it from the log then
+        ingest_options['ulog_info'] = get_ulog_notification_info(ulog_header)
+    with con: # commits, or rolls back on error
+        cur.execute(
+            'insert into Logs (Id, Title, Description, '
+            'OriginalFilename, Date, AllowForAnalysis, Obfuscated, '
+            'Source, Email, WindSpeed, Rating, Feedback, Type, '
+            'videoUrl, ErrorLabels, Public, Token, Sha256) values '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            log_values)
+        update_log_search_entry(cur, log_id)
+        add_log_upload_statistics(cur, log_id)
+        if ulog_header is not None:
+            ingest_options['vehicle_name'] = update_vehicle_db_entry(
+                cur, ulog_header, log_id, ingest_options['vehicle_name']).name
+            ingest_options['vehicle_updated'] = True
+        add_ingest_job(cur, log_id, ingest_options)
+    cur.close()
+
+
+def decrypt_uploaded_file(file_obj, output_file_name, private_key_path):
     """
+    Decrypt an uploaded .ulge file into a .ulg file, chunk by chunk (runs in
+    the DB thread pool). The decrypted data is hashed & its header parsed on
+    the way.
+    :param file_obj: uploaded file (finalized ULogStreamedPart)
+    :return: tuple of (SHA-256 hex digest, ULogHeaderParser) of the decrypted data
+    """
+    sha256 = hashlib.sha256()
+    ulog_header = ULogHeaderParser()
+    with open(file_obj.f_out.name, 'rb') as encrypted_file, \
+            open(output_file_name, 'wb') as output_file:
+        for data in decrypt_ulge_chunks(encrypted_file, private_key_path):
+            output_file.write(data)
+            sha256.update(data)
+            ulog_header.feed(data)
+    return sha256.hexdigest(), ulog_header
 
-    vehicle_data = DBVehicleData()
-    if 'sys_uuid' in ulog.msg_info_dict:
-        vehicle_data.uuid = escape(ulog.msg_info_dict['sys_uuid'])
-
-        if vehicle_name == '':
-            cur.execute('select Name '
-                        'from Vehicle where UUID = ?', [vehicle_data.uuid])
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                vehicle_data.name = db_tuple[0]
-            print('reading vehicle name from db:'+vehicle_data.name)
-        else:
-            vehicle_data.name = vehicle_name
-            print('vehicle name from uploader:'+vehicle_data.name)
 
-        vehicle_data.log_id = log_id
-        flight_time = get_total_flight_time(ulog)
-        if flight_time is not None:
-            vehicle_data.flight_time = flight_time
+def _remove_file(file_name):
+    """ remove a file if it exists """
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+async def decrypt_upload(file_obj, output_file_name, private_key_path):
+    """
+    Decrypt an uploaded .ulge file into output_file_name (see
+    decrypt_uploaded_file). The output file is removed if decryption fails or
+    the result is not a ULog file.
+    :return: tuple of (SHA-256 hex digest, ULogHeaderParser) of the decrypted data
+    """
+    try:
+        sha256, ulog_header = await run_db_task(
+            decrypt_uploaded_file, file_obj, output_file_name, private_key_path)
+
+    except Exception as e:
+        _remove_file(output_file_name)
+        raise CustomHTTPError(400, f"Decryption failed: {str(e)}") from e
+
+    if not ulog_header.is_ulog:
+        _remove_file(output_file_name)
+        raise CustomHTTPError(400, "Decrypted file is not a valid ULog")
+
+    print(f"Decryption successful for {file_obj.get_filename()}, saved to {output_file_name}")
+    return sha256, ulog_header
+
 
-        # update or insert the DB entry
-        cur.execute('insert or replace into Vehicle (UUID, LatestLogId, Name, FlightTime)'
-                    'values (?, ?, ?, ?)',
-                    [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
-                     vehicle_data.flight_time])
-    return vehicle_data
+def find_duplicate_log(sha256, is_public, source):
+    """
+    get an existing log with the same content (runs in the DB thread pool)
+    :return: log id or None (also if deduplication is disabled)
+    """
+    cur = get_db_connection().cursor()
+    try:
+        return get_duplicate_log_id(cur, sha256, is_public, source)
+    finally:
+        cur.close()
 
 
 @tornado.web.stream_request_body
-class UploadHandler(AuthMixin, TornadoRequestHandlerBase):
+class UploadHandler(LogUploadMixin, AuthMixin, TornadoRequestHandlerBase):
     """ Upload log file Tornado request handler: handles page requests and POST
     data """
 
-    def initialize(self):
-        """ initialize the instance """
-        self.multipart_streamer = None
-
-    def prepare(self):
-        """ called before a new request """
-        super.prepare()
-        if self.request.method.upper() == 'POST':
-            if 'expected_size' in self.request.arguments:
-                self.request.connection.set_max_body_size(
-                    int(self.get_argument('expected_size')))
-            try:
-                total = int(self.request.headers.get("Content-Length", "0"))
-            except KeyError:
-                total = 0
-            self.multipart_streamer = MultiPartStreamer(total)
-
-    def data_received(self, chunk):
-        """ called whenever new data is received """
-        if self.multipart_streamer:
-            self.multipart_streamer.data_received(chunk)
-
-    def get(self, *args, **kwargs):
-        """ GET request callback """
-        template = get_jinja_env().get_template(UPLOAD_TEMPLATE)
-        self.write(template.render())
+    upload_template = UPLOAD_TEMPLATE
 
     def _generate_unique_log_filename(self):
         """Generate a unique log filename that does not exist yet."""
@@ -118,7 +149,27 @@ class UploadHandler(AuthMixin, TornadoRequestHandlerBase):
                 return log_id, new_file_name
 
 
-    def post(self, *args, **kwargs):
+    def _write_response(self, url, log_id, should_redirect, is_duplicate, upload_file_name):
+        """ redirect to the plot page or return its url as json """
+        if should_redirect and is_duplicate:
+            # show that the options of this upload were not stored
+            template = get_jinja_env().get_template(UPLOAD_RESULT_TEMPLATE)
+            self.write(template.render(
+                upload_filename=upload_file_name,
+                results=[(upload_file_name, log_id, DUPLICATE_UPLOAD_MESSAGE)],
+                num_failed=0, num_duplicates=1))
+        elif should_redirect:
+            self.redirect(url)
+        else:
+            # Return plot url as json
+            response = {"url": url,
+                        "status_url": '/ingest_status?log='+log_id,
+                        "duplicate": is_duplicate}
+            if is_duplicate:
+                response["message"] = DUPLICATE_UPLOAD_MESSAGE
+            self.write(json.dumps(response))
+
+    async def post(self, *args, **kwargs):
         """ POST request callback """
         if self.multipart_streamer:
             try:
@@ -187,36 +238,35 @@ class UploadHandler(AuthMixin, TornadoRequestHandlerBase):
 
                 # check if the file is encrypted
                 ulge_key_path = get_ulge_private_key_path()
-                if ulge_key_path and upload_file_name.lower().endswith('.ulge'):
-                    file_payload = file_obj.get_payload()  # full content as bytes
-                    try:
-                        decrypted_data = decrypt_ulge_payload(
-                        file_payload,
-                        get_ulge_private_key_path()
-                    )
-
-                    except Exception as e:
-                        raise CustomHTTPError(400, f"Decryption failed: {str(e)}") from e
-
-                    if decrypted_data[:len(ULog.HEADER_BYTES)] != ULog.HEADER_BYTES:
-                        raise CustomHTTPError(400, "Decrypted file is not a valid ULog")
-
+                is_encrypted = ulge_key_path and upload_file_name.lower().endswith('.ulge')
+                log_id, new_file_name = self._generate_unique_log_filename()
+                if is_encrypted:
                     # Write decrypted .ulg to disk
-                    log_id, new_file_name = self._generate_unique_log_filename()
-
-                    with open(new_file_name, 'wb') as output_file:
-                        output_file.write(decrypted_data)
-
-                    print(f"Decryption successful for {upload_file_name}, saved to {new_file_name}")
+                    sha256, ulog_header = await decrypt_upload(
+                        file_obj, new_file_name, ulge_key_path)
 
                 else:
-                    # Regular .ulg file
-                    log_id, new_file_name = self._generate_unique_log_filename()
-
-                    header_len = len(ULog.HEADER_BYTES)
-                    if file_obj.get_payload_partial(header_len) != ULog.HEADER_BYTES:
+                    # parsed while receiving
+                    ulog_header = file_obj.ulog_header
+                    if not ulog_header.is_ulog:
                         raise CustomHTTPError(400, 'Invalid File')
-
+                    sha256 = file_obj.get_sha256()
+
+                # the same file was uploaded before: return the existing log
+                duplicate_log_id = await run_db_task(find_duplicate_log, sha256, is_public,
+                                                     source)
+                if duplicate_log_id is not None:
+                    print('Upload of {} is a duplicate of log {}'.format(
+                        upload_file_name, duplicate_log_id))
+                    if is_encrypted:
+                        _remove_file(new_file_name)
+                    self._write_response('/plot_app?log='+duplicate_log_id,
+                                         duplicate_log_id, should_redirect, True,
+                                         upload_file_name)
+                    return
+
+                if not is_encrypted:
+                    # Regular .ulg file
                     print('Moving uploaded file to', new_file_name)
                     file_obj.move(new_file_name)
 
@@ -227,117 +277,26 @@ class UploadHandler(AuthMixin, TornadoRequestHandlerBase):
                 # generate a token: secure random string (url-safe)
                 token = str(binascii.hexlify(os.urandom(16)), 'ascii')
 
-                # Load the ulog file but only if not uploaded via CI.
-                # Then we open the DB connection.
-                ulog = None
-                if source != 'CI':
-                    ulog_file_name = get_log_filename(log_id)
-                    ulog = load_ulog_file(ulog_file_name)
-
-                # put additional data into a DB
-                con = sqlite3.connect(get_db_filename())
-                cur = con.cursor()
-                cur.execute(
-                    'insert into Logs (Id, Title, Description, '
-                    'OriginalFilename, Date, AllowForAnalysis, Obfuscated, '
-                    'Source, Email, WindSpeed, Rating, Feedback, Type, '
-                    'videoUrl, ErrorLabels, Public, Token) values '
-                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                # put additional data into a DB. The log is parsed and the
+                # notification emails are sent by the ingestion job
+                await run_db_task(
+                    insert_log_db_entry,
                     [log_id, title, description, upload_file_name,
                      datetime.datetime.now(), allow_for_analysis,
                      obfuscated, source, stored_email, wind_speed, rating,
-                     feedback, upload_type, video_url, error_labels, is_public, token])
-
-                if ulog is not None:
-                    vehicle_data = update_vehicle_db_entry(cur, ulog, log_id, vehicle_name)
-                    vehicle_name = vehicle_data.name
-
-                con.commit()
+                     feedback, upload_type, video_url, error_labels, is_public, token,
+                     sha256],
+                    {'vehicle_name': vehicle_name, 'email': email, 'notify': True},
+                    None if source == 'CI' else ulog_header)
+                submit_ingest_job(log_id)
 
                 url = '/plot_app?log='+log_id
-                full_plot_url = get_http_protocol()+'://'+get_domain_name()+url
-                print(full_plot_url)
-
-                delete_url = get_http_protocol()+'://'+get_domain_name()+ \
-                    '/edit_entry?action=delete&log='+log_id+'&token='+token
-
-                # information for the notification email
-                info = {}
-                info['description'] = description
-                info['feedback'] = feedback
-                info['upload_filename'] = upload_file_name
-                info['type'] = ''
-                info['airframe'] = ''
-                info['hardware'] = ''
-                info['uuid'] = ''
-                info['software'] = ''
-                info['rating'] = rating
-                if len(vehicle_name) > 0:
-                    info['vehicle_name'] = vehicle_name
-
-                if ulog is not None:
-                    px4_ulog = PX4ULog(ulog)
-                    info['type'] = px4_ulog.get_mav_type()
-                    airframe_name_tuple = get_airframe_name(ulog)
-                    if airframe_name_tuple is not None:
-                        airframe_name, airframe_id = airframe_name_tuple
-                        if len(airframe_name) == 0:
-                            info['airframe'] = airframe_id
-                        else:
-                            info['airframe'] = airframe_name
-                    sys_hardware = ''
-                    if 'ver_hw' in ulog.msg_info_dict:
-                        sys_hardware = escape(ulog.msg_info_dict['ver_hw'])
-                        info['hardware'] = sys_hardware
-                    if 'sys_uuid' in ulog.msg_info_dict and sys_hardware != 'SITL':
-                        info['uuid'] = escape(ulog.msg_info_dict['sys_uuid'])
-                    branch_info = ''
-                    if 'ver_sw_branch' in ulog.msg_info_dict:
-                        branch_info = ' (branch: '+ulog.msg_info_dict['ver_sw_branch']+')'
-                    if 'ver_sw' in ulog.msg_info_dict:
-                        ver_sw = escape(ulog.msg_info_dict['ver_sw'])
-                        info['software'] = ver_sw + branch_info
-
-
-                if upload_type == 'flightreport' and is_public and source != 'CI':
-                    destinations = set(email_notifications_config['public_flightreport'])
-                    if rating in ['unsatisfactory', 'crash_sw_hw', 'crash_pilot']:
-                        destinations = destinations | \
-                            set(email_notifications_config['public_flightreport_bad'])
-                    send_flightreport_email(
-                        list(destinations),
-                        full_plot_url,
-                        DBData.rating_str_static(rating),
-                        DBData.wind_speed_str_static(wind_speed), delete_url,
-                        email, info)
-
-                    # also generate the additional DB entry
-                    # (we may have the log already loaded in 'ulog', however the
-                    # lru cache will make it very quick to load it again)
-                    generate_db_data_from_log_file(log_id, con)
-                    # also generate the preview image
-                    IOLoop.instance().add_callback(generate_overview_img_from_id, log_id)
-
-                con.commit()
-                cur.close()
-                con.close()
-
-                # send notification emails
-                send_notification_email(email, full_plot_url, delete_url, info)
-
-                if should_redirect:
-                    self.redirect(url)
-                else:
-                    # Return plot url as json
-                    self.write(json.dumps({"url": url}))
+                print(get_http_protocol()+'://'+get_domain_name()+url)
+                self._write_response(url, log_id, should_redirect, False, upload_file_name)
 
             except CustomHTTPError:
                 raise
 
-            except ULogException as e:
-                raise CustomHTTPError(
-                    400,
-                    'Failed to parse the file. It is most likely corrupt.') from e
             except Exception as e:
                 print('Error when handling POST data', sys.exc_info()[0],
                       sys.exc_info()[1])
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+""" Script to measure the throughput & peak memory of the multipart/form-data
+parser of the upload handlers, with a generated upload """
+
+import argparse
+import os
+import time
+import tracemalloc
+
+from tornado_handlers.multipart_streamer import MultiPartStreamer, StreamedPart
+
+BOUNDARY = b'----FlightReviewBenchmarkBoundary7MA4YWxk'
+
+# chunk size of tornado's HTTP1Connection
+CHUNK_SIZE = 64 * 1024
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = argparse.ArgumentParser(description='Benchmark the multipart/form-data parser '
+                                                 'with a generated upload of a single file.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--size', type=int, default=500,
+                        help='Size of the uploaded file in MB.')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Size of the received chunks in bytes.')
+    parser.add_argument('--write', action='store_true', default=False,
+                        help='Write the file to a temporary file (as the upload handlers '
+                        'do), instead of discarding it.')
+    return parser.parse_args()
+
+
+class _DiscardedStreamedPart(StreamedPart): #pylint: disable=abstract-method
+    """ part that only counts the data, to measure the parser alone """
+
+    def feed(self, data):
+        pass
+
+
+class _BenchmarkStreamer(MultiPartStreamer):
+    """ streamer that optionally discards the data """
+
+    def __init__(self, total, write):
+        super().__init__(total)
+        self.write = write
+
+    def create_part(self, headers):
+        if self.write:
+            return super().create_part(headers)
+        return _DiscardedStreamedPart(self, headers)
+
+
+def generate_chunks(file_size, chunk_size):
+    """ generate the request body of an upload, in chunks """
+    header = (b'--' + BOUNDARY + b'\r\n'
+              b'Content-Disposition: form-data; name="description"\r\n\r\n'
+              b'benchmark\r\n'
+              b'--' + BOUNDARY + b'\r\n'
+              b'Content-Disposition: form-data; name="filearg"; filename="log.ulg"\r\n'
+              b'Content-Type: application/octet-stream\r\n\r\n')
+    trailer = b'\r\n--' + BOUNDARY + b'--\r\n'
+    data = os.urandom(chunk_size)
+    yield header
+    remaining = file_size
+    while remaining > 0:
+        yield data[:min(remaining, chunk_size)]
+        remaining -= chunk_size
+    yield trailer
+
+
+def run(file_size, chunk_size, write):
+    """ parse a generated upload
+    :return: duration in seconds """
+    chunks = generate_chunks(file_size, chunk_size)
+    streamer = _BenchmarkStreamer(file_size, write)
+    start_time = time.monotonic()
+    for chunk in chunks:
+        streamer.data_received(chunk)
+    streamer.data_complete()
+    duration = time.monotonic() - start_time
+    assert streamer.parts[-1].get_size() == file_size
+    streamer.release_parts()
+    return duration
+
+
+def main():
+    """ main method """
+    args = get_arguments()
+    file_size = args.size * 1024 * 1024
+
+    duration = run(file_size, args.chunk_size, args.write)
+    print('Parsed {} MB in {:.2f} s: {:.1f} MB/s'.format(
+        args.size, duration, args.size / duration))
+
+    # separate run, tracing slows it down
+    tracemalloc.start()
+    run(file_size, args.chunk_size, args.write)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('Peak memory: {:.2f} MB'.format(peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ set -e
 pushd app
 export PYTHONPATH="plot_app:plot_app/libevents/libs/python"
 python3 $pylint_exec tornado_handlers/*.py serve.py \
-	plot_app/*.py download_logs.py
+	plot_app/*.py download_logs.py load_test.py \
+	ingest_logs.py upload_benchmark.py
 popd
 exit 0